@@ -0,0 +1,262 @@
+# Content-addressed cache of intermediate files
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+FICLONE = 0x40049409
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def fingerprint(path, chunk=1 << 20):
+  """A fast fingerprint of a file's content.
+
+  Hashes the size and the first, middle, and last chunk bytes, so that it does
+  not change when a file is renamed or touched.  Results are remembered for as
+  long as the file's device, inode, size, and mtime stay the same."""
+
+  path = pathlib.Path(path)
+  st = path.stat()
+  stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+  with _fingerprints_lock:
+    if (fp := _fingerprints.get(path)) and fp[0] == stamp:
+      return fp[1]
+  h = hashlib.sha256(str(st.st_size).encode())
+  with open(path, "rb") as f:
+    for pos in sorted({0, max(0, st.st_size // 2 - chunk // 2), max(0, st.st_size - chunk)}):
+      f.seek(pos)
+      h.update(f.read(chunk))
+  digest = h.hexdigest()
+  with _fingerprints_lock:
+    _fingerprints[path] = (stamp, digest)
+  return digest
+
+
+def materialize(src, dst):
+  """Make dst a copy of src, by reflink or hardlink where possible."""
+
+  src = pathlib.Path(src)
+  dst = pathlib.Path(dst)
+  try:
+    dst.unlink()
+  except FileNotFoundError:
+    pass
+  if fcntl is not None:
+    try:
+      with open(src, "rb") as i, open(dst, "wb") as o:
+        fcntl.ioctl(o.fileno(), FICLONE, i.fileno())
+      return
+    except OSError as e:
+      if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+        raise
+      dst.unlink()
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copyfile(src, dst)
+
+
+class ArtifactStore:
+  """A size-bounded, least-recently-used store of intermediate files.
+
+  Artifacts are keyed by the fingerprint of their source plus the parameters
+  of the stage that made them, so they survive renames of the source and the
+  deletion of a title's config.  Last use is recorded in the access time,
+  leaving modification times (which readytomake compares) alone."""
+
+  def __init__(self, root, max_bytes):
+    self.root = pathlib.Path(root).resolve()
+    self.root.mkdir(parents=True, exist_ok=True)
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def key(source, stage, params):
+    d = json.dumps([fingerprint(source), stage, params], sort_keys=True, default=str)
+    return hashlib.sha256(d.encode()).hexdigest()
+
+  def _path(self, key, suffix):
+    return self.root / key[:2] / f"{key}{suffix}"
+
+  def fetch(self, key, dst):
+    """Materialize artifact key as dst; return its metadata dict, or None if absent."""
+
+    dst = pathlib.Path(dst)
+    art = self._path(key, dst.suffix)
+    meta = art.with_suffix(art.suffix + ".json")
+    with self._lock:
+      try:
+        st = art.stat()
+        with open(meta, "rt", encoding="utf-8") as fp:
+          m = json.load(fp)
+      except (FileNotFoundError, json.JSONDecodeError):
+        return None
+      if st.st_size == 0:
+        return None
+      os.utime(art, ns=(time.time_ns(), st.st_mtime_ns))
+      materialize(art, dst)
+    # The materialized file must look newer than the inputs it was made from.
+    os.utime(dst)
+    log.info(f"Reused cached artifact for {dst}.")
+    return m
+
+  def store(self, key, src, meta=None):
+    """Add file src with metadata dict meta to the store as artifact key."""
+
+    src = pathlib.Path(src)
+    if not src.exists() or src.stat().st_size == 0:
+      return
+    art = self._path(key, src.suffix)
+    art.parent.mkdir(exist_ok=True)
+    tmp = art.with_suffix(f"{art.suffix}.{os.getpid()}.{threading.get_ident()}.tmp")
+    materialize(src, tmp)
+    with self._lock:
+      with open(art.with_suffix(art.suffix + ".json"), "wt", encoding="utf-8") as fp:
+        json.dump(meta or {}, fp)
+      tmp.replace(art)
+      self._evict()
+
+  def _evict(self):
+    arts = []
+    for d in self.root.iterdir():
+      if not d.is_dir():
+        continue
+      for f in d.iterdir():
+        if f.suffix in (".json", ".tmp"):
+          continue
+        st = f.stat()
+        arts.append((st.st_atime, st.st_size, f))
+    total = sum(a[1] for a in arts)
+    for _, size, f in sorted(arts, key=lambda a: a[0]):
+      if total <= self.max_bytes:
+        break
+      log.debug(f"Evicting cached artifact {f}.")
+      for g in (f, f.with_suffix(f.suffix + ".json")):
+        try:
+          g.unlink()
+        except FileNotFoundError:
+          pass
+      total -= size
+
+
+class ProbeCache:
+  """A persistent cache of parsed probe results of source files.
+
+  Entries are keyed by a file's device, inode, size, and mtime plus the name
+  of the probe, and hold zlib-compressed JSON.  With validate, a content
+  fingerprint is checked as well, catching files replaced with identical
+  stat results.  Every evict_every puts, and whenever the running total of
+  the stored sizes exceeds max_bytes, entries unused for max_age seconds are
+  evicted, and then the least recently used ones until at most low_water of
+  max_bytes are stored."""
+
+  evict_every = 100
+  low_water = 0.9
+
+  def __init__(self, path, max_age=90 * 86400.0, max_bytes=64 << 20, validate=False):
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+    self.validate = validate
+    self.hits = 0
+    self.misses = 0
+    self._total = None
+    self._puts = 0
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute(
+      "CREATE TABLE IF NOT EXISTS probes ("
+      " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, probe TEXT,"
+      " fingerprint TEXT, used REAL, data BLOB,"
+      " PRIMARY KEY (dev, ino, size, mtime_ns, probe))"
+    )
+
+  @staticmethod
+  def _stamp(path):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+  def get(self, path, probe):
+    """Return the cached result of probe for path, or None."""
+
+    stamp = self._stamp(path)
+    with self._lock:
+      row = self._db.execute(
+        "SELECT fingerprint, data FROM probes"
+        " WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND probe=?",
+        (*stamp, probe),
+      ).fetchone()
+      if row is not None:
+        self._db.execute(
+          "UPDATE probes SET used=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND probe=?",
+          (time.time(), *stamp, probe),
+        )
+    if row is None or (self.validate and row[0] != fingerprint(path)):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return json.loads(zlib.decompress(row[1]))
+
+  def put(self, path, probe, value):
+    stamp = self._stamp(path)
+    data = zlib.compress(json.dumps(value, separators=(",", ":")).encode(), 9)
+    fp = fingerprint(path) if self.validate else None
+    with self._lock:
+      old = self._db.execute(
+        "SELECT LENGTH(data) FROM probes WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND probe=?",
+        (*stamp, probe),
+      ).fetchone()
+      self._db.execute(
+        "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (*stamp, probe, fp, time.time(), data),
+      )
+      self._puts += 1
+      if self._total is not None:
+        self._total += len(data) - (old[0] if old else 0)
+      # The total drifts with the puts of other processes, so it is recounted now and then.
+      if self._total is None or self._total > self.max_bytes or self._puts % self.evict_every == 0:
+        self._evict()
+
+  def probe(self, path, probe, func, *args):
+    """Return the result of func(*args) as probe of path, from the cache if possible."""
+
+    if (v := self.get(path, probe)) is not None:
+      return v
+    v = func(*args)
+    self.put(path, probe, v)
+    return v
+
+  def _evict(self):
+    self._db.execute("DELETE FROM probes WHERE used < ?", (time.time() - self.max_age,))
+    (total,) = self._db.execute("SELECT COALESCE(SUM(LENGTH(data)), 0) FROM probes").fetchone()
+    self._total = total
+    if total <= self.max_bytes:
+      return
+    rows = self._db.execute("SELECT rowid, LENGTH(data) FROM probes ORDER BY used").fetchall()
+    doomed = []
+    for rowid, size in rows:
+      if total <= self.max_bytes * self.low_water:
+        break
+      doomed.append((rowid,))
+      total -= size
+    self._db.executemany("DELETE FROM probes WHERE rowid=?", doomed)
+    self._total = total
@@ -1,18 +1,30 @@
 # Various utility functions
 
 import argparse
+import ctypes
+import ctypes.util
 import json
 import logging
 # import logging.handlers
 import os
 import pathlib
 import re
+import select
+import socket
+import struct
+import threading
 import time
 import unicodedata
 
+from concurrent.futures import ThreadPoolExecutor
 from fractions import Fraction
 from xmlrpc.client import Boolean
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 # if os.name == "nt":
 #   import ctypes
 #   import win32api
@@ -225,31 +237,505 @@ def to_float(s):
   raise ValueError
 
 
-def sleep_change_directories(dirs, state=None):
-  """Sleep until any of the files in any of the dirs has changed."""
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
 
-  while True:
-    nstate = {f: f.stat().st_mtime for d in dirs for f in d.iterdir()}
-    if nstate != state:
-      return nstate
 
-    # if os.name == "nt":
-    #   import win32file, win32event, win32con  # noqa: E401
+class Inotify:
+  """A minimal ctypes wrapper around the Linux inotify API."""
 
-    #   watches = (
-    #     win32con.FILE_NOTIFY_CHANGE_FILE_NAME
-    #     | win32con.FILE_NOTIFY_CHANGE_ATTRIBUTES
-    #     | win32con.FILE_NOTIFY_CHANGE_LAST_WRITE
-    #   )
-    #   try:
-    #     chs = [win32file.FindFirstChangeNotification(str(d), 0, watches) for d in dirs]
-    #     while win32event.WaitForMultipleObjects(chs, 0, 1000) == win32con.WAIT_TIMEOUT:
-    #       pass
-    #   finally:
-    #     for ch in chs:
-    #       win32file.FindCloseChangeNotification(ch)
-    # else:
-    time.sleep(10)
+  _event = struct.Struct("iIII")
+
+  def __init__(self):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self._libc = libc
+    self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    self._wds = {}
+
+  def add_watch(self, path, mask):
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e), str(path))
+    self._wds[wd] = pathlib.Path(path)
+    return wd
+
+  def read(self, timeout=None):
+    """Return a list of (path, mask) events, waiting at most timeout seconds."""
+
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    try:
+      buf = os.read(self.fd, 65536)
+    except BlockingIOError:
+      return []
+    events = []
+    pos = 0
+    while pos + self._event.size <= len(buf):
+      wd, mask, _, nlen = self._event.unpack_from(buf, pos)
+      pos += self._event.size
+      name = buf[pos : pos + nlen].rstrip(b"\0")
+      pos += nlen
+      d = self._wds.get(wd)
+      if mask & IN_Q_OVERFLOW:
+        events.append((None, mask))
+      elif d is not None:
+        events.append((d / os.fsdecode(name) if name else d, mask))
+    return events
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+
+class LogFollower:
+  """Return the lines appended to a growing log file since the last read."""
+
+  def __init__(self, path):
+    self.path = pathlib.Path(path)
+    self.offset = 0
+    self._partial = b""
+
+  def read(self):
+    try:
+      with open(self.path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size < self.offset:
+          # Truncated or replaced; start over.
+          self.offset = 0
+          self._partial = b""
+        fp.seek(self.offset)
+        data = fp.read()
+    except FileNotFoundError:
+      return []
+    self.offset += len(data)
+    *lines, self._partial = (self._partial + data).split(b"\n")
+    return [l.decode("utf-8", errors="replace").strip() for l in lines]
+
+  def flush(self):
+    """Return any final line not terminated by a newline."""
+
+    lines = self.read()
+    if self._partial:
+      lines.append(self._partial.decode("utf-8", errors="replace").strip())
+      self._partial = b""
+    return lines
+
+
+class SourceWatcher:
+  """Wait for source files in any of dirs to be completely written.
+
+  Uses inotify where available and directory scans every interval seconds
+  otherwise.  With inotify, the directories are still scanned every rescan
+  seconds (never if rescan is 0), since writes through network filesystems
+  (NFS, SMB) raise no events.  A file is quarantined until its size has been
+  stable for settle seconds.  A requeued file waits twice as long each time,
+  and is dropped after retries requeues until it changes."""
+
+  def __init__(self, dirs, settle=30.0, interval=10.0, backend="auto", rescan=600.0, retries=5):
+    self.dirs = list(dirs)
+    self.settle = settle
+    self.interval = interval
+    self.rescan = rescan
+    self.retries = retries
+    self.pending = {}
+    self._known = {}
+    self._failures = {}
+    self._scanned = 0.0
+    self.notify = None
+    if backend in ("auto", "inotify"):
+      try:
+        notify = Inotify()
+        for d in self.dirs:
+          notify.add_watch(
+            d,
+            IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_FROM,
+          )
+        self.notify = notify
+      except (OSError, AttributeError) as e:
+        if backend == "inotify":
+          raise
+        log.info(f"inotify unavailable ({e}), polling source directories.")
+    self._scan(initial=True)
+
+  def _scan(self, initial=False):
+    now = self._scanned = time.time()
+    seen = set()
+    for d in self.dirs:
+      with os.scandir(d) as it:
+        for e in it:
+          if not e.is_file():
+            continue
+          p = pathlib.Path(e.path)
+          seen.add(p)
+          st = e.stat()
+          key = (st.st_size, st.st_mtime_ns)
+          if self._known.get(p) == key:
+            continue
+          self._known[p] = key
+          self._failures.pop(p, None)
+          # Files already at rest at startup need not sit out the quarantine.
+          self.pending[p] = (st.st_size, st.st_mtime if initial else now)
+    for p in set(self._known) - seen:
+      del self._known[p]
+      self.pending.pop(p, None)
+      self._failures.pop(p, None)
+
+  def _event(self, p, mask):
+    if mask & (IN_DELETE | IN_MOVED_FROM):
+      self.pending.pop(p, None)
+      self._failures.pop(p, None)
+      return
+    try:
+      st = p.stat()
+    except FileNotFoundError:
+      self.pending.pop(p, None)
+      return
+    if self._known.get(p) != (key := (st.st_size, st.st_mtime_ns)):
+      self._failures.pop(p, None)
+    self._known[p] = key
+    self.pending[p] = (st.st_size, time.time())
+
+  def ripe(self):
+    """Return (and stop tracking) the pending files whose size has settled."""
+
+    now = time.time()
+    ready = []
+    for p, (size, since) in list(self.pending.items()):
+      if now - since < self.settle:
+        continue
+      try:
+        st = p.stat()
+      except FileNotFoundError:
+        del self.pending[p]
+        continue
+      if st.st_size != size:
+        self.pending[p] = (st.st_size, now)
+        continue
+      del self.pending[p]
+      # So that scans do not return the file again unless it changes.
+      self._known[p] = (st.st_size, st.st_mtime_ns)
+      if p.is_file():
+        ready.append(p)
+    return sorted(ready, key=lambda p: sortkey(p.name))
+
+  def requeue(self, paths):
+    """Return the files in paths (e.g., ones that failed to prepare) again once
+    they have settled anew, backing off on repeated failures."""
+
+    now = time.time()
+    for p in paths:
+      n = self._failures[p] = self._failures.get(p, 0) + 1
+      if n > self.retries:
+        log.warning(f"Giving up on {p} after {n - 1} retries, until it changes.")
+        continue
+      try:
+        # Settles for settle * 2**n seconds.
+        self.pending[p] = (p.stat().st_size, now + self.settle * ((1 << n) - 1))
+      except FileNotFoundError:
+        pass
+
+  def wait(self):
+    """Block until at least one source file is ready and return the ready ones."""
+
+    while True:
+      if ready := self.ripe():
+        return ready
+      # Events wake an inotify wait early.
+      timeout = self.interval if self.notify is None else self.rescan or 3600.0
+      if self.pending:
+        now = time.time()
+        timeout = min(
+          timeout, max(0.1, min(since + self.settle - now for _, since in self.pending.values()))
+        )
+      if self.notify is None:
+        time.sleep(timeout)
+        self._scan()
+        continue
+      for p, mask in self.notify.read(timeout):
+        if p is None:
+          self._scan()
+        else:
+          self._event(p, mask)
+      if self.rescan and time.time() - self._scanned >= self.rescan:
+        self._scan()
+
+
+class StageScheduler:
+  """Run interdependent stages on per-lane pools of worker threads.
+
+  Each stage names the stages it depends on and the lane (e.g., "cpu" or "io")
+  whose pool runs it.  A stage starts as soon as all its dependencies have
+  finished; a stage whose dependency raised is skipped.  Stages may be added
+  from within running stages.
+
+  With a budget, each stage also holds cost tokens (e.g., threads) while it
+  runs, and starts only once enough are free; stages that fit start ahead of
+  earlier ones that do not.  A ready stage added with reserve, though, holds
+  back the stages after it until enough tokens have freed up for it, so that
+  cheap stages cannot starve it.  Costs above the budget are capped at it."""
+
+  def __init__(self, lanes, budget=None):
+    self._pools = {
+      lane: ThreadPoolExecutor(max_workers=max(1, n), thread_name_prefix=lane)
+      for lane, n in lanes.items()
+    }
+    self._cond = threading.Condition()
+    self._waiting = {}
+    self._running = {}
+    self._done = {}
+    self.budget = budget
+    self._used = 0
+
+  def add(self, name, func, *args, deps=(), lane="cpu", cost=0, reserve=False):
+    """Add stage name running func(*args) after deps; return name."""
+
+    with self._cond:
+      if name in self._waiting or name in self._running or name in self._done:
+        return name
+      if lane not in self._pools:
+        raise ValueError(f"Unknown lane {lane} for stage {name}")
+      cost = min(cost, self.budget) if self.budget else 0
+      self._waiting[name] = (func, args, tuple(d for d in deps if d), lane, cost, reserve)
+      self._dispatch()
+    return name
+
+  def _dispatch(self):
+    # Must be called with self._cond held.
+    changed = True
+    while changed:
+      changed = False
+      reserved = 0
+      for name, (func, args, deps, lane, cost, reserve) in list(self._waiting.items()):
+        if any(d not in self._done for d in deps):
+          continue
+        if not all(self._done[d] for d in deps):
+          del self._waiting[name]
+          changed = True
+          log.debug(f"Skipping stage {name} because a dependency failed.")
+          self._done[name] = False
+          continue
+        if cost and self._used + reserved + cost > self.budget:
+          if reserve:
+            reserved += cost
+          continue
+        del self._waiting[name]
+        changed = True
+        self._used += cost
+        self._running[name] = cost
+        self._pools[lane].submit(self._run, name, func, args)
+
+  def _run(self, name, func, args):
+    ok = True
+    try:
+      func(*args)
+    except Exception:
+      log.exception(f"Stage {name} failed.")
+      ok = False
+    with self._cond:
+      self._used -= self._running.pop(name)
+      self._done[name] = ok
+      self._dispatch()
+      self._cond.notify_all()
+
+  def run(self):
+    """Block until all stages have finished, then shut down the pools."""
+
+    with self._cond:
+      while self._waiting or self._running:
+        if not self._running:
+          for name, (_, _, deps, *_) in self._waiting.items():
+            log.error(f"Stage {name} depends on unknown stages {deps}.")
+            self._done[name] = False
+          self._waiting.clear()
+          break
+        self._cond.wait()
+    for pool in self._pools.values():
+      pool.shutdown(wait=True)
+    return all(self._done.values())
+
+
+class WorkLock:
+  """An advisory lock on the work that makes a file.
+
+  The lockfile next to the file holds its owner's pid, host, and a heartbeat
+  that a background thread renews while the lock is held.  Where flock is
+  available, the kernel releases the lock when its owner dies, so a lock
+  that can be taken over belonged to a dead process; locks held by other
+  hosts (or anywhere without flock) count as dead once their heartbeat is
+  older than stale seconds."""
+
+  heartbeat_interval = 30.0
+  stale = 120.0
+
+  _held = set()
+  _held_lock = threading.Lock()
+  _thread = None
+
+  def __init__(self, file):
+    self.file = pathlib.Path(file)
+    self.path = self.file.with_suffix(f"{self.file.suffix}.working")
+    self.fd = None
+    self.recovered = None
+
+  @staticmethod
+  def _info(fd):
+    try:
+      os.lseek(fd, 0, os.SEEK_SET)
+      return json.loads(os.read(fd, 4096) or b"null")
+    except (OSError, ValueError):
+      return None
+
+  @classmethod
+  def _alive(cls, info):
+    """Check whether the owner described by info has a fresh heartbeat."""
+
+    return isinstance(info, dict) and time.time() - info.get("heartbeat", 0.0) < cls.stale
+
+  @classmethod
+  def _foreign(cls, info):
+    return isinstance(info, dict) and info.get("host") != socket.gethostname() and cls._alive(info)
+
+  def owner(self):
+    try:
+      with open(self.path, "rt", encoding="utf-8") as f:
+        info = json.load(f)
+      return f'pid {info["pid"]} on {info["host"]}'
+    except (OSError, ValueError, KeyError, TypeError):
+      return "another process"
+
+  def _open(self):
+    """Open and lock the lockfile; return (fd, previous owner info) or None if held."""
+
+    if fcntl is None:
+      for _ in range(2):
+        try:
+          return os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL), None
+        except FileExistsError:
+          try:
+            fd = os.open(self.path, os.O_RDONLY)
+          except FileNotFoundError:
+            continue
+          info = self._info(fd)
+          os.close(fd)
+          if self._alive(info):
+            return None
+          try:
+            self.path.unlink()
+          except FileNotFoundError:
+            pass
+          self.recovered = info
+      return None
+
+    while True:
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        os.close(fd)
+        return None
+      # The previous owner may have unlinked the lockfile before we locked it.
+      try:
+        if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+          break
+      except FileNotFoundError:
+        pass
+      os.close(fd)
+    info = self._info(fd)
+    # flock does not reliably exclude processes on other hosts of a network filesystem.
+    if self._foreign(info):
+      os.close(fd)
+      return None
+    return fd, info
+
+  def acquire(self):
+    """Take the lock; return False if a live process holds it.
+
+    If the previous owner died, its owner info is left in self.recovered."""
+
+    if (r := self._open()) is None:
+      return False
+    self.fd, info = r
+    if info is not None:
+      self.recovered = info
+    self.heartbeat()
+    with WorkLock._held_lock:
+      WorkLock._held.add(self)
+      if WorkLock._thread is None:
+        WorkLock._thread = threading.Thread(target=WorkLock._beat, daemon=True)
+        WorkLock._thread.start()
+    return True
+
+  def heartbeat(self):
+    d = json.dumps({"pid": os.getpid(), "host": socket.gethostname(), "heartbeat": time.time()})
+    os.ftruncate(self.fd, 0)
+    os.lseek(self.fd, 0, os.SEEK_SET)
+    os.write(self.fd, d.encode())
+
+  @classmethod
+  def _beat(cls):
+    while True:
+      time.sleep(cls.heartbeat_interval)
+      with cls._held_lock:
+        for lock in list(cls._held):
+          try:
+            lock.heartbeat()
+          except OSError as e:
+            log.warning(f"Heartbeat for {lock.path} failed: {e}")
+
+  def release(self):
+    if self.fd is None:
+      return
+    with WorkLock._held_lock:
+      WorkLock._held.discard(self)
+    if fcntl is None:
+      # Open files cannot be unlinked everywhere.
+      os.close(self.fd)
+    # Otherwise, unlink while still locked so that no one else locks the doomed file.
+    try:
+      self.path.unlink()
+    except FileNotFoundError:
+      pass
+    if fcntl is not None:
+      os.close(self.fd)
+    self.fd = None
+
+  def __enter__(self):
+    return self.acquire()
+
+  def __exit__(self, *exc):
+    self.release()
+
+  @classmethod
+  def locked(cls, file):
+    """Check whether a live process holds the lock on the work making file."""
+
+    lock = cls(file)
+    if not lock.path.exists():
+      return False
+    try:
+      fd = os.open(lock.path, os.O_RDONLY)
+    except FileNotFoundError:
+      return False
+    try:
+      info = cls._info(fd)
+      if fcntl is None:
+        return cls._alive(info)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return True
+      return cls._foreign(info)
+    finally:
+      os.close(fd)
 
 
 def sleep_inhibit():
@@ -325,7 +811,7 @@ class defdict(dict):
       return True
 
     # Note: generator, not list, to enable short-circuiting
-    m = any(s.modified() for s in self.values() if isinstance(s, defdict))
+    m = any(s.modified() for s in list(self.values()) if isinstance(s, defdict))
     return m
 
   def modclear(self):
@@ -333,7 +819,7 @@ class defdict(dict):
     and clear modification status."""
 
     # Note: list, not generator, to prevent short-circuiting
-    m = any([s.modclear() for s in self.values() if isinstance(s, defdict)])
+    m = any([s.modclear() for s in list(self.values()) if isinstance(s, defdict)])
     m = m or self._modified
     self._modified = False
     return m
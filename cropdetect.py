@@ -0,0 +1,117 @@
+# Detection of the black borders of a video from sampled frames
+
+import logging
+import re
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+# The sizes of a chroma plane of a w by h picture, by the YUV4MPEG2 colourspace.
+chroma_sizes = {
+  "420": lambda w, h: ((w + 1) // 2, (h + 1) // 2),
+  "422": lambda w, h: ((w + 1) // 2, h),
+  "411": lambda w, h: ((w + 3) // 4, h),
+  "444": lambda w, h: (w, h),
+  "mono": lambda w, h: (0, 0),
+}
+
+
+class CropDetector:
+  """Find the black borders of the frames of a YUV4MPEG2 stream fed in chunks.
+
+  A row or column of a frame's luma is black if its mean is at most threshold
+  (on an 8-bit scale).  Frames with less than a quarter of their width or
+  height left (e.g., black or title frames) tell nothing and are ignored.
+  Feeding an empty chunk ends the stream."""
+
+  def __init__(self, threshold=30):
+    self.threshold = threshold
+    self.width = None
+    self.height = None
+    self.boxes = []
+    self.done = False
+    self._buf = bytearray()
+
+  def __call__(self, data):
+    if not data:
+      if self.width is None:
+        raise ValueError("YUV4MPEG2 stream ended before its header")
+      self.done = True
+      return
+    self._buf += data
+    if self.width is None and not self._parse_header():
+      return
+    while self._frame():
+      pass
+
+  def _parse_header(self):
+    i = self._buf.find(b"\n")
+    if i < 0:
+      if len(self._buf) > 4096:
+        raise ValueError("No YUV4MPEG2 header")
+      return False
+    fields = bytes(self._buf[:i]).decode("ascii", errors="replace").split()
+    if not fields or fields[0] != "YUV4MPEG2":
+      raise ValueError("Not a YUV4MPEG2 stream")
+    tags = {f[0]: f[1:] for f in fields[1:]}
+    w, h = int(tags["W"]), int(tags["H"])
+    c = tags.get("C", "420jpeg")
+    depth = int(m[1]) if (m := re.search(r"p(\d+)$", c)) else 16 if c == "mono16" else 8
+    space = "mono" if c.startswith("mono") else c[:3]
+    if space not in chroma_sizes:
+      raise ValueError(f"Unsupported YUV4MPEG2 colourspace {c}")
+    cw, ch = chroma_sizes[space](w, h)
+    self._dtype = np.uint8 if depth == 8 else np.dtype("<u2")
+    self._scale = float(1 << (depth - 8))
+    self._luma = w * h * (1 if depth == 8 else 2)
+    self._size = self._luma + 2 * cw * ch * (1 if depth == 8 else 2)
+    self.width, self.height = w, h
+    del self._buf[: i + 1]
+    return True
+
+  def _frame(self):
+    i = self._buf.find(b"\n")
+    if i < 0 or len(self._buf) < i + 1 + self._size:
+      return False
+    if not self._buf.startswith(b"FRAME"):
+      raise ValueError("Lost YUV4MPEG2 frame sync")
+    luma = bytes(self._buf[i + 1 : i + 1 + self._luma])
+    del self._buf[: i + 1 + self._size]
+    y = np.frombuffer(luma, dtype=self._dtype).reshape(self.height, self.width)
+    self.boxes.append(self._borders(y))
+    return True
+
+  def _borders(self, y):
+    """Return the (left, right, top, bottom) black borders of luma plane y, or None."""
+
+    thr = self.threshold * self._scale
+    rows = np.flatnonzero(y.mean(axis=1, dtype=np.float32) > thr)
+    cols = np.flatnonzero(y.mean(axis=0, dtype=np.float32) > thr)
+    if len(rows) * 4 < self.height or len(cols) * 4 < self.width:
+      return None
+    return (
+      int(cols[0]),
+      self.width - 1 - int(cols[-1]),
+      int(rows[0]),
+      self.height - 1 - int(rows[-1]),
+    )
+
+  def result(self, tolerance=0.03, share=0.2):
+    """Return the even (left, right, top, bottom) crop that keeps the picture of
+    every frame, and whether the aspect ratio of the picture varies, i.e.,
+    differs by more than tolerance from the median in more than share of the
+    frames; or None if no frame told anything."""
+
+    boxes = np.array([b for b in self.boxes if b is not None])
+    if not self.done or len(boxes) == 0:
+      return None
+    crop = tuple(int(v) - int(v) % 2 for v in boxes.min(axis=0))
+    ar = (self.width - boxes[:, 0] - boxes[:, 1]) / (self.height - boxes[:, 2] - boxes[:, 3])
+    varies = bool(np.mean(np.abs(ar / np.median(ar) - 1.0) > tolerance) > share)
+    return crop, varies
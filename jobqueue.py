@@ -0,0 +1,248 @@
+# A job queue shared by makemp4 processes on several hosts
+
+import http.server
+import json
+import logging
+import os
+import pathlib
+import socket
+import threading
+import time
+import urllib.request
+import uuid
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+
+def worker_name():
+  return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class FileJobQueue:
+  """A job queue in a directory on a filesystem shared by all workers.
+
+  Jobs move from pending/ to claimed/ by an atomic rename.  A claimed job
+  carries a lease that its worker must renew by heartbeats; a job whose lease
+  has expired is returned to pending/ for another worker.  Results are left in
+  done/ until the submitter collects them."""
+
+  def __init__(self, root, lease=300.0):
+    self.root = pathlib.Path(root).resolve()
+    self.lease = lease
+    for d in ("pending", "claimed", "done"):
+      (self.root / d).mkdir(parents=True, exist_ok=True)
+
+  def _write(self, path, d):
+    tmp = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    with open(tmp, "wt", encoding="utf-8") as fp:
+      json.dump(d, fp)
+    tmp.replace(path)
+
+  def submit(self, job):
+    jid = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    self._write(self.root / "pending" / f"{jid}.json", job)
+    return jid
+
+  def claim(self, worker):
+    """Claim the oldest pending job; return (id, job) or None."""
+
+    self.reap()
+    for f in sorted((self.root / "pending").glob("*.json")):
+      claimed = self.root / "claimed" / f.name
+      try:
+        f.rename(claimed)
+      except FileNotFoundError:
+        continue  # Another worker was faster.
+      self.heartbeat(f.stem, worker)
+      with open(claimed, "rt", encoding="utf-8") as fp:
+        return f.stem, json.load(fp)
+    return None
+
+  def heartbeat(self, jid, worker):
+    """Renew worker's lease on job jid; return False if the job is no longer worker's."""
+
+    lease = self.root / "claimed" / f"{jid}.lease"
+    try:
+      with open(lease, "rt", encoding="utf-8") as fp:
+        if json.load(fp).get("worker") != worker:
+          return False
+    except (FileNotFoundError, json.JSONDecodeError):
+      pass
+    if not (self.root / "claimed" / f"{jid}.json").exists():
+      return False
+    self._write(lease, {"worker": worker, "expires": time.time() + self.lease})
+    return True
+
+  def complete(self, jid, result):
+    self._write(self.root / "done" / f"{jid}.json", result)
+    for suf in (".json", ".lease"):
+      try:
+        (self.root / "claimed" / f"{jid}{suf}").unlink()
+      except FileNotFoundError:
+        pass
+
+  def result(self, jid):
+    """Return and remove the result of job jid, or None if it is not done yet."""
+
+    f = self.root / "done" / f"{jid}.json"
+    try:
+      with open(f, "rt", encoding="utf-8") as fp:
+        r = json.load(fp)
+    except FileNotFoundError:
+      return None
+    f.unlink()
+    return r
+
+  def reap(self):
+    """Return claimed jobs whose lease has expired to pending/."""
+
+    now = time.time()
+    for f in (self.root / "claimed").glob("*.json"):
+      lease = f.with_suffix(".lease")
+      try:
+        with open(lease, "rt", encoding="utf-8") as fp:
+          expires = json.load(fp)["expires"]
+      except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        # Claimed but never leased: give the claimer one lease period.
+        try:
+          expires = f.stat().st_mtime + self.lease
+        except FileNotFoundError:
+          continue
+      if expires > now:
+        continue
+      log.warning(f"Lease on job {f.stem} expired, returning it to the queue.")
+      try:
+        f.rename(self.root / "pending" / f.name)
+        lease.unlink()
+      except FileNotFoundError:
+        pass
+
+
+class RemoteJobQueue:
+  """The FileJobQueue interface, spoken over HTTP to a QueueServer."""
+
+  def __init__(self, url):
+    self.url = url.rstrip("/")
+
+  def _post(self, op, d):
+    req = urllib.request.Request(
+      f"{self.url}/{op}",
+      data=json.dumps(d).encode(),
+      headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=60) as r:
+      return json.load(r)
+
+  def submit(self, job):
+    return self._post("submit", {"job": job})["id"]
+
+  def claim(self, worker):
+    r = self._post("claim", {"worker": worker})
+    return (r["id"], r["job"]) if r else None
+
+  def heartbeat(self, jid, worker):
+    return self._post("heartbeat", {"id": jid, "worker": worker})
+
+  def complete(self, jid, result):
+    self._post("complete", {"id": jid, "result": result})
+
+  def result(self, jid):
+    return self._post("result", {"id": jid})
+
+  def reap(self):
+    self._post("reap", {})
+
+
+class QueueServer(http.server.ThreadingHTTPServer):
+  """Serve a FileJobQueue to RemoteJobQueues over HTTP."""
+
+  daemon_threads = True
+
+  def __init__(self, queue, address):
+    super().__init__(address, QueueHandler)
+    self.queue = queue
+
+
+class QueueHandler(http.server.BaseHTTPRequestHandler):
+  def do_POST(self):
+    q = self.server.queue
+    try:
+      d = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+      op = self.path.strip("/")
+      if op == "submit":
+        r = {"id": q.submit(d["job"])}
+      elif op == "claim":
+        c = q.claim(d["worker"])
+        r = {"id": c[0], "job": c[1]} if c else None
+      elif op == "heartbeat":
+        r = q.heartbeat(d["id"], d["worker"])
+      elif op == "complete":
+        r = q.complete(d["id"], d["result"])
+      elif op == "result":
+        r = q.result(d["id"])
+      elif op == "reap":
+        r = q.reap()
+      else:
+        self.send_error(404)
+        return
+    except (ValueError, KeyError, TypeError) as e:
+      self.send_error(400, str(e))
+      return
+    body = json.dumps(r).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    log.debug("Queue server: " + format % args)
+
+
+def open_queue(spec, lease=300.0):
+  """Open the queue at spec, either a shared directory or a QueueServer URL."""
+
+  if spec.startswith(("http://", "https://")):
+    return RemoteJobQueue(spec)
+  return FileJobQueue(spec, lease)
+
+
+class Heartbeat:
+  """Renew the lease on a claimed job from a background thread.
+
+  Once the lease is lost, lost is set and renewals stop."""
+
+  def __init__(self, queue, jid, worker, interval):
+    self.lost = threading.Event()
+    self._stop = threading.Event()
+    self._queue, self._jid, self._worker = queue, jid, worker
+    self._thread = threading.Thread(
+      target=self._run, args=(queue, jid, worker, interval), daemon=True
+    )
+
+  def _run(self, queue, jid, worker, interval):
+    while not self._stop.wait(interval):
+      try:
+        if not queue.heartbeat(jid, worker):
+          log.warning(f"Lost the lease on job {jid}.")
+          self.lost.set()
+          return
+      except OSError as e:
+        log.warning(f"Heartbeat for job {jid} failed: {e}")
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self._stop.set()
+    self._thread.join()
+    # A lease that expired without a renewal noticing is lost all the same.
+    try:
+      if not self.lost.is_set() and not self._queue.heartbeat(self._jid, self._worker):
+        log.warning(f"Lost the lease on job {self._jid}.")
+        self.lost.set()
+    except OSError as e:
+      log.warning(f"Heartbeat for job {self._jid} failed: {e}")
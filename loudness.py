@@ -0,0 +1,241 @@
+# EBU R128 loudness, loudness range, and true peak of a WAV stream
+
+import logging
+import math
+import struct
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+# The K-weighting pre-filter (high shelf) and RLB high-pass of ITU-R BS.1770,
+# as biquads at 48 kHz.
+k_filters = (
+  ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+  ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def k_weights(n, rate):
+  """Return the squared magnitude of the K-weighting at the rfft bins of n samples."""
+
+  f = np.minimum(np.fft.rfftfreq(n, 1.0 / rate), 23999.0)
+  z = np.exp(-2j * np.pi * f / 48000.0)
+  h = np.ones_like(z)
+  for b, a in k_filters:
+    h *= (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+  return np.abs(h) ** 2
+
+
+def channel_weights(channels):
+  """Return the BS.1770 weights of the channels of a WAV, in WAVE order (L, R, C, LFE, surrounds)."""
+
+  if channels in (6, 8):
+    return np.array([1.0, 1.0, 1.0, 0.0] + [1.41] * (channels - 4))
+  return np.array([1.0] * min(channels, 3) + [1.41] * (channels - 3))
+
+
+def lufs(energy):
+  return -0.691 + 10.0 * math.log10(energy) if energy > 0.0 else -math.inf
+
+
+class LoudnessMeter:
+  """Measure a WAV stream fed in chunks of any size.
+
+  Each 100 ms segment is weighted in the frequency domain, giving the energies
+  from which the gated 400 ms blocks (integrated loudness) and 3 s windows
+  (loudness range) are summed.  True peak is the peak of the signal
+  oversampled four times by FFT.  Feeding an empty chunk ends the stream."""
+
+  oversample = 4
+  pad = 64  # Samples of context on each side of an oversampled run.
+
+  def __init__(self):
+    self._head = b""
+    self._rest = b""
+    self.rate = None
+    self.channels = None
+    self._dtype = None
+    self._width = None
+    self._frames = None
+    self._energies = []
+    self._sample_peak = 0.0
+    self._true_peak = 0.0
+    self.done = False
+
+  def __call__(self, data):
+    if not data:
+      self._finish()
+    elif self.rate is None:
+      self._head += data
+      self._parse_header()
+    else:
+      self._feed(data)
+
+  def _parse_header(self):
+    h = self._head
+    if len(h) < 12:
+      return
+    if h[:4] not in (b"RIFF", b"RF64") or h[8:12] != b"WAVE":
+      raise ValueError("Not a WAV stream")
+    pos = 12
+    fmt = None
+    while pos + 8 <= len(h):
+      cid, size = h[pos : pos + 4], struct.unpack("<I", h[pos + 4 : pos + 8])[0]
+      if cid == b"data":
+        if fmt is None:
+          raise ValueError("WAV data before its format")
+        self._start(fmt)
+        self._head = b""
+        self._feed(h[pos + 8 :])
+        return
+      if pos + 8 + size > len(h):
+        return  # Wait for the rest of the chunk.
+      if cid == b"fmt ":
+        fmt = h[pos + 8 : pos + 8 + size]
+      pos += 8 + size + (size & 1)
+    if len(h) > 1 << 20:
+      raise ValueError("No data in the first MB of the WAV stream")
+
+  def _start(self, fmt):
+    tag, channels, rate, _, align, bits = struct.unpack("<HHIIHH", fmt[:16])
+    if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+      tag = struct.unpack("<H", fmt[24:26])[0]
+    if tag == WAVE_FORMAT_PCM and bits in (16, 24, 32):
+      self._dtype = {16: "<i2", 24: None, 32: "<i4"}[bits]
+    elif tag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+      self._dtype = {32: "<f4", 64: "<f8"}[bits]
+    else:
+      raise ValueError(f"Unsupported WAV format {tag} with {bits} bits")
+    self.rate, self.channels = rate, channels
+    self._bits, self._float, self._width = bits, tag == WAVE_FORMAT_IEEE_FLOAT, align
+    self._seg = max(1, rate // 10)
+    self._kw = k_weights(self._seg, rate)
+    # Parseval: the mean square of a segment from its one-sided spectrum.
+    self._kw[1 : (self._seg + 1) // 2] *= 2.0
+    self._kw /= self._seg * self._seg
+    self._gains = channel_weights(channels)
+    self._frames = self._silence()
+
+  def _silence(self):
+    return np.zeros((self.pad, self.channels), dtype=np.float32)
+
+  def _samples(self, data):
+    if self._dtype is None:
+      b = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+      x = (b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) << 8 >> 8
+    else:
+      x = np.frombuffer(data, dtype=self._dtype)
+    x = x.astype(np.float32)
+    if not self._float:
+      x /= float(1 << (self._bits - 1))
+    return x.reshape(-1, self.channels)
+
+  def _feed(self, data):
+    data = self._rest + data
+    n = len(data) - len(data) % self._width
+    self._rest = data[n:]
+    if n:
+      self._frames = np.concatenate((self._frames, self._samples(data[:n])))
+    # Keep pad frames of context behind and ahead of the segments measured.
+    k = (len(self._frames) - 2 * self.pad) // self._seg
+    if k > 0:
+      self._measure(k)
+
+  def _measure(self, k):
+    p, n = self.pad, k * self._seg
+    x = self._frames[p : p + n]
+    segs = x.reshape(k, self._seg, self.channels)
+    z = (np.abs(np.fft.rfft(segs, axis=1)) ** 2 * self._kw[None, :, None]).sum(axis=1)
+    self._energies.extend((z @ self._gains).tolist())
+    self._peaks(self._frames[: n + 2 * p])
+    self._frames = self._frames[n:]
+
+  def _peaks(self, x):
+    """Add the peaks of x but its first and last pad frames, which give context."""
+
+    p, o = self.pad, self.oversample
+    if len(x) <= 2 * p:
+      return
+    self._sample_peak = max(self._sample_peak, float(np.abs(x[p:-p]).max()))
+    run = 8192 - 2 * p  # Oversample runs of a power of two, FFTs' best size.
+    for s in range(p, len(x) - p, run):
+      b = x[s - p : min(s + run, len(x) - p) + p]
+      # Real audio does not overshoot its samples by 6 dB between them.
+      if 2.0 * float(np.abs(b).max()) <= self._true_peak:
+        continue
+      y = np.fft.irfft(np.fft.rfft(b, axis=0), n=o * len(b), axis=0) * o
+      self._true_peak = max(self._true_peak, float(np.abs(y[o * p : -o * p]).max()))
+
+  def _finish(self):
+    if self.rate is None:
+      raise ValueError("WAV stream ended before its data")
+    # Pad with silence so that the last frames get their peaks measured.
+    self._frames = np.concatenate((self._frames, self._silence()))
+    k = (len(self._frames) - 2 * self.pad) // self._seg
+    if k > 0:
+      self._measure(k)
+    self._peaks(np.concatenate((self._frames, self._silence())))
+    self.done = True
+
+  def result(self):
+    """Return the integrated loudness (LUFS), loudness range (LU), true and sample peaks (dBFS)."""
+
+    if not self.done:
+      return None
+    e = np.array(self._energies)
+    if len(e) >= 4:
+      c = np.concatenate(([0.0], np.cumsum(e)))
+      blocks = (c[4:] - c[:-4]) / 4.0
+    else:
+      blocks = np.zeros(0)
+    blocks = blocks[blocks > 10.0 ** ((-70.0 + 0.691) / 10.0)]
+    integrated = None
+    if len(blocks):
+      rel = lufs(blocks.mean()) - 10.0
+      gated = blocks[blocks > 10.0 ** ((rel + 0.691) / 10.0)]
+      integrated = lufs(gated.mean())
+    lra = None
+    if len(e) >= 30:
+      c = np.concatenate(([0.0], np.cumsum(e)))
+      short = (c[30:] - c[:-30]) / 30.0
+      short = short[short > 10.0 ** ((-70.0 + 0.691) / 10.0)]
+      if len(short):
+        rel = lufs(short.mean()) - 20.0
+        short = short[short > 10.0 ** ((rel + 0.691) / 10.0)]
+        lo, hi = np.percentile(-0.691 + 10.0 * np.log10(short), [10.0, 95.0])
+        lra = float(hi - lo)
+
+    def db(v):
+      return round(20.0 * math.log10(v), 2) if v > 0.0 else None
+
+    return {
+      "integrated": round(integrated, 2) if integrated is not None else None,
+      "lra": round(lra, 2) if lra is not None else None,
+      "true_peak": db(self._true_peak),
+      "sample_peak": db(self._sample_peak),
+    }
+
+
+def normalization_gain(loud, target=None, true_peak=None):
+  """Return the gain in dB that raises loud's sample peak to 0 dBFS (as eac3to
+  -normalize does) or, given true_peak, its true peak to true_peak dBTP; with a
+  target, the gain is at most what brings its integrated loudness to target
+  LUFS."""
+
+  peak = None if not loud else loud.get("sample_peak" if true_peak is None else "true_peak")
+  if peak is None:
+    return 0.0
+  gain = (true_peak or 0.0) - peak
+  if target is not None and loud.get("integrated") is not None:
+    gain = min(gain, target - loud["integrated"])
+  return round(gain, 2)
@@ -10,6 +10,8 @@ then recombine all tracks into properly tagged .mp4 or .mkv
 """
 
 import argparse
+import asyncio
+import bisect
 import json
 import logging
 import math
@@ -20,6 +22,7 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import xml.etree.ElementTree as ET
 import yaml
@@ -31,12 +34,25 @@ except ImportError:
   from yaml import Loader, Dumper
 
 from cetools import *  # pylint: disable=unused-wildcard-import
+from artifacts import *  # pylint: disable=unused-wildcard-import
+from cropdetect import *  # pylint: disable=unused-wildcard-import
+from jobqueue import *  # pylint: disable=unused-wildcard-import
+from loudness import *  # pylint: disable=unused-wildcard-import
+from mkvprobe import *  # pylint: disable=unused-wildcard-import
+from progress import *  # pylint: disable=unused-wildcard-import
+from subtitles import *  # pylint: disable=unused-wildcard-import
+from timecodes import *  # pylint: disable=unused-wildcard-import
 from tagmp4 import *  # pylint: disable=unused-wildcard-import
+from titlemodel import *  # pylint: disable=unused-wildcard-import
 
 parser = None
 args = None
 log = logging.getLogger()
 progmodtime = None
+board = ProgressBoard(enabled=False)
+artifacts = None
+probe_cache = None
+jobs = None
 
 iso6392BtoT = {
   "alb": "sqi",
@@ -79,17 +95,23 @@ yaml_exts = set(["yaml", "yml"])
 def cfgload(fn):
   with open(fn, "r", encoding="utf-8") as f:
     if fn.suffix[1:] in yaml_exts:
-      return yaml.load(f)
+      d = yaml.load(f, Loader=Loader)
     elif fn.suffix[1:] in json_exts:
-      return json.load(f, object_hook=defdict)
+      d = json.load(f)
     else:
       log.error(f"{fn} is not a config file, skipping.")
+      return None
+  if not isinstance(d, dict):
+    raise TypeError(f"{fn} does not contain a mapping")
+  return Title.from_dict(d)
 
 
 def cfgdump(cfg, fn):
+  if isinstance(cfg, Record):
+    cfg = cfg.to_dict()
   with open(fn, "w", encoding="utf-8") as f:
     if fn.suffix[1:] in yaml_exts:
-      yaml.dump(cfg, f, indent=2, allow_unicode=True, encoding="utf-8")
+      yaml.dump(cfg, f, Dumper=Dumper, indent=2, allow_unicode=True)
     elif fn.suffix[1:] in json_exts:
       json.dump(
         cfg, f, ensure_ascii=False, indent=2, sort_keys=True, cls=DefDictEncoder
@@ -98,59 +120,120 @@ def cfgdump(cfg, fn):
       log.error(f"{fn} is not a config file, skipping.")
 
 
-def syncconfig(cfg):
-  if cfg.modclear():
-    cfgdump(cfg, cfg["cfgname"])
-
-
-def serveconfig(fn):
+def loadconfig(fn):
   try:
-    j = cfgload(fn)
-    yield j
-    syncconfig(j)
+    return cfgload(fn)
   except yaml.YAMLError:
     log.error(f"{fn} is not a YAML config file, skipping.")
   except json.JSONDecodeError:
     log.error(f"{fn} is not a JSON config file, skipping.")
   except TypeError:
     log.error(f"Type Error in {fn}, skipping.")
+  return None
+
+
+class ConfigCache:
+  """A process-wide cache of loaded configs.
+
+  Configs are keyed by path and revalidated against the file's (st_mtime_ns,
+  st_size), so unchanged files are parsed only once and every caller shares
+  the same config object.  Only configs whose modclear() reports changes are
+  written back."""
+
+  def __init__(self):
+    self._cfgs = {}
+    self._lock = threading.RLock()
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def _stamp(fn):
+    st = fn.stat()
+    return (st.st_mtime_ns, st.st_size)
+
+  def get(self, fn):
+    fn = pathlib.Path(fn)
+    with self._lock:
+      try:
+        stamp = self._stamp(fn)
+      except FileNotFoundError:
+        self._cfgs.pop(fn, None)
+        return None
+      if (e := self._cfgs.get(fn)) and e[0] == stamp:
+        self.hits += 1
+        return e[1]
+      self.misses += 1
+      cfg = loadconfig(fn)
+      if cfg is None:
+        self._cfgs.pop(fn, None)
+      else:
+        self._cfgs[fn] = (stamp, cfg)
+      return cfg
+
+  def sync(self, cfg):
+    # Stages of one title run concurrently, so only one of them may write at a
+    # time, and the others must not change the title between the snapshot and
+    # the clearing of its modifications.
+    with self._lock:
+      with cfg.lock:
+        if not cfg.modclear():
+          return False
+        d = cfg.to_dict()
+      fn = args.outdir / cfg["cfgname"]
+      cfgdump(d, fn)
+      self._cfgs[fn] = (self._stamp(fn), cfg)
+      return True
 
+  def forget(self, fn):
+    with self._lock:
+      self._cfgs.pop(pathlib.Path(fn), None)
 
-def configs(path=None):
+
+config_cache = ConfigCache()
+
+
+def syncconfig(cfg):
+  config_cache.sync(cfg)
+
+
+def serveconfig(fn):
+  j = config_cache.get(fn)
+  if j is None:
+    return
+  yield j
+  syncconfig(j)
+
+
+def config_files(path=None):
   if path is None:
     path = args.outdir
-  for e in json_exts | yaml_exts:
-    for fn in path.glob(f"*.{e}"):
-      yield from serveconfig(fn)
+  exts = json_exts | yaml_exts
+  with os.scandir(path) as it:
+    for e in it:
+      if e.name.rpartition(".")[2] in exts and e.is_file():
+        yield pathlib.Path(e.path)
+
+
+def configs(path=None):
+  for fn in config_files(path):
+    yield from serveconfig(fn)
 
 
 def maketrack(cfg, tid=None):
-  track = defdict()
   if not isinstance(tid, int):
-    for tid in range(sys.maxsize):
-      n = f"track{tid:02d}"
-      if n not in cfg:
-        track["id"] = tid
-        cfg[n] = track
-        return track
+    tid = max((t.id for t in cfg.tracks), default=-1) + 1
+  return cfg.add_track(Track(id=tid))
 
 
 def tracks(cfg, typ=None):
-  if not isinstance(cfg, dict):
+  if not isinstance(cfg, Title):
     return
-  for k in list(cfg):
-    if not re.fullmatch(r"track\d+", k):
+  for track in list(cfg.tracks):
+    if track.disable:
       continue
-    track = cfg[k]
-    if track["disable"]:
+    if typ and track.type != typ:
       continue
-    if typ and track["type"] != typ:
-      continue
-    if (
-      "language" in track
-      and "languages" in cfg
-      and track["language"] not in cfg("languages")
-    ):
+    if track.language and cfg.languages and track.language not in cfg.languages:
       continue
     yield track
 
@@ -163,13 +246,12 @@ def readytomake(file, *comps):
       return False
     if f.stat().st_size == 0:
       return False
-
-    fd = os.open(f, os.O_RDONLY | os.O_EXCL)
-    if fd < 0:
+    if WorkLock.locked(f):
       return False
-    os.close(fd)
   if file is None:
     return True
+  if WorkLock.locked(file):
+    return False
   if not file.exists():
     return True
   if file.stat().st_size == 0:
@@ -185,22 +267,31 @@ def readytomake(file, *comps):
 
 
 def work_lock_delete():
+  """Delete the partial outputs of work whose owner has died."""
+
   for l in args.outdir.glob("*.working"):
-    log.debug(f"Deleting worklock {l} and associated file.")
-    l.unlink()
-    try:
-      l.with_suffix("").unlink()
-    except FileNotFoundError:
-      pass
+    lock = WorkLock(l.with_suffix(""))
+    if not lock.acquire():
+      log.debug(f"Worklock {l} is held by {lock.owner()}.")
+      continue
+    # A lock without a previous owner was made afresh: its owner finished and
+    # removed it after the glob, leaving a complete file.
+    if lock.recovered:
+      log.debug(f"Deleting dead worklock {l} and associated file.")
+      lock.file.unlink(missing_ok=True)
+    lock.release()
 
 
-def do_call(cargs, outfile=None, infile=None):
-  def cookout(s):
-    s = re.sub(r"\s*\n\s*", r"\n", s)
-    s = re.sub(r"[^\n]*", r"", s)
-    s = re.sub(r"\n+", r"\n", s)
-    s = re.sub(r"\n \*(.*?) \*", r"\n\1", s)
-    return s.strip()
+def cookout(s):
+  s = re.sub(r"\s*\n\s*", r"\n", s)
+  s = re.sub(r"[^\n]*\r", r"", s)
+  s = re.sub(r"\n+", r"\n", s)
+  s = re.sub(r"\n \*(.*?) \*", r"\n\1", s)
+  return s.strip()
+
+
+def split_pipeline(cargs):
+  """Split an argument list at "|" into the commands of a pipeline."""
 
   cs = [[]]
   for a in cargs:
@@ -208,57 +299,255 @@ def do_call(cargs, outfile=None, infile=None):
       cs.append([])
     else:
       cs[-1].append(str(a))
+  return cs
+
+
+async def spawn_pipeline(cs, infile=None, stdout=asyncio.subprocess.PIPE):
+  """Start the commands cs connected by pipes; return the list of processes.
+
+  Every process's stderr, and the last process's stdout, are pipes that the
+  caller must drain."""
+
+  ps = []
+  stdin = infile
+  try:
+    for i, c in enumerate(cs):
+      if i < len(cs) - 1:
+        r, w = os.pipe()
+      else:
+        r, w = None, stdout
+      try:
+        ps.append(
+          await asyncio.create_subprocess_exec(
+            *c, stdin=stdin, stdout=w, stderr=asyncio.subprocess.PIPE
+          )
+        )
+      finally:
+        if r is not None:
+          os.close(w)
+        if i > 0:
+          os.close(stdin)
+      stdin = r
+  except BaseException:
+    if stdin is not None and stdin is not infile:
+      os.close(stdin)
+    for p in ps:
+      if p.returncode is None:
+        p.kill()
+    raise
+  return ps
+
+
+async def drain(stream, job, tool):
+  """Read a tool's output stream to its end, reporting progress lines to the
+  board and keeping only the last other lines."""
+
+  buf = RingBuffer(args.log_lines)
+  sp = LineSplitter()
+  while True:
+    data = await stream.read(65536)
+    for line in sp.feed(data):
+      if (e := parse_progress(job, tool, line)) is not None:
+        board.update(e)
+      elif line.strip():
+        buf.append(line)
+    if not data:
+      break
+  if buf.dropped:
+    log.debug(f"{job}: dropped {buf.dropped} lines of {tool} output.")
+  return buf.text()
+
+
+async def do_call_async(cargs, outfile=None, infile=None):
+  """Run pipeline cargs, making outfile under its work lock; return its output,
+  or None if another process is making outfile."""
+
+  cs = split_pipeline(cargs)
   cstr = " | ".join([subprocess.list2cmdline(c) for c in cs])
   log.debug("Executing: " + cstr)
 
-  lockfile = None
+  lock = None
   if outfile:
-    lockfile = outfile.with_suffix(f"{outfile.suffix}.working")
-    if lockfile.exists():
-      log.warning(f"Lockfile {lockfile} already exists.")
-    with open(lockfile, "w") as f:
-      f.truncate(0)
-
-  ps = []
-  for c in cs:
-    ps.append(
-      subprocess.Popen(
-        c,
-        stdin=ps[-1].stdout if ps else infile,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-      )
+    lock = WorkLock(outfile)
+    if not lock.acquire():
+      log.warning(f"{outfile} is being made by {lock.owner()}, skipping.")
+      return None
+    if lock.recovered:
+      log.warning(f'Taking over {outfile} from dead pid {lock.recovered.get("pid")} on {lock.recovered.get("host")}.')
+
+  job = outfile.name if outfile else cs[-1][0]
+  tools = [pathlib.Path(c[0]).stem.casefold() for c in cs]
+  try:
+    ps = await spawn_pipeline(cs, infile)
+    # Drain every stage's stderr concurrently so a chatty stage cannot stall the pipeline.
+    outs = await asyncio.gather(
+      drain(ps[-1].stdout, job, tools[-1]),
+      *(drain(p.stderr, job, t) for p, t in zip(ps, tools, strict=True)),
     )
-  outstr, errstr = ps[-1].communicate()
+    await asyncio.gather(*(p.wait() for p in ps))
+  finally:
+    board.finish(job)
+    if lock is not None:
+      lock.release()
 
   # encname='cp1252'/ encname='utf-8'
-  outstr = outstr.decode(errors="replace")
-  errstr = errstr.decode(errors="replace")
-  errstr += "".join(
-    [p.stderr.read().decode(errors="replace") for p in ps if not p.stderr.closed]
-  )
-  outstr = cookout(outstr)
-  errstr = cookout(errstr)
+  outstr = cookout(outs[0])
+  errstr = cookout("\n".join(outs[1:]))
   if outstr:
     log.debug("Output: " + repr(outstr))
   if errstr:
     log.debug("Error: " + repr(errstr))
-  errcode = ps[-1].poll()
-  if errcode != 0:
-    if args.ignore_error:
-      log.warning("Error code (ignored) for " + repr(cstr) + ": " + str(errcode))
-    else:
-      log.error("Error code for " + repr(cstr) + ": " + str(errcode))
-      if outfile:
-        open(outfile, "w").truncate(0)
+  call_failed(cstr, ps[-1].returncode, outfile)
 
-  if lockfile is not None:
-    try:
-      lockfile.unlink()
-    except FileNotFoundError:
-      pass
+  return "\n".join(s for s in (outstr, errstr) if s)
+
+
+def call_failed(cstr, errcode, outfile=None):
+  """Report a nonzero errcode of command line cstr, leaving an empty outfile
+  behind unless errors are ignored; return whether the call failed."""
+
+  if errcode == 0:
+    return False
+  if args.ignore_error:
+    log.warning("Error code (ignored) for " + repr(cstr) + ": " + str(errcode))
+    return True
+  log.error("Error code for " + repr(cstr) + ": " + str(errcode))
+  if outfile:
+    spoil(outfile)
+  return True
+
+
+def spoil(outfile):
+  """Leave an empty outfile, marking it as failed."""
+
+  # Replace rather than truncate, as outfile may be linked into the artifact store.
+  try:
+    outfile.unlink()
+  except FileNotFoundError:
+    pass
+  outfile.touch()
 
-  return outstr + errstr
+
+def spoiled(outfile):
+  """Check whether outfile is missing or was left empty as failed."""
+
+  return not outfile.exists() or outfile.stat().st_size == 0
+
+
+def do_call(cargs, outfile=None, infile=None):
+  return asyncio.run(do_call_async(cargs, outfile, infile))
+
+
+async def tee_call_async(decode, encodes, taps=(), job=None, chunk=1 << 20):
+  """Run pipeline decode once, copying its output into each of the pipelines in
+  encodes, a list of (cargs, outfile); return the output of each, or None for
+  those whose outfile is being made elsewhere.
+
+  Each of taps is also called with every chunk of the output and, if the
+  decoder succeeds, with b"" at its end.  An encoder that dies, or a tap that
+  raises ValueError, is dropped; the others go on.  If the decoder fails, all
+  outfiles are left empty."""
+
+  outs = [None] * len(encodes)
+  live = []
+  locks = []
+  taps = list(taps)
+  try:
+    for i, (cargs, outfile) in enumerate(encodes):
+      lock = WorkLock(outfile)
+      if not lock.acquire():
+        log.warning(f"{outfile} is being made by {lock.owner()}, skipping.")
+        continue
+      if lock.recovered:
+        log.warning(f'Taking over {outfile} from dead pid {lock.recovered.get("pid")} on {lock.recovered.get("host")}.')
+      locks.append(lock)
+      live.append((i, split_pipeline(cargs), outfile))
+    if not live and not taps:
+      return outs
+
+    dcs = split_pipeline(decode)
+    dstr = " | ".join([subprocess.list2cmdline(c) for c in dcs])
+    estrs = [" | ".join([subprocess.list2cmdline(c) for c in cs]) for _, cs, _ in live]
+    log.debug(f"Executing: {dstr}" + (f" into {len(live)} encoders: " + "; ".join(estrs) if live else ""))
+    job = job or (live[0][2].name if live else dcs[0][0])
+    dec = []
+    encs = []
+    try:
+      dec = await spawn_pipeline(dcs)
+      for _, cs, _ in live:
+        encs.append(await spawn_pipeline(cs, asyncio.subprocess.PIPE))
+    except BaseException:
+      for p in dec + [p for ps in encs for p in ps]:
+        if p.returncode is None:
+          p.kill()
+      raise
+
+    async def tee():
+      sinks = {ps[0].stdin: outfile for ps, (_, _, outfile) in zip(encs, live, strict=True)}
+      while (sinks or taps) and (data := await dec[-1].stdout.read(chunk)):
+        feed(data)
+        for s, outfile in list(sinks.items()):
+          try:
+            s.write(data)
+            await s.drain()
+          except ConnectionError:
+            log.warning(f"Encoder for {outfile} stopped reading.")
+            del sinks[s]
+      if not sinks and not taps:
+        for p in dec:
+          if p.returncode is None:
+            p.kill()
+      for s in [ps[0].stdin for ps in encs]:
+        s.close()
+        try:
+          await s.wait_closed()
+        except ConnectionError:
+          pass
+
+    def feed(data):
+      for tap in list(taps):
+        try:
+          tap(data)
+        except ValueError as e:
+          log.warning(f"{job}: {e}")
+          taps.remove(tap)
+
+    def drains(ps, job, cs):
+      tools = [pathlib.Path(c[0]).stem.casefold() for c in cs]
+      return asyncio.gather(*(drain(p.stderr, job, t) for p, t in zip(ps, tools, strict=True)))
+
+    # The tee reads the decoder's stdout; each encoder's is drained with its stderr.
+    res = await asyncio.gather(
+      tee(),
+      drains(dec, job, dcs),
+      *(
+        asyncio.gather(drain(ps[-1].stdout, outfile.name, cs[-1][0]), drains(ps, outfile.name, cs))
+        for ps, (_, cs, outfile) in zip(encs, live, strict=True)
+      ),
+    )
+    await asyncio.gather(*(p.wait() for p in dec + [p for ps in encs for p in ps]))
+    if dec[-1].returncode == 0:
+      feed(b"")
+  finally:
+    if job:
+      board.finish(job)
+    for _, _, outfile in live:
+      board.finish(outfile.name)
+    for lock in locks:
+      lock.release()
+
+  derr = cookout("\n".join(res[1]))
+  if derr:
+    log.debug("Error: " + repr(derr))
+  failed = call_failed(dstr, dec[-1].returncode) and not args.ignore_error
+  for (i, _, outfile), ps, estr, (out, errs) in zip(live, encs, estrs, res[2:], strict=True):
+    text = "\n".join(s for s in (cookout(out), cookout("\n".join(errs))) if s)
+    if text:
+      log.debug(f"Output for {outfile}: " + repr(text))
+    if not call_failed(estr, ps[-1].returncode, outfile) and failed:
+      spoil(outfile)
+    outs[i] = "\n".join(s for s in (derr, text) if s)
+  return outs
 
 
 def make_srt(cfg, track):
@@ -331,63 +620,301 @@ def config_from_base(cfg, base):
     cfg["season"] = int(m["season"])
 
 
+def cached_probe(path, probe, func, *fargs):
+  if probe_cache is None:
+    return func(*fargs)
+  return probe_cache.probe(path, probe, func, *fargs)
+
+
+# The mediainfo fields kept in configs unless --avi-all-fields is given.
+mediainfo_fields = {
+  "General": {"Format", "Duration", "FileSize", "OverallBitRate", "FrameRate", "FrameCount", "Title", "Movie"},
+  "Video": {
+    "StreamOrder", "ID", "Format", "Format_Profile", "CodecID", "Duration", "BitRate",
+    "Width", "Height", "PixelAspectRatio", "DisplayAspectRatio", "FrameRate", "FrameCount",
+    "ScanType", "ScanOrder", "Delay", "Language", "Title",
+  },
+  "Audio": {
+    "StreamOrder", "ID", "Format", "Format_Profile", "CodecID", "Duration", "BitRate", "BitRate_Mode",
+    "Channels", "SamplingRate", "Delay", "Language", "Title",
+  },
+}
+mediainfo_prefetched = {}
+
+
+def mediainfo_probe():
+  return "mediainfo-all" if args.avi_all_fields else "mediainfo-2"
+
+
+def mediainfo_batch(files, batch=256):
+  """Probe files with as few mediainfo processes as possible.
+
+  Returns {file: [(track type, {field: text})]}.  The XML is parsed
+  incrementally as mediainfo writes it, and each track is discarded as soon as
+  its fields have been copied."""
+
+  res = {}
+  files = list(files)
+  for i in range(0, len(files), batch):
+    chunk = files[i : i + batch]
+    byname = {str(f): f for f in chunk}
+    n = 0
+    tracks = ref = None
+    parser = ET.XMLPullParser(("start", "end"))
+    with subprocess.Popen(
+      ["mediainfo", "--output=XML"] + chunk, stdout=subprocess.PIPE
+    ) as p:
+      for data in iter(lambda: p.stdout.read(1 << 16), b""):
+        parser.feed(data)
+        for ev, el in parser.read_events():
+          tag = el.tag.rsplit("}", 1)[-1]
+          if ev == "start":
+            if tag in ("media", "File"):
+              tracks = []
+              ref = el.get("ref")
+          elif tag == "track" and tracks is not None:
+            typ = el.get("type")
+            keep = None if args.avi_all_fields else mediainfo_fields.get(typ, set())
+            fields = {}
+            for k in el.iter():
+              name = k.tag.rsplit("}", 1)[-1]
+              if k is not el and not len(k) and (keep is None or name in keep):
+                fields[name] = k.text
+            tracks.append((typ, fields))
+            el.clear()
+          elif tag in ("media", "File") and tracks is not None:
+            f = byname.get(ref, chunk[n] if n < len(chunk) else None)
+            if f is not None:
+              res[f] = tracks
+            n += 1
+            tracks = None
+            el.clear()
+    parser.close()
+  return res
+
+
+def prefetch_mediainfo(files):
+  """Probe all files not yet in the probe cache with one batch of mediainfo runs.
+
+  If the batch fails, each file is left to be probed on its own."""
+
+  probe = mediainfo_probe()
+  files = [f for f in files if probe_cache is None or probe_cache.get(f, probe) is None]
+  if files:
+    log.debug(f"Probing {len(files)} files with mediainfo.")
+    try:
+      mediainfo_prefetched.update(mediainfo_batch(files))
+    except (OSError, ET.ParseError) as e:
+      log.warning(f"Probing {len(files)} files with mediainfo failed ({e}), probing them one by one.")
+
+
+def mediainfo_tracks(avifile):
+  if (t := mediainfo_prefetched.pop(avifile, None)) is not None:
+    return t
+  return mediainfo_batch([avifile]).get(avifile, [])
+
+
+# Codecs by name.  ids are the other codec IDs and names under which probes
+# report them; stage is how their tracks are built: video, audio, subtitle,
+# passthrough (copied into the output unchanged), or disable; index asks for a
+# DGIndex index; timecodes for the frame timecodes; params are defaults for the
+# track; and shadows names a codec whose next track is a lossy copy of the same
+# audio, which is disabled.
+codecs = {
+  "MPEG-1/2": {
+    "ids": ["V_MPEG1", "V_MPEG2", "MPEG Video"],
+    "extension": "mpg",
+    "stage": "video",
+    "index": True,
+    "timecodes": True,
+  },
+  "AVC/H.264/MPEG-4p10": {
+    "ids": ["V_MPEG4/ISO/AVC", "MPEG-4p10/AVC/h.264", "AVC"],
+    "extension": "264",
+    "stage": "video",
+    "index": True,
+    "timecodes": True,
+  },
+  # AVIs are read in place; mkvextract writes MPEG-4 Part 2 from an MKV into an AVI.
+  "MPEG-4 Visual": {
+    "ids": ["MPEG-4p2", "V_MPEG4/ISO/ASP", "V_MPEG4/ISO/SP", "V_MPEG4/ISO/AP"],
+    "extension": "avi",
+    "stage": "video",
+  },
+  "VC-1": {
+    "ids": ["V_MS/VFW/FOURCC, WVC1"],
+    "extension": "wvc",
+    "stage": "video",
+    "index": True,
+    "timecodes": True,
+  },
+  "AC-3": {
+    "ids": ["A_AC3", "A_EAC3", "AC3/EAC3", "AC-3/E-AC-3", "E-AC-3", "AC-3 Dolby Surround EX"],
+    "extension": "ac3",
+    "stage": "audio",
+    "params": {"quality": 60},
+  },
+  "TrueHD": {
+    "ids": ["A_TRUEHD", "TrueHD Atmos", "MLP FBA"],
+    "extension": "thd",
+    "stage": "audio",
+    "params": {"quality": 60},
+    "shadows": "DTS",
+  },
+  "DTS-HD Master Audio": {"extension": "dts", "stage": "audio", "params": {"quality": 60}, "shadows": "DTS"},
+  "DTS": {
+    "ids": ["A_DTS", "DTS-ES", "DTS-HD High Resolution", "DTS-HD High Resolution Audio"],
+    "extension": "dts",
+    "stage": "audio",
+    "params": {"quality": 60},
+  },
+  "PCM": {"ids": ["A_PCM/INT/LIT"], "extension": "pcm", "stage": "audio", "params": {"quality": 60}},
+  "MP3": {"ids": ["A_MPEG/L3", "MPEG Audio Layer 3"], "extension": "mp3", "stage": "audio", "params": {"quality": 60}},
+  "MP2": {
+    "ids": ["A_MPEG/L2", "A_MPEG/L1", "MPEG Audio Layer 2", "MPEG Audio Layer 1"],
+    "extension": "mp2",
+    "stage": "audio",
+    "params": {"quality": 60},
+  },
+  "VobSub": {"ids": ["S_VOBSUB"], "extension": "idx", "stage": "subtitle"},
+  "HDMV PGS": {"ids": ["S_HDMV/PGS", "PGS"], "extension": "sup", "stage": "subtitle"},
+  "SubRip/SRT": {"ids": ["S_TEXT/UTF8", "UTF-8"], "extension": "srt", "stage": "subtitle"},
+  "SubStationAlpha": {"ids": ["S_TEXT/ASS", "S_TEXT/SSA", "ASS", "SSA"], "extension": "ass", "stage": "subtitle"},
+  "WebVTT": {"ids": ["S_TEXT/WEBVTT"], "extension": "vtt", "stage": "subtitle"},
+  "ACM": {"ids": ["A_MS/ACM"], "stage": "disable"},
+}
+
+
+def load_codecs(fn):
+  """Merge the codec definitions in JSON or YAML file fn into the codec table."""
+
+  with open(fn, "r", encoding="utf-8") as f:
+    d = yaml.load(f, Loader=Loader)
+  if not isinstance(d, dict):
+    raise TypeError(f"{fn} does not contain a mapping")
+  for name, c in d.items():
+    codecs.setdefault(name, {}).update(c)
+
+
+def find_codec(fmt):
+  """Return the name and definition of the codec fmt, or (None, None)."""
+
+  for name, c in codecs.items():
+    if fmt == name or fmt in c.get("ids", ()):
+      return name, c
+  return None, None
+
+
+def apply_codec(cfg, track, source, shadowed, extract=False):
+  """Set up track according to the codec table.
+
+  shadowed is the set of codecs whose next track is to be disabled as a
+  duplicate.  With extract, the track is named for extraction from source."""
+
+  name, c = find_codec(track["format"])
+  if c is None:
+    log.warning(f'{cfg["base"]}: Unrecognized track type {track["format"]} in {source}')
+    track["disable"] = True
+    return
+  if extract and (ext := c.get("extension")):
+    track["extension"] = ext
+    track["file"] = f'{cfg["base"]} T{track["id"]:02d}.{ext}'
+    if c.get("index"):
+      track["dgifile"] = f'{cfg["base"]} T{track["id"]:02d}.dgi'
+    if c.get("timecodes"):
+      track["t2cfile"] = f'{cfg["base"]} T{track["id"]:02d}.t2c'
+  track.update(c.get("params", {}))
+  if c.get("stage") == "disable":
+    track["disable"] = True
+  elif c.get("stage") == "passthrough":
+    track["passthrough"] = True
+  if name in shadowed:
+    log.info(f'{cfg["base"]}: Disabling {name} track {track["id"]}, a copy of an earlier track.')
+    track["disable"] = True
+    shadowed.discard(name)
+  elif sh := c.get("shadows"):
+    shadowed.add(sh)
+
+
 def prepare_avi(cfg, avifile):
   try:
-    xmlroot = ET.fromstring(
-      subprocess.check_output(["mediainfo", "--output=XML", avifile]).decode(
-        errors="replace"
-      )
-    )
-    for avitrack in xmlroot.iter("track"):
-      avittype = avitrack.get("type")
-      if avittype == "General":
-        for k in avitrack.iter():
-          cfg["avi" + "".join(l for l in k.tag.casefold() if l.isalnum())] = k.text
-        pass
-      elif avittype == "Video" or avittype == "Audio":
-        track = maketrack(cfg)
-        track["type"] = avittype.casefold()
-        for k in avitrack.iter():
-          track["avi" + "".join(l for l in k.tag.casefold() if l.isalnum())] = k.text
-      else:
-        log.warning(f"Unrecognized avi track type {avittype} in {avifile}")
+    avitracks = cached_probe(avifile, mediainfo_probe(), mediainfo_tracks, avifile)
   except ET.ParseError:
     return
+  shadowed = set()
+  for avittype, fields in avitracks:
+    if avittype == "General":
+      for k, v in fields.items():
+        cfg["avi" + "".join(l for l in k.casefold() if l.isalnum())] = v
+    elif avittype == "Video" or avittype == "Audio":
+      track = maketrack(cfg)
+      track["type"] = avittype.casefold()
+      for k, v in fields.items():
+        track["avi" + "".join(l for l in k.casefold() if l.isalnum())] = v
+      if fmt := fields.get("Format"):
+        # E.g., "MPEG Audio" is told apart by its profile, "Layer 2" or "Layer 3".
+        if (profile := fields.get("Format_Profile")) and find_codec(f"{fmt} {profile}")[1]:
+          fmt = f"{fmt} {profile}"
+        track["format"] = fmt
+        apply_codec(cfg, track, avifile, shadowed)
+      order = fields.get("StreamOrder")
+      if args.stream_audio and track["type"] == "audio" and order:
+        track["extension"] = avifile.suffix[1:]
+        track["file"] = avifile
+        track["stream"] = int(order.split("-")[-1])
+    else:
+      log.warning(f"Unrecognized avi track type {avittype} in {avifile}")
 
 
-def prepare_mkv(cfg, mkvfile):
-  try:
-    cs = cfg["chapters"] = defdict(
+def mkv_chapter_atoms(xmlfile):
+  """Read the chapter atoms from the XML written by mkvextract chapters."""
+
+  atoms = []
+  for chap in ET.parse(xmlfile).getroot().iter("ChapterAtom"):
+    disp = chap.find("ChapterDisplay")
+    atoms.append(
       {
-        "uid": [],
-        "time": [],
-        "hidden": [],
-        "enabled": [],
-        "name": [],
-        "lang": [],
-        "delay": 0.0,
-        "elongation": 1.0,
+        "uid": chap.find("ChapterUID").text,
+        "time": to_float(chap.find("ChapterTimeStart").text),
+        "hidden": chap.find("ChapterFlagHidden").text,
+        "enabled": chap.find("ChapterFlagEnabled").text,
+        "name": disp.find("ChapterString").text,
+        "lang": disp.find("ChapterLanguage").text,
       }
     )
-    xmlroot = ET.fromstring(
-      subprocess.check_output(["mkvextract", "chapters", mkvfile]).decode(
-        errors="replace"
-      )
-    )
-    for chap in xmlroot.iter("ChapterAtom"):
-      cs["uid"].append(chap.find("ChapterUID").text)
-      cs["time"].append(to_float(chap.find("ChapterTimeStart").text))
-      cs["hidden"].append(chap.find("ChapterFlagHidden").text)
-      cs["enabled"].append(chap.find("ChapterFlagEnabled").text)
-      cs["name"].append(chap.find("ChapterDisplay").find("ChapterString").text)
-      v = chap.find("ChapterDisplay").find("ChapterLanguage").text
-      cs["lang"].append(iso6392BtoT.get(v, v))
-  except ET.ParseError:
-    del cfg["chapters"]
+  return atoms
+
+
+def set_mkv_chapters(cfg, atoms):
+  cfg["chapters"] = Chapters(
+    **{k: [a[k] for a in atoms] for k in ("uid", "time", "hidden", "enabled", "name")},
+    lang=[iso6392BtoT.get(a["lang"], a["lang"]) for a in atoms],
+    delay=0.0,
+    elongation=1.0,
+  )
 
-  j = json.loads(
-    subprocess.check_output(["mkvmerge", "-J", mkvfile]).decode(errors="replace")
+
+def probe_mkv_file(mkvfile):
+  """Return the mkvmerge -J description of mkvfile, probing natively where possible."""
+
+  if args.probe != "mkvmerge":
+    try:
+      return cached_probe(mkvfile, probe_name, probe_mkv, mkvfile)
+    except EBMLError as e:
+      if args.probe == "native":
+        raise
+      log.warning(f"Native probe of {mkvfile} failed ({e}), using mkvmerge.")
+  return cached_probe(
+    mkvfile,
+    "mkvmerge",
+    lambda: json.loads(
+      subprocess.check_output(["mkvmerge", "-J", mkvfile]).decode(errors="replace")
+    ),
   )
+
+
+def prepare_mkv(cfg, mkvfile):
+  j = probe_mkv_file(mkvfile)
   jc = j["container"]
   contain = cfg["mkvcontainer"] = defdict()
   contain["type"] = jc["type"]
@@ -397,122 +924,13 @@ def prepare_mkv(cfg, mkvfile):
     else:
       contain[k] = v
 
-  skip_a_dts = False
-  base = cfg["base"]
+  shadowed = set()
   for t in j["tracks"]:
     track = maketrack(cfg)
-    tid = track["id"]
     track["mkvtrack"] = t["id"]
     track["type"] = t["type"]
     track["format"] = t["codec"]
-
-    if track["format"] in {
-      "V_MPEG2",
-      "MPEG-1/2",
-    }:
-      track["extension"] = "mpg"
-      track["file"] = f"{base} T{tid:02d}.mpg"
-      track["dgifile"] = f"{base} T{tid:02d}.dgi"
-    elif track["format"] in {
-      "V_MPEG4/ISO/AVC",
-      "MPEG-4p10/AVC/h.264",
-      "AVC/H.264/MPEG-4p10",
-    }:
-      track["extension"] = "264"
-      track["file"] = f"{base} T{tid:02d}.264"
-      #        track['t2cfile'] = f'{base} T{tid:02d}.t2c'
-      track["dgifile"] = f"{base} T{tid:02d}.dgi"
-    elif track["format"] in {
-      "V_MS/VFW/FOURCC, WVC1",
-      "VC-1",
-    }:
-      track["extension"] = "wvc"
-      track["file"] = f"{base} T{tid:02d}.wvc"
-      #        track['t2cfile'] = f'{base} T{tid:02d}.t2c'
-      track["dgifile"] = f"{base} T{tid:02d}.dgi"
-    elif track["format"] in {
-      "A_AC3",
-      "A_EAC3",
-      "AC3/EAC3",
-      "AC-3/E-AC-3",
-      "AC-3",
-      "E-AC-3",
-      "AC-3 Dolby Surround EX",
-    }:
-      track["extension"] = "ac3"
-      track["file"] = f"{base} T{tid:02d}.ac3"
-      track["quality"] = 60
-    elif track["format"] in {"E-AC-3"}:
-      log.warning(
-        f'{cfg["base"]}: Track type {track["format"]} in {mkvfile} not supported, disabling.'
-      )
-      track["disable"] = True
-      track["extension"] = "ac3"
-      track["file"] = f"{base} T{tid:02d}.ac3"
-      track["quality"] = 60
-    elif track["format"] in {
-      "TrueHD",
-      "A_TRUEHD",
-      "TrueHD Atmos",
-    }:
-      track["extension"] = "thd"
-      track["file"] = f"{base} T{tid:02d}.thd"
-      track["quality"] = 60
-      skip_a_dts = True
-    elif track["format"] in {
-      "DTS-HD Master Audio",
-    }:
-      track["extension"] = "dts"
-      track["file"] = f"{base} T{tid:02d}.dts"
-      track["quality"] = 60
-      skip_a_dts = True
-    elif track["format"] in {
-      "A_DTS",
-      "DTS",
-      "DTS-ES",
-      "DTS-HD High Resolution",
-      "DTS-HD High Resolution Audio",
-    }:
-      track["extension"] = "dts"
-      track["file"] = f"{base} T{tid:02d}.dts"
-      track["quality"] = 60
-      if skip_a_dts:
-        track["disable"] = True
-        skip_a_dts = False
-    elif track["format"] in {
-      "A_PCM/INT/LIT",
-      "PCM",
-    }:
-      track["extension"] = "pcm"
-      track["file"] = f"{base} T{tid:02d}.pcm"
-      track["quality"] = 60
-    elif track["format"] in {
-      "S_VOBSUB",
-      "VobSub",
-    }:
-      track["extension"] = "idx"
-      track["file"] = f"{base} T{tid:02d}.idx"
-    elif track["format"] in {
-      "S_HDMV/PGS",
-      "HDMV PGS",
-      "PGS",
-    }:
-      track["extension"] = "sup"
-      track["file"] = f"{base} T{tid:02d}.sup"
-    elif track["format"] in {
-      "SubRip/SRT",
-    }:
-      track["extension"] = "srt"
-      track["file"] = f"{base} T{tid:02d}.srt"
-    elif track["format"] in {
-      "A_MS/ACM",
-    }:
-      track["disable"] = True
-    else:
-      log.warning(
-        f'{cfg["base"]}: Unrecognized track type {track["format"]} in {mkvfile}'
-      )
-      track["disable"] = True
+    apply_codec(cfg, track, mkvfile, shadowed, extract=True)
 
     for k, v in t["properties"].items():
       if k == "language":
@@ -543,89 +961,169 @@ def prepare_mkv(cfg, mkvfile):
       else:
         track[k] = v
 
+  # Everything is gathered in a single pass of mkvextract over the file.
   extract = []
+  tcs = []
   for track in tracks(cfg):
     file = track["file"]
-    print(type(file), repr(file))
     mkvtrack = track["mkvtrack"]
+    if mkvtrack is None:
+      continue
+    if (tc := track["t2cfile"]) and not tc.exists():
+      tcs.append(f"{mkvtrack:d}:{tc}")
     if (args.keep_video_in_mkv and track["type"] == "video") or (
       args.keep_audio_in_mkv and track["type"] == "audio"
     ):
       track["extension"] = "mkv"
       track["file"] = mkvfile
-    elif file and not file.exists() and mkvtrack:
-      extract.append(f"{mkvtrack:d}:{file}")
+    elif args.stream_audio and track["type"] == "audio":
+      track["extension"] = "mkv"
+      track["file"] = mkvfile
+      track["stream"] = mkvtrack
+    elif file and not file.exists():
+      if (
+        artifacts is not None
+        and artifacts.fetch(artifacts.key(mkvfile, "extract", mkvtrack), file) is not None
+      ):
+        continue
+      extract.append((mkvtrack, file))
+
+  # Chapters read from the XML of mkvextract are cached like the other probes.
+  atoms = j.get("chapter_atoms")
+  if atoms is None and j.get("chapters") and probe_cache is not None:
+    atoms = probe_cache.get(mkvfile, "mkvextract-chapters")
+  chapfile = pathlib.Path(f'{cfg["base"]}.chapters.xml')
+  call = []
   if extract:
-    do_call(["mkvextract", "tracks", mkvfile] + extract)
+    call += ["tracks"] + [f"{t:d}:{f}" for t, f in extract]
+  if tcs:
+    call += ["timestamps_v2"] + tcs
+  if j.get("chapters") and atoms is None and not chapfile.exists():
+    call += ["chapters", chapfile]
+  if call:
+    do_call(["mkvextract", mkvfile] + call)
+    if artifacts is not None:
+      for t, f in extract:
+        artifacts.store(artifacts.key(mkvfile, "extract", t), f)
+  if j.get("chapters") and atoms is None:
+    try:
+      atoms = mkv_chapter_atoms(chapfile)
+      if probe_cache is not None:
+        probe_cache.put(mkvfile, "mkvextract-chapters", atoms)
+    except (ET.ParseError, OSError, AttributeError):
+      log.warning(f"{cfg['base']}: Unreadable chapters in {mkvfile}, skipping.")
+    chapfile.unlink(missing_ok=True)
+  if atoms:
+    set_mkv_chapters(cfg, atoms)
 
   #  for track in tracks(cfg, 'video'):
   #    make_srt(cfg, track)
 
-  tcs = []
-  for track in tracks(cfg):
-    if "t2cfile" not in track or "mkvtrack" not in track:
+  for track in tracks(cfg, "video"):
+    if not (tc := track["t2cfile"]) or not tc.exists():
       continue
-    tc = track["t2cfile"]
-    if not tc.exists() and track["mkvtrack"]:
-      tcs.append(f'{track["mkvtrack"]}:{track["t2cfile"]}')
-  if tcs:
-    do_call(["mkvextract", "timecodes_v2", mkvfile] + tcs)
-
-  for track in tracks(cfg):
-    if track["extension"] != ".sub":
+    with Timecodes.for_file(tc) as tcs:
+      st = tcs.stats()
+    if not st["frames"]:
       continue
-    try:
-      with open(track["t2cfile"], "rt", encoding="utf-8") as fp:
-        t2cl = [to_float(l) for l in fp]
-    except ValueError:
-      log.warning(f'Unrecognized line in {track["t2cfile"]}, skipping.')
-    if len(t2cl) == 0:
-      continue
-    #    oframes = track['frames']
-    #    frames = len(t2cl)-1
-    #    if oframes>0 and frames != oframes:
-    #      log.warning(f'Timecodes changed frames in "{file}" from {oframes:d} to {frames:d}')
-    #    cfg.set('frames',frames)
     odur = track["duration"]
-    track["duration"] = dur = t2cl[-1] / 1000.0
-    if odur and odur > 0 and odur != dur:
-      log.warning(f'Encoding changed duration in "{file}" from {odur:f} to {dur:f}')
+    track["duration"] = dur = st["duration"]
+    if odur and odur > 0 and abs(odur - dur) > 0.5:
+      log.warning(f'Timecodes changed duration of "{track["file"]}" from {odur:f} to {dur:f}')
+    track["vfr"] = st["vfr"]
+    if st["vfr"]:
+      log.info(
+        f'{cfg["base"]}: Variable frame rate from {st["min_fps"]:.3f} to {st["max_fps"]:.3f} fps '
+        f'(typically {st["typical_fps"]:.3f}) in {track["file"]}.'
+      )
 
-  for track in tracks(cfg, "subtitle"):
-    if track["extension"] != ".sub":
+  for track in tracks(cfg, "subtitles"):
+    if track["extension"] != "idx" or not track["file"].exists():
       continue
-    idxfile = track["file"].with_suffix(".idx")
-    track["timestamp"] = []
-    with open(idxfile, "rt", encoding="utf-8", errors="replace").read() as fp:
-      for l in fp:
-        if re.fullmatch(r"\s*#.*", l):
-          continue
-        elif re.fullmatch(r"\s*", l):
-          continue
-        elif (
-          m := re.fullmatch(
-            r"\s*timestamp:\s*(?P<time>.*),\s*filepos:\s*(?P<pos>[0-9a-fA-F]+)\s*",
-            l,
-          )
-        ) and (t := to_float(m["time"])):
-          track["timestamp"].append(t)
-          track["filepos"].append(m["pos"])
-        elif m := re.fullmatch(r"\s*id\s*:\s*(\w+?)\s*, index:\s*(\d+)\s*", l):
-          track["language"] = m[1]  # Convert to 3 character codes
-          track["langindex"] = m[2]
-        elif m := re.fullmatch(r"\s*(\w+)\s*:\s*(.*?)\s*", l):
-          track[m[1]] = m[2]
-        else:
-          log.warning(
-            f'{cfg["base"]}: Ignorning in {idxfile} uninterpretable line: {l}'
-          )
-    # remove idx file
+    # The index lives in a sidecar rather than in the config.
+    idx = VobSubIndex.for_file(track["file"])
+    log.debug(f'{track["file"]}: {len(idx)} subpictures in streams {idx.languages()}.')
 
   if args.delete_source:
-    try:
-      mkvfile.unlink()
-    except FileNotFoundError:
-      pass
+    # Tracks streamed or kept in the source read it until the mux, which deletes it.
+    if any(t["file"] == mkvfile for t in tracks(cfg)):
+      log.debug(f"{cfg['base']}: Keeping {mkvfile} until muxed.")
+    else:
+      mkvfile.unlink(missing_ok=True)
+
+
+def parse_dg_line(dg, l):
+  if not l:
+    return
+  if m := re.fullmatch("([^:]*):(.*)", l):
+    k = "".join(i for i in m[1].casefold() if i.isalnum())
+    v = m[2].strip()
+    if not v:
+      return
+    if dg[k] == v:
+      return
+    elif dg[k]:
+      dg[k] += f";{v}"
+    else:
+      dg[k] = v
+  else:
+    log.warning(f"Unrecognized DGIndex log line: {repr(l)}")
+
+
+async def index_async(call, dgifile, logfile, dg):
+  """Run an indexer while following its log, until the indexer exits; return
+  its output, or None if another process is making dgifile."""
+
+  job = dgifile.name
+  tool = pathlib.Path(call[0]).stem.casefold()
+  follower = LogFollower(logfile)
+  loop = asyncio.get_running_loop()
+  changed = asyncio.Event()
+  notify = None
+  try:
+    notify = Inotify()
+    notify.add_watch(logfile.parent.resolve(), IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE)
+    loop.add_reader(notify.fd, lambda: (notify.read(0), changed.set()))
+  except (OSError, AttributeError, NotImplementedError):
+    if notify is not None:
+      notify.close()
+    notify = None
+
+  def consume(lines):
+    for l in lines:
+      if (e := parse_progress(job, tool, l)) is not None:
+        board.update(e)
+      else:
+        parse_dg_line(dg, l)
+
+  task = asyncio.ensure_future(do_call_async(call, dgifile))
+  try:
+    while not task.done():
+      waiter = asyncio.ensure_future(changed.wait())
+      await asyncio.wait(
+        {task, waiter},
+        timeout=5.0 if notify else 0.5,
+        return_when=asyncio.FIRST_COMPLETED,
+      )
+      waiter.cancel()
+      changed.clear()
+      consume(follower.read())
+    consume(follower.flush())
+    return await task
+  finally:
+    board.finish(job)
+    if notify is not None:
+      loop.remove_reader(notify.fd)
+      notify.close()
+
+
+def read_dg_log(call, dgifile, logfile, dg):
+  """Parse the log of a finished indexer into dg, as index_async does while it runs."""
+
+  tool = pathlib.Path(call[0]).stem.casefold()
+  for l in LogFollower(logfile).flush():
+    if parse_progress(dgifile.name, tool, l) is None:
+      parse_dg_line(dg, l)
 
 
 def build_indices(cfg, track):
@@ -633,55 +1131,64 @@ def build_indices(cfg, track):
   dgifile = track["dgifile"]
   logfile = file.with_suffix(".log")
 
-  if not dgifile or dgifile.exists():
+  if not dgifile or dgifile.exists() or WorkLock.locked(dgifile):
     return False
+  try:
+    logfile.unlink()
+  except FileNotFoundError:
+    pass
   if dgifile.suffix == ".dgi":
-    do_call(["DGIndexNV", "-i", file, "-o", dgifile.resolve(), "-h", "-e"], dgifile)
+    call = ["DGIndexNV", "-i", file, "-o", dgifile.resolve(), "-h", "-e"]
   elif dgifile.suffix == ".d2v":
-    do_call(
-      [
-        "dgindex",
-        "-i",
-        file.resolve(),
-        "-o",
-        dgifile.with_suffix("").resolve(),
-        "-fo",
-        "0",
-        "-ia",
-        "3",
-        "-om",
-        "2",
-        "-hide",
-        "-exit",
-      ],
-      dgifile,
-    )
+    call = [
+      "dgindex",
+      "-i",
+      file.resolve(),
+      "-o",
+      dgifile.with_suffix("").resolve(),
+      "-fo",
+      "0",
+      "-ia",
+      "3",
+      "-om",
+      "2",
+      "-hide",
+      "-exit",
+    ]
   else:
     return False
 
-  dg = track["dg"] = defdict()
-  while True:
-    time.sleep(1)
-    if not logfile.exists():
-      continue
-    with open(logfile, "rt", encoding="utf-8", errors="replace") as fp:
-      for l in fp:
-        l = l.strip()
-        if m := re.fullmatch("([^:]*):(.*)", l):
-          k = "".join(i for i in m[1].casefold() if i.isalnum())
-          v = m[2].strip()
-          if not v:
-            continue
-          if dg[k] == v:
-            continue
-          elif dg[k]:
-            dg[k] += f";{v}"
-          else:
-            dg[k] = v
+  dg = defdict()
+  key = None
+  cached = False
+  if artifacts is not None:
+    # Indexes hold the path of their source, so a renamed source is indexed afresh.
+    key = artifacts.key(file, "index", [str(file.resolve())] + [c for c in call if not isinstance(c, pathlib.Path)])
+    with WorkLock(dgifile) as locked:
+      if not locked:
+        return False
+      if artifacts.fetch(key, dgifile) is not None:
+        if artifacts.fetch(key, logfile) is not None:
+          read_dg_log(call, dgifile, logfile, dg)
+          cached = True
         else:
-          log.warning(f"Unrecognized DGIndex log line: {repr(l)}")
-    if dg["info"] == "Finished!":
-      break
+          dgifile.unlink()
+  if not cached and asyncio.run(index_async(call, dgifile, logfile, dg)) is None:
+    # Another process is indexing; its index and log are not ours to judge.
+    return False
+  track["dg"] = dg
+  if dg["info"] != "Finished!":
+    log.error(
+      f'{call[0]} exited without finishing {dgifile} (last status: {dg["info"] or "none"}).'
+    )
+    try:
+      dgifile.unlink()
+    except FileNotFoundError:
+      pass
+    return False
+  if key is not None and not cached:
+    artifacts.store(key, dgifile)
+    artifacts.store(key, logfile)
   try:
     logfile.unlink()
   except FileNotFoundError:
@@ -716,11 +1223,10 @@ def build_indices(cfg, track):
       r"\bCLIP\ *(?P<left>\d+) *(?P<right>\d+) *(?P<top>\d+) *(?P<bottom>\d+)",
       dgip[2],
     ):
-      w = track["picture_width"] - int(m["left"]) - int(m["right"])
-      h = track["picture_height"] - int(m["top"]) - int(m["bottom"])
-      track["macroblocks"] = int(math.ceil(w / 16.0)) * int(math.ceil(h / 16.0))
+      clip = tuple(int(m[k]) for k in ("left", "right", "top", "bottom"))
     else:
       log.error(f'No CLIP in {track["dgifile"]}')
+      clip = (0, 0, 0, 0)
 
     if "sar" in dg:
       track["sample_aspect_ratio"] = to_float(dg["sar"])
@@ -772,6 +1278,17 @@ def build_indices(cfg, track):
     log.error(f'Unrecognize index file {track["dgifile"]}')
     return False
 
+  set_video_level(cfg, track, clip)
+  return True
+
+
+def set_video_level(cfg, track, crop=(0, 0, 0, 0)):
+  """Set the macroblocks of track's picture less crop (left, right, top,
+  bottom), and the AVC level and rate factors that picture calls for."""
+
+  w = track["picture_width"] - crop[0] - crop[1]
+  h = track["picture_height"] - crop[2] - crop[3]
+  track["macroblocks"] = int(math.ceil(w / 16.0)) * int(math.ceil(h / 16.0))
   if track["macroblocks"] <= 1620:  # 480p@30fps; 576p@25fps
     track["avc_level"] = 3.0
     track["x264_rate_factor"] = 16.0
@@ -796,6 +1313,41 @@ def build_indices(cfg, track):
     track["x265_rate_factor"] = 22.0
     cfg["hdvideo"] = True
 
+
+def build_crop(cfg, track):
+  """Replace an automatic crop by the crop found in frames sampled once from
+  the video, and reset the level and rate factors for the cropped picture.
+
+  Without NumPy, AviSynth's autocrop is left to crop at each encode."""
+
+  if track["crop"] != "auto" or np is None:
+    return False
+  dgifile = track["dgifile"]
+  if not dgifile or not dgifile.exists():
+    return False
+  every = max(1, (track["frames"] or 0) // (args.crop_samples + 1))
+  avsfile = args.outdir / track["file"].with_suffix(".crop.avs").name
+  avs = avs_source(track, dgifile) + [f"SelectRangeEvery({every:d}, 1, {every // 2:d})"]
+  with open(avsfile, "wt", encoding="utf-8", errors="replace") as fp:
+    fp.write("\n".join(a for a in avs if a))
+  det = CropDetector()
+  try:
+    asyncio.run(
+      tee_call_async(
+        ["avs2pipemod", "-y4mp", avsfile], [], taps=[det], job=f'{cfg["base"]} T{track["id"]:02d} crop'
+      )
+    )
+  finally:
+    avsfile.unlink(missing_ok=True)
+  if (res := det.result()) is None:
+    log.warning(f'{track["file"]}: No crop found, leaving it to autocrop.')
+    return False
+  crop, track["varying_aspect"] = res
+  if track["varying_aspect"]:
+    log.warning(f'{track["file"]}: Aspect ratio varies, cropping only the borders of all frames.')
+  track["crop"] = ",".join(str(c) for c in crop)
+  log.info(f'{track["file"]}: Cropping {track["crop"]} (left, right, top, bottom).')
+  set_video_level(cfg, track, crop)
   return True
 
 
@@ -832,81 +1384,243 @@ def build_subtitle(cfg, track):
     if not outfile.exists() or not outfile.is_file() or outfile.stat().st_size == 0:
       log.error(f"Subtitle {outfile} empty and disabled.")
       track["disable"] = True
-  elif inext == "srt":
+  elif inext in ("srt", "vtt", "ass", "ssa"):
     track["outfile"] = outfile = infile.with_suffix(".ttxt")
-    if outfile.exists():
-      return False  # Should be not readytomake(outfile,)
-    with open(infile, "rt", encoding="utf-8", errors="replace") as i, open(
-      "temp.srt", "wt", encoding="utf-8", errors="replace"
-    ) as o:
-      for l in i.read().split("\n\n"):
-        if l.startswith("\ufeff"):
-          l = l[1:]
-        if not l.strip():
-          continue
-        elif (
-          (
-            m := re.fullmatch(
-              r"(?s)(?P<beg>\s*\d*\s*)(?P<time1>[0-9,.:]*)(?P<mid> --> )(?P<time2>[0-9,.:]*)(?P<end>.*)",
-              l,
-            )
-          )
-          and (t1 := to_float(m["time1"]))
-          and (t2 := to_float(m["time2"]))
-          and (s1 := t1 * elong + delay) >= 0
-          and (s2 := t2 * elong + delay) >= 0
-        ):
-          o.write(
-            f'{m["beg"]}{unparse_time(s1)}{m["mid"]}{unparse_time(s2)}{m["end"]}\n\n'
-          )
-        else:
-          log.warning(f"Unrecognized line in {infile}: {repr(l)}")
+    if not readytomake(outfile, infile):
+      return False
+    with WorkLock(outfile) as locked:
+      if not locked:
+        return False
+      try:
+        n = convert_subtitles(infile, outfile, delay, elong)
+      except (OSError, ValueError, KeyError) as e:
+        log.error(f"Unable to convert subtitles {infile}: {e}")
+        outfile.unlink(missing_ok=True)
+        return False
+    log.debug(f"Converted {n} subtitles from {infile}.")
+  elif inext == "idx" and (delay != 0.0 or elong != 1.0):
+    track["outfile"] = outfile = infile.with_suffix(".adj.idx")
+    if not readytomake(outfile, infile):
+      return False
+    with WorkLock(outfile) as locked:
+      if not locked:
+        return False
+      try:
+        idx = VobSubIndex.for_file(infile).retimed(delay, elong)
+        # The adjusted index shares the subpictures of the original.
+        materialize(infile.with_suffix(".sub"), outfile.with_suffix(".sub"))
+        with open(outfile, "wt", encoding="utf-8") as o:
+          idx.write(o)
+      except (OSError, ValueError) as e:
+        log.error(f"Unable to retime VobSub index {infile}: {e}")
+        outfile.unlink(missing_ok=True)
+        return False
+  else:
+    if elong != 1.0 or delay != 0.0:
+      log.warning(f'Delay and elongation not implemented for subtitles type "{infile}"')
+    track["outfile"] = outfile = infile
+
+  if not outfile.exists():
+    track["disable"] = True
+    return False
+  return True
+
+
+def build_passthrough(cfg, track):
+  """Put track into the output as extracted from the source."""
+
+  track["outfile"] = track["file"]
+  return track["file"] is not None and track["file"].exists()
+
+
+def audio_decode(cfg, track, downmix=None, normalize=False):
+  """Return the command that decodes track into WAV on stdout, shifted by its delay."""
+
+  if track["extension"] in ():  # ('dts', 'thd'):
+    return ["dcadec", "-6", track["file"], "-"]
+  if track["stream"] is not None:
+    # Demux and decode straight from the source container into the encoder.
+    if normalize:
+      log.warning(f'{cfg["base"]}: Normalization is not supported for streamed audio.')
+    delay = track["delay"] or 0.0
+    return [
+      "ffmpeg",
+      "-nostdin",
+      "-v",
+      "error",
+      "-i",
+      track["file"],
+      "-map",
+      f'0:{track["stream"]}',
+      "-vn",
+      "-af" if delay else None,
+      f"adelay={delay*1000.0:.0f}:all=1"
+      if delay > 0
+      else f"atrim=start={-delay:f},asetpts=PTS-STARTPTS"
+      if delay < 0
+      else None,
+      "-ac" if downmix in (2, 6) else None,
+      downmix if downmix in (2, 6) else None,
+      "-rf64",
+      "auto",
+      "-f",
+      "wav",
+      "-",
+    ]
+  return [
+    "eac3to",
+    track["file"],
+    f'{track["mkvtrack"]+1}:' if track["extension"] == "mkv" else None,
+    "stdout.wav",
+    #      , '-no2ndpass'
+    "-log=nul",
+    f'{track["delay"]*1000.0:+.0f}ms' if track["delay"] else None,
+    #      , '-0,1,2,3,5,6,4' if track['channels']==7 else None
+    "-down6" if downmix == 6 else None,
+    "-downDpl" if downmix == 2 else None,
+    "-normalize" if normalize else None,
+  ]
+
+
+def qaac_encode(quality, outfile, normalize=False, gain=None):
+  return [
+    "qaac64",
+    "--threading",
+    "--ignorelength",
+    "--no-optimize",
+    "--tvbr",
+    quality or 60,
+    "--quality",
+    "2",
+    "--normalize" if normalize else None,
+    "--gain" if gain else None,
+    f"{gain:+.2f}" if gain else None,
+    "-",
+    "-o",
+    outfile,
+  ]
+
+
+def audio_encode(v, outfile):
+  """Return the command that encodes WAV on stdin into outfile as output variant v.
+
+  Codec "aac" (the default) encodes with qaac at quality v["quality"], codec
+  "ac3" with ffmpeg at v["quality"] kbit/s; v["downmix"] is done by ffmpeg,
+  and v["gain"] dB applied."""
+
+  downmix = ["-ac", v["downmix"]] if v.get("downmix") in (2, 6) else []
+  ffmpeg = ["ffmpeg", "-nostdin", "-v", "error", "-ignore_length", "1", "-f", "wav", "-i", "-"]
+  if v.get("codec") == "ac3":
+    if v.get("normalize"):
+      log.warning(f"{outfile}: Normalization is not supported for downmixed AC-3 outputs.")
+    gain = ["-af", f'volume={v["gain"]:+.2f}dB'] if v.get("gain") else []
+    return ffmpeg + downmix + gain + ["-c:a", "ac3", "-b:a", f'{v.get("quality") or 640}k', "-y", outfile]
+  call = qaac_encode(v.get("quality"), outfile, v.get("normalize"), v.get("gain"))
+  if downmix:
+    call = ffmpeg + downmix + ["-rf64", "auto", "-f", "wav", "-", "|"] + call
+  return call
+
+
+audio_suffixes = {"aac": ".m4a", "ac3": ".ac3"}
+
+
+def cached_loudness(track):
+  """Return the loudness measured from track's source, unless the source has changed since."""
+
+  loud = track["loudness"]
+  if loud and loud.get("source") == fingerprint(track["file"]):
+    return loud
+  return None
+
+
+def loudness_meter(track):
+  """Return a meter to tap track's decode with, or None if its loudness is known already."""
+
+  if np is None or cached_loudness(track) is not None:
+    return None
+  return LoudnessMeter()
+
+
+def keep_loudness(track, meter):
+  if meter is None or (loud := meter.result()) is None:
+    return
+  loud["source"] = fingerprint(track["file"])
+  track["loudness"] = loud
+  log.info(
+    f'{track["file"]}: {loud["integrated"]} LUFS, LRA {loud["lra"]} LU, true peak {loud["true_peak"]} dBTP.'
+  )
+
+
+class DecodeSpool:
+  """A tap that keeps a copy of a decode in a file, for the encodes that can
+  only start once all of the decode has been measured."""
+
+  def __init__(self, path):
+    self.path = path
+    self.fp = open(path, "wb")
+    self.complete = False
+
+  def __call__(self, data):
+    try:
+      if data:
+        self.fp.write(data)
+      else:
+        self.fp.close()
+        self.complete = True
+    except OSError as e:
+      self.fp.close()
+      raise ValueError(f"Unable to spool the decode into {self.path}: {e}") from e
+
+  def discard(self):
+    self.fp.close()
+    self.path.unlink(missing_ok=True)
+
+
+def spool_path(cfg, track):
+  # Each process spools its own decode, whatever others work on the title.
+  return pathlib.Path(f'{cfg["base"]} T{track["id"]:02d}.{os.getpid()}.spool.wav')
+
+
+def measure_loudness(cfg, track, decode, spool=None):
+  """Return the loudness of track, decoding it with decode to measure it unless
+  cached, and copying that decode into spool."""
+
+  if (meter := loudness_meter(track)) is not None:
+    asyncio.run(
+      tee_call_async(
+        decode, [], taps=[t for t in (meter, spool) if t], job=f'{cfg["base"]} T{track["id"]:02d} loudness'
+      )
+    )
+    keep_loudness(track, meter)
+  return cached_loudness(track)
+
+
+async def encode_file_async(infile, encodes):
+  """Encode infile into each of encodes, a list of (cargs, outfile), at once;
+  return the output of each."""
+
+  fps = [open(infile, "rb") for _ in encodes]
+  try:
+    return await asyncio.gather(*(do_call_async(c, o, fp) for (c, o), fp in zip(encodes, fps, strict=True)))
+  finally:
+    for fp in fps:
+      fp.close()
 
-    do_call(["mp4box", "-ttxt", "temp.srt"], outfile)
-    try:
-      pathlib.Path("temp.ttxt").rename(outfile)
-    except FileNotFoundError:
-      pass
-    try:
-      pathlib.Path("temp.srt").unlink()
-    except FileNotFoundError:
-      pass
-  elif False:  # inext=='idx':
-    track["outfile"] = outfile = infile.with_suffix(".adj.idx")
-    subfile = infile.with_suffix(".adj.sub")
-    if not subfile.exits():
-      shutil.copy(infile.with_suffix(".sub"), subfile)
-    if outfile.exists():
-      return  # Should be not readytomake(outfile,)
-    with open(infile, "rt", encoding="utf-8", errors="replace") as i, open(
-      outfile, "wt", encoding="utf-8", errors="replace"
-    ) as o:
-      for l in i:
-        print(l)
-        if (
-          (
-            m := re.fullmatch(
-              r"(?s)(?P<beg>\s*timestamp:\s*)\b(?P<time>.*\d)\b(?P<end>.*)",
-              l,
-            )
-          )
-          and (t := to_float(m["time"]))
-          and ((s := t * elong + delay) >= 0)
-        ):
-          l = f'{m["beg"]}{unparse_time(s)}{m["end"]}'
-        o.write(l)
-  else:
-    if elong != 1.0 or delay != 0.0:
-      log.warning(f'Delay and elongation not implemented for subtitles type "{infile}"')
-    track["outfile"] = outfile = infile
 
-  if not outfile.exists():
-    track["disable"] = True
-    return False
-  return True
+def loudness_gain(loud):
+  return None if loud is None else normalization_gain(loud, args.loudness_target, args.true_peak)
+
+
+def gain_params(by_gain):
+  """Extra artifact key parameters of an encode normalized by measured loudness."""
+
+  return ["--gain", args.loudness_target, args.true_peak] if by_gain else []
 
 
 def build_audio(cfg, track):
+  if track["outputs"]:
+    return build_audio_outputs(cfg, track)
+
   # pylint: disable=used-before-assignment
   track["outfile"] = outfile = track["outfile"] or pathlib.Path(
     f'{cfg["base"]} T{track["id"]:02d}.m4a'
@@ -914,47 +1628,237 @@ def build_audio(cfg, track):
   if not readytomake(outfile, track["file"]):
     return False
 
-  if track["extension"] in ():  # ('dts', 'thd'):
-    call = ["dcadec", "-6", track["file"], "-"]
-  else:
-    if track["elongation"] and track["elongation"] != 1.0:
-      log.warning(f"Audio elongation not implemented")
-    if track["downmix"] not in (2, 6, None):
-      log.warning(f'Invalid downmix "{track["downmix"]}"')
-    call = [
-      "eac3to",
+  if track["elongation"] and track["elongation"] != 1.0:
+    log.warning(f"Audio elongation not implemented")
+  if track["downmix"] not in (2, 6, None):
+    log.warning(f'Invalid downmix "{track["downmix"]}"')
+  # Without a downmix, normalize by a gain from the (cached) measured loudness
+  # rather than by a separate analysis pass of eac3to.  Until the loudness is
+  # known, the decode that measures it is spooled, and the encoder, which needs
+  # the gain from the start, reads the spool instead of a second decode.
+  by_gain = track["normalize"] and not track["downmix"] and np is not None
+  normalize = track["normalize"] and not by_gain
+  decode = [c for c in audio_decode(cfg, track, track["downmix"], normalize) if c]
+  call = decode + ["|"] + [c for c in qaac_encode(track["quality"], outfile) if c]
+
+  key = None
+  if artifacts is not None:
+    key = artifacts.key(
       track["file"],
-      f'{track["mkvtrack"]+1}:' if track["extension"] == "mkv" else None,
-      "stdout.wav",
-      #      , '-no2ndpass'
-      "-log=nul",
-      f'{track["delay"]*1000.0:+.0f}ms' if track["delay"] else None,
-      #      , '-0,1,2,3,5,6,4' if track['channels']==7 else None
-      "-down6" if track["downmix"] == 6 else None,
-      "-downDpl" if track["downmix"] == 2 else None,
-      "-normalize" if track["normalize"] else None,
-      "|",
-      "qaac64",
-      "--threading",
-      "--ignorelength",
-      "--no-optimize",
-      "--tvbr",
-      track["quality"] or 60,
-      "--quality",
-      "2",
-      "-",
-      "-o",
-      outfile,
-    ]
+      "audio",
+      [c for c in call if c not in (track["file"], outfile)] + gain_params(by_gain),
+    )
+    if (meta := artifacts.fetch(key, outfile)) is not None:
+      track.update(meta)
+      return True
 
-  res = do_call((c for c in call if c), outfile)
-  if res and (m := re.match(r"\bwrote (\d+\.?\d*) seconds\b", res)):
+  gain = None
+  spool = DecodeSpool(spool_path(cfg, track)) if by_gain and cached_loudness(track) is None else None
+  try:
+    if by_gain and (gain := loudness_gain(measure_loudness(cfg, track, decode, spool))) is None:
+      log.error(f'{cfg["base"]} T{track["id"]:02d}: Unable to measure loudness for normalization.')
+      return False
+    encode = [c for c in qaac_encode(track["quality"], outfile, gain=gain) if c]
+    # Decodes of the source as is are measured on the way, for later normalizations.
+    meter = loudness_meter(track) if not track["downmix"] and not normalize else None
+    if spool is not None and spool.complete:
+      res = asyncio.run(encode_file_async(spool.path, [(encode, outfile)]))[0]
+    elif meter is None:
+      res = do_call(decode + ["|"] + encode, outfile)
+    else:
+      res = asyncio.run(tee_call_async(decode, [(encode, outfile)], taps=[meter]))[0]
+      keep_loudness(track, meter)
+  finally:
+    if spool is not None:
+      spool.discard()
+  if res and (m := re.search(r"\bwrote (\d+\.?\d*) seconds\b", res)):
     track["duration"] = to_float(m[1])
+  if key is not None:
+    artifacts.store(key, outfile, {"duration": track["duration"], "loudness": track["loudness"]})
+  check_audio_duration(cfg, track)
+  return True
+
+
+def build_audio_outputs(cfg, track):
+  """Decode track once and encode it into each of the variants in its outputs.
+
+  Each variant is a dict whose downmix, normalize, and quality override the
+  track's, with an optional codec ("aac" or "ac3"), name, default_track, and
+  outfile.  Variants already made or cached are skipped.  Variants without a
+  downmix are normalized by a gain from the track's measured loudness.  If
+  that is not known yet, it is measured on the decode that feeds the other
+  variants, which is also spooled into a WAV for the normalized ones: their
+  encoders need the gain from the start."""
+
+  if track["elongation"] and track["elongation"] != 1.0:
+    log.warning("Audio elongation not implemented")
+  decode = [c for c in audio_decode(cfg, track) if c]
+  made = False
+  todo = []
+  for i, v in enumerate(track["outputs"]):
+    codec = v.setdefault("codec", "aac")
+    if codec not in audio_suffixes:
+      log.warning(f'{cfg["base"]} T{track["id"]:02d}: Unknown audio codec "{codec}"')
+      continue
+    o = {k: track[k] for k in ("downmix", "normalize", "quality")} | v
+    if o["downmix"] not in (2, 6, None):
+      log.warning(f'Invalid downmix "{o["downmix"]}"')
+    by_gain = bool(o["normalize"]) and not o["downmix"] and np is not None
+    o["normalize"] = o["normalize"] and not by_gain
+    outfile = pathlib.Path(
+      v.get("outfile") or f'{cfg["base"]} T{track["id"]:02d}.{i}{audio_suffixes[codec]}'
+    )
+    v["outfile"] = str(outfile)
+    if not readytomake(outfile, track["file"]):
+      continue
+    key = None
+    if artifacts is not None:
+      encode = [c for c in audio_encode(o, outfile) if c]
+      key = artifacts.key(
+        track["file"],
+        "audio",
+        [c for c in decode if c != track["file"]]
+        + ["|"]
+        + [c for c in encode if c != outfile]
+        + gain_params(by_gain),
+      )
+      if (meta := artifacts.fetch(key, outfile)) is not None:
+        v.update(meta)
+        made = True
+        continue
+    todo.append((v, o, by_gain, outfile, key))
+  track.touch("outputs")
+
+  meter = loudness_meter(track) if todo else None
+  first, later, spool = todo, [], None
+  if meter is not None and any(t[2] for t in todo):
+    first, later = [t for t in todo if not t[2]], [t for t in todo if t[2]]
+    spool = DecodeSpool(spool_path(cfg, track))
+  gain = None
+  try:
+    for batch in (first, later):
+      if not batch and not (meter or spool):
+        continue
+      if any(t[2] for t in batch) and (gain := loudness_gain(cached_loudness(track))) is None:
+        log.error(f'{cfg["base"]} T{track["id"]:02d}: Unable to measure loudness for normalization.')
+        return made
+      encodes = []
+      for _v, o, by_gain, outfile, _ in batch:
+        if by_gain:
+          o["gain"] = gain
+        encodes.append(([c for c in audio_encode(o, outfile) if c], outfile))
+      if batch is later and spool.complete:
+        outs = asyncio.run(encode_file_async(spool.path, encodes))
+      else:
+        taps = [meter, spool] if batch is first else []
+        outs = asyncio.run(tee_call_async(decode, encodes, taps=[t for t in taps if t]))
+        keep_loudness(track, meter)
+        meter = None
+      for (v, _, _, outfile, key), res in zip(batch, outs, strict=True):
+        if res and (m := re.search(r"\bwrote (\d+\.?\d*) seconds\b", res)):
+          v["duration"] = to_float(m[1])
+        if key is not None:
+          artifacts.store(key, outfile, {"duration": v.get("duration")})
+      made = made or bool(batch)
+  finally:
+    if spool is not None:
+      spool.discard()
+  if dur := next((v["duration"] for v in track["outputs"] if v.get("duration")), None):
+    track["duration"] = dur
+  check_audio_duration(cfg, track)
+  return made
+
+
+def check_audio_duration(cfg, track):
   if (dur := track["duration"]) and (mdur := cfg["duration"]) and abs(dur - mdur) > 0.5:
     log.warning(
       f'Audio track "{track["file"]}" duration differs (elongation={mdur/dur})'
     )
-  return True
+
+
+def mux_tracks(cfg):
+  """Yield the tracks to mux: each track, except that an audio track with
+  outputs yields a copy per output variant, only the first of which is default."""
+
+  for track in tracks(cfg):
+    if track["type"] != "audio" or not track["outputs"] or track["passthrough"]:
+      yield track
+      continue
+    for i, v in enumerate(track["outputs"]):
+      d = track.to_dict()
+      del d["outputs"]
+      if i > 0:
+        d.pop("default_track", None)
+      yield Track.from_dict(d | v)
+
+
+def title_chapters(cfg):
+  """Return the title's (time, name, lang) chapters, retimed like its video."""
+
+  if not (cs := cfg["chapters"]) or not cs["time"]:
+    return []
+  v = next(tracks(cfg, "video"), None)
+  if v is None:
+    return cs.retimed()
+  return cs.retimed(v["delay"] or 0.0, v["elongation"] or 1.0)
+
+
+def write_ogm_chapters(chapters, fn):
+  """Write chapters in the OGM format, which both MP4Box and mkvmerge read."""
+
+  with open(fn, "wt", encoding="utf-8") as fp:
+    for i, (t, name, _) in enumerate(chapters, 1):
+      fp.write(f"CHAPTER{i:02d}={unparse_time(t)}\nCHAPTER{i:02d}NAME={name or f'Chapter {i}'}\n")
+
+
+def chapter_frames(cfg, track):
+  """Return the frames of the encoded track at which chapters start, excluding the first."""
+
+  times = [t for t, _, _ in title_chapters(cfg)]
+  if not times:
+    return []
+  if tc := vfr_timecodes(track):
+    with Timecodes.for_file(tc) as tcs:
+      frames = [bisect.bisect_left(tcs.times, t * 1000.0 - 0.5) for t in times]
+  else:
+    fps = track["frame_rate_ratio_out"]
+    frames = [round(t * fps) for t in times]
+  return sorted({f for f in frames if f > 0})
+
+
+def write_qpfile(frames, fn, first=0, last=None):
+  """Write a qpfile forcing IDR frames at frames (within first..last, renumbered from first)."""
+
+  with open(fn, "wt", encoding="utf-8") as fp:
+    for f in frames:
+      if f > first and (last is None or f <= last):
+        fp.write(f"{f - first:d} I -1\n")
+
+
+def vfr_timecodes(track):
+  """Return the timecodes file to apply to a variable-frame-rate track, or None.
+
+  Timecodes only fit if the script passes every source frame through."""
+
+  if not track["vfr"] or not (tc := track["t2cfile"]) or not tc.exists():
+    return None
+  if track["interlace_type"] in {"FILM"}:
+    log.warning(f'{track["file"]}: Timecodes do not survive decimation, encoding at a constant rate.')
+    return None
+  return tc
+
+
+def avs_source(track, dgifile):
+  """Return the AviSynth lines that open the video of track through its index dgifile."""
+
+  return [
+    f'DGDecode_mpeg2source("{dgifile}", info=3, idct=4, cpu=3)'
+    if dgifile.suffix == ".d2v"
+    else None,
+    f'DGSource("{dgifile}", deinterlace={1 if track["interlace_type"] in ["VIDEO", "INTERLACE"] else 0:d})\n'
+    if dgifile.suffix == ".dgi"
+    else None,
+  ]
 
 
 def build_video(cfg, track):
@@ -983,12 +1887,7 @@ def build_video(cfg, track):
   avs = [
     f"SetMTMode(5,{procs:d})" if procs != 1 else None,
     "SetMemoryMax(1024)",
-    f'DGDecode_mpeg2source("{dgifile}", info=3, idct=4, cpu=3)'
-    if dgifile.suffix == ".d2v"
-    else None,
-    f'DGSource("{dgifile}", deinterlace={1 if track["interlace_type"] in ["VIDEO", "INTERLACE"] else 0:d})\n'
-    if dgifile.suffix == ".dgi"
-    else None,
+    *avs_source(track, dgifile),
     #    , 'ColorMatrix(hints = true, interlaced=false)'
     "unblock(cartoon=true)"
     if track["unblock"] == "cartoon"
@@ -1087,8 +1986,11 @@ def build_video(cfg, track):
       "--non-deterministic" if not track["x264_deterministic"] else None,
       "--no-fast-pskip" if not track["x264_fast_pskip"] else None,
       "--no-dct-decimate" if not track["x264_dct_decimate"] else None,
+      "--output",
+      outfile,
     ]
-    # if 't2cfile' in track: call += ['--timebase', '1000', '--tcfile-in', track['t2cfile']]
+    if (tc := vfr_timecodes(track)) and args.video_chunks <= 1:
+      call += ["--timebase", "1000", "--tcfile-in", tc]
     # if not track['deinterlace'] and 'frames' in track: call += ['--frames', track['frames']]
   elif track["outformat"] == "h265":
     call += [
@@ -1114,6 +2016,11 @@ def build_video(cfg, track):
     log.error(f'{outfile}: Unrecognized output format "{track["outformat"]}"')
     return False
 
+  # Start every chapter on an IDR frame so that chapter seeks are quick.
+  qpfile = avsfile.with_suffix(".qp")
+  if keyframes := chapter_frames(cfg, track):
+    call += ["--qpfile", qpfile]
+
   call += [
     "--fps",
     to_ratio_string(track["frame_rate_ratio_out"]),
@@ -1121,9 +2028,39 @@ def build_video(cfg, track):
     to_ratio_string(track["sample_aspect_ratio"], sep=":"),
   ]
 
-  res = do_call((c for c in call if c), outfile)
-  if res and (m := re.match(r"\bencoded (\d+) frames\b", res)):
-    nframes = int(m[1])
+  call = [c for c in call if c]
+  key = None
+  if artifacts is not None:
+    # The index and script names follow the source name, so leave them out of the key.
+    key = artifacts.key(
+      infile,
+      "video",
+      {
+        "avs": [a for a in avs if a and dgifile.name not in a],
+        "call": [c for c in call if c not in (avsfile, outfile, qpfile)],
+        "chunks": max(1, args.video_chunks),
+        "keyframes": keyframes,
+      },
+    )
+    if (meta := artifacts.fetch(key, outfile)) is not None:
+      track.update(meta)
+      return True
+
+  try:
+    if args.video_chunks > 1 and track["frames"]:
+      if (nframes := encode_video_chunks(cfg, track, avs, avsfile, call, outfile)) is None:
+        return False
+    else:
+      if keyframes:
+        write_qpfile(keyframes, qpfile)
+      # No result means that another process is making outfile.
+      if not (res := do_call(call, outfile)) or spoiled(outfile):
+        return False
+      m = re.search(r"\bencoded (\d+) frames\b", res)
+      nframes = int(m[1]) if m else None
+  finally:
+    qpfile.unlink(missing_ok=True)
+  if nframes is not None:
     oframes = int(
       track["frame_rate_ratio_out"] / track["frame_rate_ratio"] * track["frames"]
     )
@@ -1139,9 +2076,127 @@ def build_video(cfg, track):
       log.warning(
         f'Video track "{infile}" duration differs (elongation={track["duration"]/mdur:f})'
       )
+  if key is not None:
+    artifacts.store(
+      key,
+      outfile,
+      {
+        "frames": track["frames"],
+        "duration": track["duration"],
+        "frame_rate_ratio_out": track["frame_rate_ratio_out"],
+      },
+    )
   return True
 
 
+def chunk_ranges(frames, n, fps, chapters=None):
+  """Split frames 0..frames-1 into about n (first, last) ranges.
+
+  Chunk boundaries snap to a chapter start when one is near the even split
+  point; each chunk is at least ten seconds long."""
+
+  n = max(1, min(n, int(frames // (10 * fps))))
+  starts = [round(t * fps) for t in (chapters or [])]
+  bounds = [0]
+  for i in range(1, n):
+    target = i * frames / n
+    near = [c for c in starts if abs(c - target) < frames / (4 * n)]
+    b = min(near, key=lambda c: abs(c - target)) if near else round(target)
+    if bounds[-1] < b < frames:
+      bounds.append(b)
+  bounds.append(frames)
+  return [(bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1)]
+
+
+async def encode_chunks_async(calls):
+  return await asyncio.gather(*(do_call_async(c, o) for c, o in calls))
+
+
+def encode_video_chunks(cfg, track, avs, avsfile, call, outfile):
+  """Encode the video in concurrently encoded chunks and join them.
+
+  Each chunk is a Trim() of the full filter chain encoded to its own elementary
+  stream, which starts with an IDR frame and parameter sets, so the chunks are
+  joined by plain concatenation.  Return the total frames encoded, or None if
+  any chunk failed or the total is not what the track should have."""
+
+  fps = track["frame_rate_ratio_out"]
+  oframes = int(fps / track["frame_rate_ratio"] * track["frames"])
+  chapters = [t for t, _, _ in title_chapters(cfg)]
+  ranges = chunk_ranges(oframes, args.video_chunks, fps, chapters)
+  keyframes = chapter_frames(cfg, track)
+  # The stage holds all of video_chunk_threads() against the CPU budget.
+  threads = max(1, video_chunk_threads() // len(ranges))
+
+  lock = WorkLock(outfile)
+  if not lock.acquire():
+    log.warning(f"{outfile} is being made by {lock.owner()}, skipping.")
+    return None
+  if lock.recovered:
+    log.warning(f'Taking over {outfile} from dead pid {lock.recovered.get("pid")} on {lock.recovered.get("host")}.')
+  # Holding the lock on outfile, this call owns the chunk files; it removes only those it made.
+  calls = []
+  temps = []
+  try:
+    for i, (first, last) in enumerate(ranges):
+      cavs = avsfile.with_suffix(f".c{i:02d}.avs")
+      cout = outfile.with_suffix(f".c{i:02d}{outfile.suffix}")
+      lines = [a for a in avs if a]
+      trim = f"Trim({first:d},{last:d})"
+      if lines[-1] == "Distributor()":
+        lines.insert(-1, trim)
+      else:
+        lines.append(trim)
+      temps.append(cavs)
+      with open(cavs, "wt", encoding="utf-8", errors="replace") as fp:
+        fp.write("\n".join(lines))
+      ccall = [cavs if c == avsfile else cout if c == outfile else c for c in call]
+      if "--qpfile" in ccall:
+        cqp = avsfile.with_suffix(f".c{i:02d}.qp")
+        temps.append(cqp)
+        write_qpfile(keyframes, cqp, first, last)
+        ccall[ccall.index("--qpfile") + 1] = cqp
+      if track["outformat"] == "h265":
+        ccall += ["--pools", threads]
+      else:
+        ccall += ["--threads", threads]
+      calls.append((ccall, cout))
+
+    log.info(f"Encoding {outfile} in {len(calls)} chunks of {threads} threads each.")
+    results = asyncio.run(encode_chunks_async(calls))
+    for (_, cout), res in zip(calls, results, strict=True):
+      # A chunk skipped as locked was not made here.
+      if res is not None:
+        temps.append(cout)
+
+    nframes = 0
+    for (_, cout), res, (first, last) in zip(calls, results, ranges, strict=True):
+      if not (m := re.search(r"\bencoded (\d+) frames\b", res or "")) or spoiled(cout):
+        log.error(f"Chunk {cout} failed.")
+        return None
+      if int(m[1]) != last - first + 1:
+        log.error(f"Chunk {cout} has {m[1]} frames instead of {last - first + 1:d}.")
+        return None
+      nframes += int(m[1])
+    if abs(nframes - oframes) > 2:
+      log.error(f"Chunks of {outfile} have {nframes:d} frames instead of {oframes:d}.")
+      return None
+
+    # Join into a temporary file, so that outfile never holds a partial join.
+    joined = outfile.with_suffix(f".join{outfile.suffix}")
+    temps.append(joined)
+    with open(joined, "wb") as o:
+      for _, cout in calls:
+        with open(cout, "rb") as i:
+          shutil.copyfileobj(i, o, 1 << 24)
+    joined.replace(outfile)
+    return nframes
+  finally:
+    for f in temps:
+      f.unlink(missing_ok=True)
+    lock.release()
+
+
 def get_cover_files(l):
   cfps = []
   if not isinstance(l, list):
@@ -1161,7 +2216,7 @@ def get_cover_files(l):
 
 def build_mp4(cfg):
   base = cfg["base"]
-  for track in tracks(cfg):
+  for track in mux_tracks(cfg):
     outfile = track["outfile"]
     trackid = track["id"]
     if not outfile:
@@ -1186,7 +2241,7 @@ def build_mp4(cfg):
   trcnt = {}
   mdur = cfg["duration"]
 
-  for track in tracks(cfg):
+  for track in mux_tracks(cfg):
     of = track["outfile"]
     dur = track["duration"]
     if mdur and dur:
@@ -1227,15 +2282,35 @@ def build_mp4(cfg):
 
   cfg["tool"] = f'{prog} {version} on {time.strftime("%A, %B %d, %Y, at %X")}'
   syncconfig(cfg)
-  do_call(call, outfile)
+  chapfile = pathlib.Path(f"{base}.chapters.txt")
+  if chapters := title_chapters(cfg):
+    write_ogm_chapters(chapters, chapfile)
+    call += ["-chap", chapfile]
+  try:
+    do_call(call, outfile)
+  finally:
+    chapfile.unlink(missing_ok=True)
+  if spoiled(outfile):
+    return False
+  for track in tracks(cfg, "video"):
+    # MP4Box cannot take timecodes on import, so apply them afterwards.
+    if tc := vfr_timecodes(track):
+      # Into a copy, so that a failure does not spoil the muxed file.
+      tmp = outfile.with_suffix(f".vfr{outfile.suffix}")
+      do_call(["mp4fpsmod", "--tcfile", tc, "--output", tmp, outfile], tmp)
+      if spoiled(tmp):
+        tmp.unlink(missing_ok=True)
+        log.error(f"{outfile}: Applying the timecodes in {tc} failed.")
+        return False
+      tmp.replace(outfile)
+      break
   set_meta_mutagen(outfile, cfg)
-  set_chapters_cmd(outfile, cfg)
   return True
 
 
 def build_mkv(cfg):
   base = cfg["base"]
-  for track in tracks(cfg):
+  for track in mux_tracks(cfg):
     outfile = track["outfile"]
     trackid = track["id"]
     if outfile is None:
@@ -1260,6 +2335,7 @@ def build_mkv(cfg):
   trcnt = {}
   mdur = cfg["duration"]
 
+  xf = pathlib.Path(f"{base}.tags.xml")
   call = [
     "mkvmerge",
     #    '--command-line-charset', 'utf-8',
@@ -1268,10 +2344,10 @@ def build_mkv(cfg):
     "--output",
     outfile,
     "--global-tags",
-    "temp.xml",
+    xf,
   ]
 
-  for track in tracks(cfg):
+  for track in mux_tracks(cfg):
     of = track["outfile"]
     dur = track["duration"]
     if mdur and dur:
@@ -1306,6 +2382,9 @@ def build_mkv(cfg):
     else:
       trcnt[track["type"]] = 1
 
+    if track["type"] == "video" and (tc := vfr_timecodes(track)):
+      call += ["--timestamps", f"0:{tc}"]
+      infiles.append(tc)
     call.append(of)
 
   for c in get_cover_files(cfg["coverart"]):
@@ -1329,14 +2408,22 @@ def build_mkv(cfg):
   syncconfig(cfg)
   xml = set_meta_mkvxml(cfg)
   log.debug(xml)
-  xf = pathlib.Path("temp.xml")
+  chapfile = pathlib.Path(f"{base}.chapters.txt")
+  if chapters := title_chapters(cfg):
+    write_ogm_chapters(chapters, chapfile)
+    opts = ["--chapters", chapfile]
+    if lang := chapters[0][2]:
+      opts = ["--chapter-language", lang] + opts
+    i = call.index(xf) + 1
+    call[i:i] = opts
   try:
     with open(xf, mode="wt", encoding="utf-8") as tf:
       tf.write(xml)
     do_call(call, outfile)
   finally:
     xf.unlink()
-  return True
+    chapfile.unlink(missing_ok=True)
+  return not spoiled(outfile)
 
 
 def build_meta(cfg):
@@ -1397,60 +2484,249 @@ def build_meta(cfg):
   return True
 
 
-def main():
-  #    if args.prog.stat()).st_mtime >progmodtime:
-  #      exec(compile(open(args.prog).read(), args.prog, 'exec')) # execfile(args.prog)
+def build_output(cfg):
+  if args.output_type == "mp4":
+    made = build_mp4(cfg)
+  elif args.output_type == "mkv":
+    made = build_mkv(cfg)
+  else:
+    log.error(f"Output type {args.output_type} not yet supported")
+    return False
+  if made and args.delete_source:
+    # prepare_mkv keeps sources that tracks are read from until now.
+    for f in {t["file"] for t in tracks(cfg) if t["extension"] == "mkv"}:
+      f.unlink(missing_ok=True)
+  return made
+
+
+preparers = {
+  "mkv": prepare_mkv,
+  "avi": prepare_avi,
+  # , 'tivo': prepare_tivo
+  # , 'mpg': prepare_mpg
+}
+
+
+def run_stage(func, cfg, *fargs):
+  """Run one build stage of a title and write back any changes to its config."""
+
+  try:
+    return func(cfg, *fargs)
+  finally:
+    syncconfig(cfg)
+
+
+remote_stages = {
+  "video": build_video,
+  "audio": build_audio,
+}
+
+
+def run_remote_stage(stage, cfg, track):
+  """Have a worker run a stage for a track and apply the changes it reports."""
+
+  syncconfig(cfg)  # The worker reads the config from the shared directory.
+  jid = jobs.submit(
+    {"cfgname": str(cfg["cfgname"]), "stage": stage, "track": track["id"]}
+  )
+  log.debug(f'Queued {stage} of {cfg["base"]} T{track["id"]:02d} as job {jid}.')
+  delay = 1.0
+  while (r := jobs.result(jid)) is None:
+    time.sleep(delay)
+    delay = min(30.0, delay * 1.5)
+  if "error" in r:
+    log.error(f'{cfg["base"]}: {stage} failed on worker {r.get("worker")}: {r["error"]}')
+    return False
+  with cfg.lock:
+    track.update(r["track"])
+    cfg.update(r.get("title", {}))
+  syncconfig(cfg)
+  return r["result"]
+
 
-  preparers = {
-    "mkv": prepare_mkv,
-    "avi": prepare_avi,
-    # , 'tivo': prepare_tivo
-    # , 'mpg': prepare_mpg
+def run_job(job):
+  cfg = config_cache.get(args.outdir / job["cfgname"])
+  if cfg is None or (track := cfg[f'track{job["track"]:02d}']) is None:
+    return {"error": f"No track {job['track']} in {job['cfgname']}"}
+  # Only the submitting process writes the config, so start from a clean slate.
+  cfg.modclear()
+  try:
+    res = remote_stages[job["stage"]](cfg, track)
+  except Exception as e:
+    log.exception(f"Job {job} failed.")
+    return {"error": repr(e)}
+  d = track.to_dict()
+  t = cfg.to_dict()
+  return {
+    "result": res,
+    "track": {k: d.get(k) for k in track.dirty()},
+    "title": {k: t.get(k) for k in cfg.dirty() if k != "tracks"},
   }
-  for d in args.sourcedirs:
-    for f in d.iterdir():
-      if not f.is_file():
-        continue
-      fn = args.outdir / f"{f.stem}.{args.config_format}"
-      if fn.exists():
-        continue
 
-      cfgdump(defdict({"cfgname": fn.relative_to(args.outdir)}), fn)
 
-      suf = f.suffix.casefold()[1:]
-      if suf not in preparers:
-        log.warning(f"Source file type not recognized {f}")
-        continue
-      for cfg in serveconfig(fn):
-        config_from_base(cfg, f.stem)
-        preparers[suf](cfg, f)
-
-  for cfg in configs():
-    build_meta(cfg)
-
-  for cfg in configs():
-    if args.output_type == "mp4":
-      build_mp4(cfg)
-    elif args.output_type == "mkv":
-      build_mkv(cfg)
-    else:
-      log.error(f"Output type {args.output_type} not yet supported")
+def work():
+  """Run stages from the shared queue until interrupted."""
+
+  me = worker_name()
+  log.info(f"Worker {me} waiting for jobs.")
+  while True:
+    if (c := jobs.claim(me)) is None:
+      time.sleep(args.poll_interval)
+      continue
+    jid, job = c
+    log.info(f"Running job {jid}: {job}")
+    with Heartbeat(jobs, jid, me, args.lease / 3) as hb:
+      r = run_job(job)
+    if hb.lost.is_set():
+      # The job has been handed to another worker, whose result counts.
+      log.warning(f"Discarding the result of job {jid}, whose lease was lost.")
+      continue
+    r["worker"] = me
+    jobs.complete(jid, r)
+
+
+def stage_cost(stage, track):
+  """Return the number of CPU threads an encode stage of track keeps busy."""
+
+  if stage == "audio":
+    # Each extra output adds an encoder to the one decode.
+    return args.audio_cost + max(0, len(track["outputs"] or ()) - 1)
+  if args.video_chunks > 1:
+    return video_chunk_threads()
+  return track["processors"] or 8
+
+
+def video_chunk_threads():
+  """Return the CPU threads the chunks of a video encode share out: the whole budget."""
+
+  return args.cpu_budget or os.cpu_count() or 1
+
+
+def schedule_title(sched, cfg, after=()):
+  """Add the build stages of one title to the scheduler.
+
+  Indices feed crop detection, which feeds the video encode; the video,
+  audio, subtitle, and metadata stages feed the final mux, which thus starts
+  as soon as its inputs exist.
+  With a job queue, video and audio encodes are handed to workers."""
+
+  base = cfg["base"]
+  if jobs is not None:
+    encode = lambda stage: (run_remote_stage, stage)  # noqa: E731
+    lane = "remote"
+  else:
+    encode = lambda stage: (run_stage, remote_stages[stage])  # noqa: E731
+    lane = "cpu"
+  # Remote encodes use no local CPU.
+  cost = (lambda stage, track: 0) if jobs is not None else stage_cost  # noqa: E731
+  muxdeps = [
+    sched.add(f"{base}: meta", run_stage, build_meta, cfg, deps=after, lane="io")
+  ]
+  for track in tracks(cfg):
+    tn = f'{base} T{track["id"]:02d}'
+    if track["passthrough"]:
+      muxdeps.append(
+        sched.add(
+          f"{tn}: passthrough", run_stage, build_passthrough, cfg, track, deps=after, lane="io"
+        )
+      )
+    elif track["type"] == "video":
+      idx = sched.add(
+        f"{tn}: indices", run_stage, build_indices, cfg, track, deps=after, lane="io"
+      )
+      crop = sched.add(
+        f"{tn}: crop", run_stage, build_crop, cfg, track, deps=[idx], lane="cpu", cost=1
+      )
+      muxdeps.append(
+        sched.add(
+          f"{tn}: video",
+          *encode("video"),
+          cfg,
+          track,
+          deps=[crop],
+          lane=lane,
+          cost=cost("video", track),
+          # Chunked encodes take the whole budget; keep cheaper stages from starving them.
+          reserve=jobs is None and args.video_chunks > 1,
+        )
+      )
+    elif track["type"] == "subtitles":
+      muxdeps.append(
+        sched.add(
+          f"{tn}: subtitle", run_stage, build_subtitle, cfg, track, deps=after, lane="io"
+        )
+      )
+    elif track["type"] == "audio":
+      muxdeps.append(
+        sched.add(
+          f"{tn}: audio",
+          *encode("audio"),
+          cfg,
+          track,
+          deps=after,
+          lane=lane,
+          cost=cost("audio", track),
+        )
+      )
+  sched.add(f"{base}: mux", run_stage, build_output, cfg, deps=muxdeps, lane="io")
+
+
+def prepare_source(sched, f, fn):
+  cfgdump(Title(cfgname=fn.relative_to(args.outdir)), fn)
+  cfg = config_cache.get(fn)
+  if cfg is None:
+    return
+  try:
+    config_from_base(cfg, f.stem)
+    preparers[f.suffix.casefold()[1:]](cfg, f)
+  except Exception:
+    # Drop the partial config, so that the source is prepared afresh when requeued.
+    config_cache.forget(fn)
+    fn.unlink(missing_ok=True)
+    raise
+  syncconfig(cfg)
+  schedule_title(sched, cfg)
+
+
+def main(sources=()):
+  """Run the stages of all titles, preparing sources first; return the sources that failed to prepare."""
+
+  #    if args.prog.stat()).st_mtime >progmodtime:
+  #      exec(compile(open(args.prog).read(), args.prog, 'exec')) # execfile(args.prog)
+
+  budget = args.cpu_budget or None
+  lanes = {"io": args.io_jobs, "cpu": args.cpu_jobs or budget or os.cpu_count() or 1}
+  if jobs is not None:
+    lanes["remote"] = 64
+  sched = StageScheduler(lanes, budget)
 
-  for cfg in configs():
-    for track in tracks(cfg, "video"):
-      build_indices(cfg, track)
+  for fn in config_files():
+    if (cfg := config_cache.get(fn)) is not None:
+      schedule_title(sched, cfg)
 
-  for cfg in configs():
-    for track in tracks(cfg, "subtitles"):
-      build_subtitle(cfg, track)
+  todo = []
+  for f in sources:
+    fn = args.outdir / f"{f.stem}.{args.config_format}"
+    if fn.exists():
+      continue
+
+    suf = f.suffix.casefold()[1:]
+    if suf not in preparers:
+      log.warning(f"Source file type not recognized {f}")
+      continue
+    todo.append((f, fn))
 
-  for cfg in configs():
-    for track in tracks(cfg, "audio"):
-      build_audio(cfg, track)
+  prefetch_mediainfo(f for f, _ in todo if f.suffix.casefold() == ".avi")
+  for f, fn in todo:
+    sched.add(f"{f.stem}: prepare", prepare_source, sched, f, fn, lane="io")
 
-  for cfg in configs():
-    for track in tracks(cfg, "video"):
-      build_video(cfg, track)
+  sched.run()
+  log.debug(
+    f"Config cache: {config_cache.hits} hits, {config_cache.misses} misses."
+  )
+  if probe_cache is not None:
+    log.debug(f"Probe cache: {probe_cache.hits} hits, {probe_cache.misses} misses.")
+  return [f for f, fn in todo if not fn.exists()]
 
 
 if __name__ == "__main__":
@@ -1507,7 +2783,7 @@ if __name__ == "__main__":
     "--delete-source",
     action="store_true",
     default=False,
-    help="delete source file after successful extraction",
+    help="delete source file after successful extraction or, if tracks are streamed or kept in it, after the mux",
   )
   parser.add_argument(
     "--keep-video-in-mkv",
@@ -1551,6 +2827,165 @@ if __name__ == "__main__":
     default="mp4",
     help="container type for final result",
   )
+  parser.add_argument(
+    "--watch",
+    choices=["auto", "inotify", "poll"],
+    default="auto",
+    help="how to wait for new source files; with inotify, directories are still scanned every --rescan-interval"
+    " for writes by other hosts to network shares",
+  )
+  parser.add_argument(
+    "--settle",
+    type=float,
+    default=30.0,
+    help="seconds a source file's size must be unchanged before it is processed",
+  )
+  parser.add_argument(
+    "--poll-interval",
+    type=float,
+    default=10.0,
+    help="seconds between source directory scans when polling",
+  )
+  parser.add_argument(
+    "--rescan-interval",
+    type=float,
+    default=600.0,
+    help="seconds between source directory scans with inotify, or 0 to rely on its events alone",
+  )
+  parser.add_argument(
+    "--artifact-cache",
+    type=pathlib.Path,
+    action="store",
+    help="directory in which to keep extracted and encoded tracks and video indexes for reuse",
+  )
+  parser.add_argument(
+    "--artifact-cache-size",
+    type=float,
+    default=500.0,
+    help="maximum size of the artifact cache in GB",
+  )
+  parser.add_argument(
+    "--avi-all-fields",
+    action="store_true",
+    default=False,
+    help="keep every field mediainfo reports for AVI sources in their configs",
+  )
+  parser.add_argument(
+    "--probe-cache",
+    type=pathlib.Path,
+    action="store",
+    help="database in which to keep the results of probing source files",
+  )
+  parser.add_argument(
+    "--probe-cache-validate",
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="check the content of sources against their cached probe results",
+  )
+  parser.add_argument(
+    "--probe-cache-days",
+    type=float,
+    default=90.0,
+    help="days after their last use before cached probe results are dropped",
+  )
+  parser.add_argument(
+    "--progress",
+    action=argparse.BooleanOptionalAction,
+    default=True,
+    help="show live progress of running tools (requires blessed and a terminal)",
+  )
+  parser.add_argument(
+    "--log-lines",
+    type=int,
+    default=200,
+    help="number of lines of each tool's output to keep for logging",
+  )
+  parser.add_argument(
+    "--video-chunks",
+    type=int,
+    default=0,
+    help="encode each video track in this many concurrently encoded chunks (0 or 1 to disable)",
+  )
+  parser.add_argument(
+    "--codecs",
+    type=pathlib.Path,
+    action="store",
+    help="JSON or YAML file of codec definitions to add to or override the built-in ones",
+  )
+  parser.add_argument(
+    "--stream-audio",
+    action="store_true",
+    default=False,
+    help="decode audio tracks straight from the source into the encoder instead of extracting them first",
+  )
+  parser.add_argument(
+    "--probe",
+    choices=["auto", "mkvmerge", "native"],
+    default="auto",
+    help="how to read Matroska headers: natively, falling back to mkvmerge (auto), or only one way",
+  )
+  parser.add_argument(
+    "--queue",
+    action="store",
+    help="shared directory or http://host:port URL of a job queue to which to hand video and audio encodes",
+  )
+  parser.add_argument(
+    "--worker",
+    action="store_true",
+    default=False,
+    help="run encodes from the --queue instead of processing source directories",
+  )
+  parser.add_argument(
+    "--serve-queue",
+    type=int,
+    metavar="PORT",
+    help="serve the --queue directory over HTTP on this port",
+  )
+  parser.add_argument(
+    "--lease",
+    type=float,
+    default=300.0,
+    help="seconds after its last heartbeat before a queued job is given to another worker",
+  )
+  parser.add_argument(
+    "--cpu-jobs",
+    type=int,
+    help="most CPU-heavy stages (video and audio encodes) to run at the same time; by default as many as fit the --cpu-budget",
+  )
+  parser.add_argument(
+    "--cpu-budget",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="CPU threads that concurrent encodes may keep busy; 0 for no limit",
+  )
+  parser.add_argument(
+    "--loudness-target",
+    type=float,
+    help="integrated loudness in LUFS to normalize audio to, within the peak limit; by default, audio is normalized to its peak",
+  )
+  parser.add_argument(
+    "--true-peak",
+    type=float,
+    help="true peak in dBTP that normalized audio may reach; by default, its sample peak is normalized to 0 dBFS, as by eac3to -normalize",
+  )
+  parser.add_argument(
+    "--crop-samples",
+    type=int,
+    default=51,
+    help="number of frames sampled to find the black borders to crop",
+  )
+  parser.add_argument(
+    "--audio-cost",
+    type=int,
+    default=2,
+    help="CPU threads counted against the --cpu-budget for each audio encode",
+  )
+  parser.add_argument(
+    "--io-jobs",
+    type=int,
+    default=4,
+    help="number of I/O-heavy stages (extraction, indexing, subtitles, muxing) to run at the same time",
+  )
   parser.add_argument(
     "--config-format",
     choices=yaml_exts | json_exts,
@@ -1584,15 +3019,44 @@ if __name__ == "__main__":
   slogger.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s: %(message)s"))
   log.addHandler(slogger)
 
+  board = ProgressBoard(enabled=args.progress)
+  if args.codecs:
+    load_codecs(args.codecs)
+  if args.artifact_cache:
+    artifacts = ArtifactStore(args.artifact_cache, int(args.artifact_cache_size * 2**30))
+  if args.probe_cache:
+    probe_cache = ProbeCache(
+      args.probe_cache,
+      max_age=args.probe_cache_days * 86400.0,
+      validate=args.probe_cache_validate,
+    )
   log.info(prog + " " + version + " starting up.")
   nice(args.niceness)
 
+  if args.queue:
+    jobs = open_queue(args.queue, args.lease)
+  if args.serve_queue:
+    if not args.queue or args.queue.startswith(("http://", "https://")):
+      parser.error("--serve-queue requires --queue with a shared directory")
+    server = QueueServer(FileJobQueue(args.queue, args.lease), ("", args.serve_queue))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+  if args.worker:
+    if jobs is None:
+      parser.error("--worker requires --queue")
+    # Jobs name their configs relative to the output directory.
+    args.outdir = args.outdir.resolve()
+    os.chdir(args.outdir)
+    work()
+
   work_lock_delete()
-  sleep_state = None
+  watcher = SourceWatcher(
+    args.sourcedirs, settle=args.settle, interval=args.poll_interval, backend=args.watch, rescan=args.rescan_interval
+  )
   progmodtime = args.prog.stat().st_mtime
+  sources = watcher.ripe()
   while True:
-    sleep_state = sleep_change_directories(args.sourcedirs, sleep_state)
     sleep_inhibit()
-    main()
+    watcher.requeue(main(sources))
     log.debug("Sleeping.")
     sleep_uninhibit()
+    sources = watcher.wait()
@@ -0,0 +1,376 @@
+# In-process probing of Matroska headers
+
+import io
+import logging
+import struct
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEKHEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEKID = 0x53AB
+SEEKPOSITION = 0x53AC
+INFO = 0x1549A966
+TRACKS = 0x1654AE6B
+CHAPTERS = 0x1043A770
+CLUSTER = 0x1F43B675
+BLOCKGROUP = 0xA0
+BLOCK = 0xA1
+SIMPLEBLOCK = 0xA3
+
+TRACKENTRY = 0xAE
+CHAPTERATOM = 0xB6
+EDITIONENTRY = 0x45B9
+CHAPTERDISPLAY = 0x80
+VIDEO = 0xE0
+AUDIO = 0xE1
+
+# Element ID: (name, kind) for the leaf elements we read.
+leaves = {
+  0x2AD7B1: ("timestamp_scale", "uint"),
+  0x4489: ("duration", "float"),
+  0x7BA9: ("title", "str"),
+  0x4D80: ("muxing_application", "str"),
+  0x5741: ("writing_application", "str"),
+  0x73A4: ("segment_uid", "hex"),
+  0xD7: ("number", "uint"),
+  0x73C5: ("uid", "uint"),
+  0x83: ("track_type", "uint"),
+  0xB9: ("enabled_track", "uint"),
+  0x88: ("default_track", "uint"),
+  0x55AA: ("forced_track", "uint"),
+  0x23E383: ("default_duration", "uint"),
+  0x536E: ("track_name", "str"),
+  0x22B59C: ("language", "str"),
+  0x22B59D: ("language_ietf", "str"),
+  0x86: ("codec_id", "str"),
+  0x63A2: ("codec_private", "bytes"),
+  0xB0: ("pixel_width", "uint"),
+  0xBA: ("pixel_height", "uint"),
+  0x54B0: ("display_width", "uint"),
+  0x54BA: ("display_height", "uint"),
+  0x9A: ("interlaced", "uint"),
+  0xB5: ("audio_sampling_frequency", "float"),
+  0x9F: ("audio_channels", "uint"),
+  0x6264: ("audio_bits_per_sample", "uint"),
+  0x73C4: ("uid", "uint"),
+  0x91: ("time", "uint"),
+  0x98: ("hidden", "uint"),
+  0x4598: ("enabled", "uint"),
+  0x85: ("name", "str"),
+  0x437C: ("lang", "str"),
+}
+
+track_types = {1: "video", 2: "audio", 17: "subtitles"}
+
+# Codec IDs mapped to the codec names mkvmerge -J reports.
+codec_names = {
+  "V_MPEG1": "MPEG-1/2",
+  "V_MPEG2": "MPEG-1/2",
+  "V_MPEG4/ISO/AVC": "AVC/H.264/MPEG-4p10",
+  "V_MPEG4/ISO/SP": "MPEG-4p2",
+  "V_MPEG4/ISO/ASP": "MPEG-4p2",
+  "V_MPEG4/ISO/AP": "MPEG-4p2",
+  "V_MPEGH/ISO/HEVC": "HEVC/H.265/MPEG-H",
+  "A_AC3": "AC-3",
+  "A_EAC3": "E-AC-3",
+  "A_TRUEHD": "TrueHD",
+  "A_DTS": "DTS",
+  "A_PCM/INT/LIT": "PCM",
+  "A_FLAC": "FLAC",
+  "A_OPUS": "Opus",
+  "A_VORBIS": "Vorbis",
+  "S_VOBSUB": "VobSub",
+  "S_HDMV/PGS": "HDMV PGS",
+  "S_TEXT/UTF8": "SubRip/SRT",
+  "S_TEXT/ASS": "SubStationAlpha",
+  "S_TEXT/SSA": "SubStationAlpha",
+  "S_TEXT/WEBVTT": "WebVTT",
+}
+fourcc_names = {
+  "WVC1": "VC-1",
+  "WMV3": "VC-1",
+  "XVID": "MPEG-4p2",
+  "DIVX": "MPEG-4p2",
+}
+
+# The sync words of a DTS-HD extension substream and of its lossless (XLL)
+# extension; a plain A_DTS codec ID does not tell DTS-HD from DTS.
+dts_substream_sync = b"\x64\x58\x20\x25"
+dts_xll_sync = b"\x41\xa2\x95\x47"
+
+# The name under which probe results are cached, changed whenever they change.
+probe_name = "native-3"
+
+
+class EBMLError(ValueError):
+  pass
+
+
+def read_vint(f, keep_marker=False):
+  """Read an EBML variable-length integer; return (value, length) or (None, 0) at EOF.
+
+  A size with all value bits set (i.e., unknown) is returned as -1."""
+
+  b = f.read(1)
+  if not b:
+    return None, 0
+  first = b[0]
+  length = 1
+  while length <= 8 and not first & (0x80 >> (length - 1)):
+    length += 1
+  if length > 8:
+    raise EBMLError(f"Invalid EBML variable-length integer at {f.tell() - 1}")
+  rest = f.read(length - 1)
+  if len(rest) < length - 1:
+    raise EBMLError("Truncated EBML variable-length integer")
+  v = first if keep_marker else first & (0xFF >> length)
+  for c in rest:
+    v = (v << 8) | c
+  if not keep_marker and v == (1 << (7 * length)) - 1:
+    v = -1
+  return v, length
+
+
+def read_header(f):
+  """Read an element header; return (id, size, data offset) or None at EOF."""
+
+  eid, _ = read_vint(f, keep_marker=True)
+  if eid is None:
+    return None
+  size, _ = read_vint(f)
+  if size is None:
+    raise EBMLError("Truncated EBML element header")
+  return eid, size, f.tell()
+
+
+def decode(kind, data):
+  if kind == "uint":
+    return int.from_bytes(data, "big")
+  if kind == "float":
+    if len(data) == 4:
+      return struct.unpack(">f", data)[0]
+    if len(data) == 8:
+      return struct.unpack(">d", data)[0]
+    return 0.0
+  if kind == "str":
+    return data.rstrip(b"\0").decode("utf-8", errors="replace")
+  if kind == "hex":
+    return data.hex()
+  return data
+
+
+def children(f, end):
+  """Iterate over the (id, size, offset) of the elements until end, leaving f at each."""
+
+  while end < 0 or f.tell() < end:
+    h = read_header(f)
+    if h is None:
+      return
+    yield h
+    if h[1] < 0:
+      raise EBMLError(f"Element {h[0]:X} of unknown size in a header")
+    f.seek(h[2] + h[1])
+
+
+def read_master(f, end, masters=()):
+  """Read a master element into a dict of its known leaves.
+
+  Sub-masters whose IDs are in masters are read into lists under their ID."""
+
+  d = {}
+  for eid, size, _ in children(f, end):
+    if eid in masters:
+      d.setdefault(eid, []).append(read_master(f, f.tell() + size, masters))
+    elif eid in leaves:
+      name, kind = leaves[eid]
+      d[name] = decode(kind, f.read(size))
+  return d
+
+
+def first_frames(f, pos, end, numbers, limit=1 << 22):
+  """Return {track number: data} of the first block of each track in numbers,
+  reading at most limit bytes of the clusters from pos."""
+
+  frames = {}
+  f.seek(pos)
+  while len(frames) < len(numbers) and f.tell() < pos + limit and (end < 0 or f.tell() < end):
+    h = read_header(f)
+    if h is None:
+      break
+    eid, size, data = h
+    if eid in (CLUSTER, BLOCKGROUP):
+      continue  # Read on into the blocks.
+    if size < 0:
+      break
+    if eid in (SIMPLEBLOCK, BLOCK):
+      b = io.BytesIO(f.read(min(size, 1 << 16)))
+      number, _ = read_vint(b)
+      if number in numbers and number not in frames:
+        frames[number] = b.getvalue()[b.tell() + 3 :]  # Past the timecode and flags.
+    f.seek(data + size)
+  return frames
+
+
+def dts_name(frame):
+  """Return the codec name mkvmerge reports for DTS starting with frame."""
+
+  i = frame.find(dts_substream_sync)
+  if i < 0:
+    return "DTS"
+  if dts_xll_sync in frame[i:]:
+    return "DTS-HD Master Audio"
+  return "DTS-HD High Resolution Audio"
+
+
+def flatten_atoms(atoms):
+  """Yield chapter atoms and their nested atoms in document order."""
+
+  for a in atoms:
+    yield a
+    yield from flatten_atoms(a.get(CHAPTERATOM, []))
+
+
+def probe_mkv(path):
+  """Probe a Matroska file's headers without running mkvmerge.
+
+  Returns a dict shaped like the output of mkvmerge -J, plus the parsed
+  chapters under "chapter_atoms".  Only the EBML header, the SeekHead, and the
+  Info, Tracks, and Chapters elements are read; the parse stops at the first
+  Cluster and seeks to anything the SeekHead places after it.  DTS tracks have
+  their first frames read from the clusters to tell DTS-HD from DTS."""
+
+  found = {}
+  with open(path, "rb") as f:
+    h = read_header(f)
+    if h is None or h[0] != EBML:
+      raise EBMLError(f"{path} is not an EBML file")
+    f.seek(h[2] + h[1])
+    h = read_header(f)
+    if h is None or h[0] != SEGMENT:
+      raise EBMLError(f"{path} has no Matroska segment")
+    seg = h[2]
+    seg_end = -1 if h[1] < 0 else seg + h[1]
+
+    seeks = []
+    seen = set()
+
+    def read_at(eid, size):
+      end = f.tell() + size
+      if eid == SEEKHEAD:
+        for sid, ssize, _ in children(f, end):
+          if sid != SEEK:
+            continue
+          e = {cid: f.read(csize) for cid, csize, _ in children(f, f.tell() + ssize)}
+          if SEEKID in e and SEEKPOSITION in e:
+            seeks.append((int.from_bytes(e[SEEKID], "big"), seg + int.from_bytes(e[SEEKPOSITION], "big")))
+      elif eid == INFO:
+        found[INFO] = read_master(f, end)
+      elif eid == TRACKS:
+        found[TRACKS] = read_master(f, end, (TRACKENTRY, VIDEO, AUDIO)).get(TRACKENTRY, [])
+      elif eid == CHAPTERS:
+        found[CHAPTERS] = read_master(f, end, (EDITIONENTRY, CHAPTERATOM, CHAPTERDISPLAY)).get(EDITIONENTRY, [])
+
+    cluster = None
+    f.seek(seg)
+    while seg_end < 0 or f.tell() < seg_end:
+      pos = f.tell()
+      h = read_header(f)
+      if h is not None and h[0] == CLUSTER:
+        cluster = pos
+      if h is None or h[0] == CLUSTER or h[1] < 0:
+        break
+      seen.add(h[2])
+      read_at(h[0], h[1])
+      f.seek(h[2] + h[1])
+
+    while seeks:
+      eid, pos = seeks.pop(0)
+      if eid not in (SEEKHEAD, INFO, TRACKS, CHAPTERS) or eid in found:
+        continue
+      f.seek(pos)
+      h = read_header(f)
+      if h is None or h[0] != eid or h[2] in seen:
+        continue
+      seen.add(h[2])
+      read_at(h[0], h[1])
+
+    if TRACKS not in found:
+      raise EBMLError(f"{path} has no Tracks element")
+
+    dts = {t.get("number") for t in found[TRACKS] if t.get("codec_id") == "A_DTS"}
+    frames = {}
+    if dts and cluster is not None:
+      try:
+        frames = first_frames(f, cluster, seg_end, dts)
+      except EBMLError as e:
+        log.debug(f"Reading the DTS frames of {path} failed: {e}")
+
+  info = found.get(INFO, {})
+  scale = info.pop("timestamp_scale", 1000000)
+  props = {k: v for k, v in info.items() if k != "duration"}
+  if "duration" in info:
+    props["duration"] = int(info["duration"] * scale)
+
+  tracks = []
+  for tid, t in enumerate(found[TRACKS]):
+    typ = track_types.get(t.get("track_type"), "unknown")
+    cid = t.get("codec_id", "")
+    codec = codec_names.get(cid, cid)
+    if cid.startswith("A_AAC"):
+      codec = "AAC"
+    elif cid == "A_DTS" and t.get("number") in frames:
+      codec = dts_name(frames[t["number"]])
+    elif cid == "V_MS/VFW/FOURCC" and len(t.get("codec_private", b"")) >= 20:
+      fourcc = t["codec_private"][16:20].decode("ascii", errors="replace")
+      codec = fourcc_names.get(fourcc.upper(), fourcc)
+    p = {
+      "codec_id": cid,
+      "language": t.get("language", "eng"),
+      "enabled_track": bool(t.get("enabled_track", 1)),
+      "default_track": bool(t.get("default_track", 1)),
+      "forced_track": bool(t.get("forced_track", 0)),
+    }
+    for k in ("number", "uid", "language_ietf", "track_name", "default_duration", "audio_bits_per_sample"):
+      if k in t:
+        p[k] = t[k]
+    if typ == "video":
+      v = (t.get(VIDEO) or [{}])[0]
+      if "pixel_width" in v and "pixel_height" in v:
+        p["pixel_dimensions"] = f'{v["pixel_width"]}x{v["pixel_height"]}'
+        p["display_dimensions"] = (
+          f'{v.get("display_width", v["pixel_width"])}x{v.get("display_height", v["pixel_height"])}'
+        )
+      if "interlaced" in v:
+        p["interlaced"] = v["interlaced"] == 1
+    elif typ == "audio":
+      a = (t.get(AUDIO) or [{}])[0]
+      p["audio_sampling_frequency"] = int(a.get("audio_sampling_frequency", 8000.0))
+      p["audio_channels"] = a.get("audio_channels", 1)
+    tracks.append({"id": tid, "type": typ, "codec": codec, "properties": p})
+
+  atoms = []
+  for ed in found.get(CHAPTERS, []):
+    for a in flatten_atoms(ed.get(CHAPTERATOM, [])):
+      disp = (a.get(CHAPTERDISPLAY) or [{}])[0]
+      atoms.append(
+        {
+          "uid": str(a.get("uid", "")),
+          "time": a.get("time", 0) / 1000000000.0,
+          "hidden": str(a.get("hidden", 0)),
+          "enabled": str(a.get("enabled", 1)),
+          "name": disp.get("name"),
+          "lang": disp.get("lang", "eng"),
+        }
+      )
+
+  return {
+    "container": {"type": "Matroska", "recognized": True, "supported": True, "properties": props},
+    "tracks": tracks,
+    "chapters": [{"num_entries": len(atoms)}] if atoms else [],
+    "chapter_atoms": atoms,
+  }
@@ -0,0 +1,188 @@
+# Streaming progress parsing and display for external tools
+
+import codecs
+import logging
+import re
+import sys
+import threading
+import time
+
+from collections import deque
+from dataclasses import dataclass
+
+try:
+  import blessed
+except ImportError:
+  blessed = None
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+
+@dataclass(slots=True)
+class ProgressEvent:
+  job: str
+  tool: str
+  percent: float | None = None
+  frames: int | None = None
+  total: int | None = None
+  fps: float | None = None
+  bitrate: float | None = None
+  position: float | None = None
+  speed: float | None = None
+  eta: float | None = None
+
+
+# Anchored, so that the closing "encoded 1234 frames, ..." line is not progress.
+_x26x = re.compile(
+  r"^\s*(\[\s*(?P<percent>[\d.]+)%\]\s*)?(?P<frames>\d+)(/(?P<total>\d+))?\s+frames[,:]\s*"
+  r"(?P<fps>[\d.]+)\s+fps,\s*(?P<bitrate>[\d.]+)\s+kb/s(,\s*eta\s+(?P<eta>[\d:]+))?",
+  re.IGNORECASE,
+)
+_qaac = re.compile(
+  r"(\[\s*(?P<percent>[\d.]+)%\]\s*)?(?P<position>(\d+:)?\d+:[\d.]+)(/[\d:.]+)?\s*"
+  r"\((?P<speed>[\d.]+)x\)(,\s*ETA\s+(?P<eta>[\d:.]+))?",
+  re.IGNORECASE,
+)
+_percent = re.compile(r"(process|analyze|progress)\w*:\s*(?P<percent>[\d.]+)%", re.IGNORECASE)
+
+progress_patterns = {
+  "x264": _x26x,
+  "x265": _x26x,
+  "qaac": _qaac,
+  "qaac64": _qaac,
+  "eac3to": _percent,
+  "mkvextract": _percent,
+  "mkvmerge": _percent,
+  "dgindexnv": _percent,
+}
+
+
+def _seconds(s):
+  """Convert [[h:]m:]s[.fff] into seconds."""
+
+  t = 0.0
+  for part in s.split(":"):
+    t = t * 60.0 + float(part)
+  return t
+
+
+def parse_progress(job, tool, line):
+  """Return a ProgressEvent if line is a progress report of tool, else None."""
+
+  pat = progress_patterns.get(tool)
+  if pat is None or not (m := pat.search(line)):
+    return None
+  e = ProgressEvent(job, tool)
+  for k, v in m.groupdict().items():
+    if v is None:
+      continue
+    if k in ("frames", "total"):
+      setattr(e, k, int(v))
+    elif k in ("eta", "position"):
+      setattr(e, k, _seconds(v))
+    else:
+      setattr(e, k, float(v))
+  if e.percent is None and e.frames is not None and e.total:
+    e.percent = 100.0 * e.frames / e.total
+  return e
+
+
+class RingBuffer:
+  """Keep only the last maxlen lines of a tool's output."""
+
+  def __init__(self, maxlen=200):
+    self.lines = deque(maxlen=maxlen)
+    self.dropped = 0
+
+  def append(self, line):
+    if len(self.lines) == self.lines.maxlen:
+      self.dropped += 1
+    self.lines.append(line)
+
+  def text(self):
+    return "\n".join(self.lines)
+
+
+class LineSplitter:
+  """Split a byte stream into lines at either carriage returns or newlines."""
+
+  def __init__(self):
+    self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    self._buf = ""
+
+  def feed(self, data):
+    self._buf += self._decoder.decode(data, final=not data)
+    *lines, self._buf = re.split(r"\r\n|\r|\n", self._buf)
+    if not data and self._buf:
+      lines.append(self._buf)
+      self._buf = ""
+    return lines
+
+
+class ProgressBoard:
+  """A live, multi-job view of progress events.
+
+  Draws one status line per running job at the bottom of the terminal when
+  blessed is available and stderr is a terminal, and otherwise logs each job's
+  progress at most every interval seconds."""
+
+  def __init__(self, enabled=True, interval=60.0):
+    self.term = (
+      blessed.Terminal(stream=sys.stderr)
+      if enabled and blessed is not None and sys.stderr.isatty()
+      else None
+    )
+    self.interval = interval
+    self._jobs = {}
+    self._logged = {}
+    self._drawn = 0
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def format(e):
+    parts = [f"{e.job} [{e.tool}]"]
+    if e.percent is not None:
+      parts.append(f"{e.percent:5.1f}%")
+    if e.frames is not None:
+      parts.append(f"{e.frames}{'/' + str(e.total) if e.total else ''} frames")
+    if e.position is not None:
+      parts.append(unparse_time(e.position))
+    if e.fps is not None:
+      parts.append(f"{e.fps:.2f} fps")
+    if e.speed is not None:
+      parts.append(f"{e.speed:.1f}x")
+    if e.bitrate is not None:
+      parts.append(f"{e.bitrate:.0f} kb/s")
+    if e.eta is not None:
+      parts.append(f"ETA {unparse_time(e.eta)[:-4]}")
+    return " ".join(parts)
+
+  def update(self, e):
+    with self._lock:
+      self._jobs[e.job] = e
+      if self.term is not None:
+        self._draw()
+      elif time.monotonic() - self._logged.get(e.job, 0.0) >= self.interval:
+        self._logged[e.job] = time.monotonic()
+        log.info(self.format(e))
+
+  def finish(self, job):
+    with self._lock:
+      self._jobs.pop(job, None)
+      self._logged.pop(job, None)
+      if self.term is not None:
+        self._draw()
+
+  def _draw(self):
+    t = self.term
+    out = [t.move_up(self._drawn) if self._drawn else ""]
+    lines = [self.format(e)[: t.width - 1] for e in self._jobs.values()]
+    out += [f"\r{t.clear_eol}{line}\n" for line in lines]
+    out += [f"\r{t.clear_eol}\n"] * max(0, self._drawn - len(lines))
+    if self._drawn > len(lines):
+      out.append(t.move_up(self._drawn - len(lines)))
+    self._drawn = len(lines)
+    sys.stderr.write("".join(out))
+    sys.stderr.flush()
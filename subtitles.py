@@ -0,0 +1,312 @@
+# Streaming subtitle parsing, retiming, and TTXT output
+
+import array
+import bisect
+import json
+import logging
+import re
+import struct
+import sys
+
+from dataclasses import dataclass
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+
+@dataclass(slots=True)
+class Cue:
+  start: float
+  end: float
+  text: str
+
+
+def parse_timestamp(s):
+  """Parse [hh:]mm:ss[.,]fff (SRT, WebVTT) or h:mm:ss.cc (ASS) into seconds."""
+
+  t = 0.0
+  for part in s.strip().replace(",", ".").split(":"):
+    t = t * 60.0 + float(part)
+  return t
+
+
+_arrow = re.compile(r"\s*(\S+)\s+-->\s+(\S+)")
+_tags = re.compile(r"</?[^>]*>")
+_ass_overrides = re.compile(r"\{[^}]*\}")
+
+
+def parse_srt(lines):
+  """Yield the cues of the SubRip lines, one cue at a time, without markup."""
+
+  cue = None
+  for l in lines:
+    l = l.rstrip("\r\n").lstrip("\ufeff")
+    if cue is None:
+      if m := _arrow.match(l):
+        try:
+          cue = Cue(parse_timestamp(m[1]), parse_timestamp(m[2]), "")
+        except ValueError:
+          log.warning(f"Unrecognized subtitle timing: {l!r}")
+      elif l.strip() and not l.strip().isdigit():
+        log.warning(f"Unrecognized subtitle line: {l!r}")
+    elif l.strip():
+      l = _tags.sub("", l)
+      cue.text = f"{cue.text}\n{l}" if cue.text else l
+    else:
+      yield cue
+      cue = None
+  if cue is not None:
+    yield cue
+
+
+def parse_vtt(lines):
+  """Yield the cues of the WebVTT lines, without markup."""
+
+  block = []
+  for l in lines:
+    l = l.rstrip("\r\n").lstrip("\ufeff")
+    if l.strip():
+      block.append(l)
+      continue
+    yield from _vtt_block(block)
+    block = []
+  yield from _vtt_block(block)
+
+
+def _vtt_block(block):
+  for i, l in enumerate(block[:2]):
+    if m := _arrow.match(l):
+      text = "\n".join(_tags.sub("", b) for b in block[i + 1 :])
+      yield Cue(parse_timestamp(m[1]), parse_timestamp(m[2]), text)
+      return
+  # Header, NOTE, STYLE, and REGION blocks have no timing line.
+
+
+def parse_ass(lines):
+  """Yield the dialogue of the ASS or SSA lines, in order of start time."""
+
+  fmt = None
+  cues = []
+  section = None
+  for l in lines:
+    l = l.strip().lstrip("\ufeff")
+    if l.startswith("["):
+      section = l.casefold()
+    elif section != "[events]":
+      continue
+    elif l.startswith("Format:"):
+      fmt = [f.strip().casefold() for f in l[7:].split(",")]
+    elif l.startswith("Dialogue:") and fmt:
+      d = dict(zip(fmt, l[9:].split(",", len(fmt) - 1), strict=False))
+      text = _ass_overrides.sub("", d.get("text", ""))
+      text = text.replace("\\N", "\n").replace("\\n", "\n").replace("\\h", " ")
+      if text.strip():
+        cues.append(Cue(parse_timestamp(d["start"]), parse_timestamp(d["end"]), text))
+  # Events need not be in order, and overlapping ones are shown together.
+  cues.sort(key=lambda c: c.start)
+  yield from cues
+
+
+parsers = {
+  ".srt": parse_srt,
+  ".vtt": parse_vtt,
+  ".ass": parse_ass,
+  ".ssa": parse_ass,
+}
+
+
+def retime(cues, delay=0.0, elongation=1.0):
+  """Yield cues stretched by elongation and shifted by delay, dropping those ending before 0."""
+
+  for c in cues:
+    end = c.end * elongation + delay
+    if end <= 0:
+      continue
+    yield Cue(max(0.0, c.start * elongation + delay), end, c.text)
+
+
+def _ttxt_time(t):
+  ms = round(t * 1000.0)
+  return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def _sample(fp, t, text=""):
+  fp.write(f'<TextSample sampleTime="{_ttxt_time(t)}" xml:space="preserve">{escape(text)}</TextSample>\n')
+
+
+def write_ttxt(cues, fp, width=400, height=60, font="Serif", size=18):
+  """Write cues as a GPAC TTXT stream, ready to be muxed as mov_text.
+
+  Each cue starts a sample; an empty sample ends it unless the next cue starts
+  first, in which case that cue cuts it short."""
+
+  fp.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+  fp.write("<!-- GPAC 3GPP Text Stream -->\n")
+  fp.write('<TextStream version="1.1">\n')
+  fp.write(
+    f'<TextStreamHeader width="{width}" height="{height}" layer="0" translation_x="0" translation_y="0">\n'
+    '<TextSampleDescription horizontalJustification="center" verticalJustification="bottom"'
+    ' backColor="0 0 0 0" verticalText="no" fillTextRegion="no" continuousKaraoke="no" scroll="None">\n'
+    f"<FontTable>\n<FontTableEntry fontName={quoteattr(font)} fontID=\"1\"/>\n</FontTable>\n"
+    f'<TextBox top="0" left="0" bottom="{height}" right="{width}"/>\n'
+    f'<Style styles="Normal" fontID="1" fontSize="{size}" color="ff ff ff ff"/>\n'
+    "</TextSampleDescription>\n</TextStreamHeader>\n"
+  )
+  n = 0
+  prev = None
+  for c in cues:
+    if prev is not None:
+      if c.start < prev.start:
+        log.warning(f"Subtitle at {_ttxt_time(c.start)} out of order, moved to {_ttxt_time(prev.start)}.")
+        c.start = prev.start
+      if prev.end < c.start:
+        _sample(fp, prev.end)
+    elif c.start > 0:
+      _sample(fp, 0.0)
+    _sample(fp, c.start, c.text)
+    prev = c
+    n += 1
+  if prev is not None:
+    _sample(fp, max(prev.end, prev.start))
+  fp.write("</TextStream>\n")
+  return n
+
+
+def convert_subtitles(infile, outfile, delay=0.0, elongation=1.0, **kwargs):
+  """Convert SubRip, WebVTT, or ASS file infile into TTXT file outfile; return the number of cues."""
+
+  parse = parsers[infile.suffix.casefold()]
+  with open(infile, "rt", encoding="utf-8", errors="replace") as i, open(
+    outfile, "wt", encoding="utf-8"
+  ) as o:
+    return write_ttxt(retime(parse(i), delay, elongation), o, **kwargs)
+
+
+_idx_timestamp = re.compile(
+  r"\s*timestamp:\s*(\d+):(\d+):(\d+):(\d+),\s*filepos:\s*([0-9a-fA-F]+)\s*"
+)
+_idx_id = re.compile(r"\s*id\s*:\s*(\w+?)\s*,\s*index:\s*(\d+)\s*")
+
+
+class VobSubIndex:
+  """The subpicture timestamps and .sub file positions of a VobSub .idx.
+
+  Timestamps and positions are held in parallel arrays; all other lines are
+  kept verbatim, each with the number of subpictures that precede it.  The
+  index is saved as a binary sidecar next to the .idx."""
+
+  magic = b"VSI1"
+
+  def __init__(self, times=None, filepos=None, lines=None):
+    self.times = times if times is not None else array.array("d")
+    self.filepos = filepos if filepos is not None else array.array("Q")
+    self.lines = lines if lines is not None else []
+
+  def __len__(self):
+    return len(self.times)
+
+  @classmethod
+  def parse(cls, lines):
+    idx = cls()
+    for l in lines:
+      l = l.rstrip("\r\n").lstrip("\ufeff")
+      if m := _idx_timestamp.fullmatch(l):
+        h, mi, s, ms, pos = m.groups()
+        idx.times.append(int(h) * 3600.0 + int(mi) * 60.0 + int(s) + int(ms) / 1000.0)
+        idx.filepos.append(int(pos, 16))
+      else:
+        idx.lines.append((len(idx.times), l))
+    return idx
+
+  def languages(self):
+    """Return the (language, index) of each subtitle stream declared by the index."""
+
+    return [(m[1], int(m[2])) for _, l in self.lines if (m := _idx_id.fullmatch(l))]
+
+  def retimed(self, delay=0.0, elongation=1.0):
+    """Return a copy stretched by elongation and shifted by delay, dropping subpictures before 0."""
+
+    if np is None:
+      times = array.array("d", (t * elongation + delay for t in self.times))
+      keep = [i for i, t in enumerate(times) if t >= 0.0]
+      if len(keep) == len(times):
+        return VobSubIndex(times, array.array("Q", self.filepos), list(self.lines))
+      # Each line keeps its place among the surviving subpictures.
+      lines = [(bisect.bisect_left(keep, n), l) for n, l in self.lines]
+      return VobSubIndex(
+        array.array("d", (times[i] for i in keep)),
+        array.array("Q", (self.filepos[i] for i in keep)),
+        lines,
+      )
+
+    t = np.frombuffer(self.times, dtype="d") * elongation + delay
+    keep = np.flatnonzero(t >= 0.0)
+    places = np.searchsorted(keep, [n for n, _ in self.lines]).tolist()
+    times, filepos = array.array("d"), array.array("Q")
+    times.frombytes(t[keep].tobytes())
+    filepos.frombytes(np.frombuffer(self.filepos, dtype="Q")[keep].tobytes())
+    return VobSubIndex(times, filepos, [(p, l) for p, (_, l) in zip(places, self.lines, strict=True)])
+
+  def write(self, fp):
+    lines = iter(self.lines)
+    nxt = next(lines, None)
+    for i, (t, pos) in enumerate(zip(self.times, self.filepos, strict=True)):
+      while nxt is not None and nxt[0] <= i:
+        fp.write(nxt[1] + "\n")
+        nxt = next(lines, None)
+      ms = round(t * 1000.0)
+      fp.write(
+        f"timestamp: {ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}:{ms % 1000:03d}, filepos: {pos:09x}\n"
+      )
+    while nxt is not None:
+      fp.write(nxt[1] + "\n")
+      nxt = next(lines, None)
+
+  def save(self, path):
+    header = json.dumps(self.lines).encode()
+    times, filepos = array.array("d", self.times), array.array("Q", self.filepos)
+    if sys.byteorder != "little":
+      times.byteswap()
+      filepos.byteswap()
+    with open(path, "wb") as fp:
+      fp.write(self.magic + struct.pack("<QQ", len(times), len(header)))
+      fp.write(header)
+      times.tofile(fp)
+      filepos.tofile(fp)
+
+  @classmethod
+  def load(cls, path):
+    with open(path, "rb") as fp:
+      if fp.read(4) != cls.magic:
+        raise ValueError(f"{path} is not a VobSub index sidecar")
+      n, hlen = struct.unpack("<QQ", fp.read(16))
+      lines = [tuple(l) for l in json.loads(fp.read(hlen))]
+      idx = cls(lines=lines)
+      idx.times.fromfile(fp, n)
+      idx.filepos.fromfile(fp, n)
+    if sys.byteorder != "little":
+      idx.times.byteswap()
+      idx.filepos.byteswap()
+    return idx
+
+  @classmethod
+  def for_file(cls, idxfile):
+    """Return the index of idxfile, from its sidecar if that is up to date."""
+
+    sidecar = idxfile.with_suffix(".vsi")
+    try:
+      if sidecar.stat().st_mtime_ns >= idxfile.stat().st_mtime_ns:
+        return cls.load(sidecar)
+    except (OSError, ValueError, EOFError):
+      pass
+    with open(idxfile, "rt", encoding="utf-8", errors="replace") as fp:
+      idx = cls.parse(fp)
+    idx.save(sidecar)
+    return idx
@@ -0,0 +1,6 @@
+# The modules under test live at the top of the repository.
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
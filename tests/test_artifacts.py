@@ -0,0 +1,34 @@
+import os
+
+from artifacts import ProbeCache
+
+
+def test_probe_cache(tmp_path):
+  src = tmp_path / "a.mkv"
+  src.write_bytes(b"mkv")
+  cache = ProbeCache(tmp_path / "probes.db")
+  calls = []
+  assert cache.probe(src, "native", lambda: calls.append(1) or {"tracks": [1, 2]}) == {"tracks": [1, 2]}
+  assert cache.probe(src, "native", lambda: calls.append(1)) == {"tracks": [1, 2]}
+  assert cache.get(src, "mkvmerge") is None
+  assert calls == [1] and (cache.hits, cache.misses) == (1, 2)
+  src.write_bytes(b"mkv, remuxed")
+  assert cache.get(src, "native") is None
+
+
+def test_probe_cache_evicts_by_running_total(tmp_path):
+  cache = ProbeCache(tmp_path / "probes.db", max_bytes=4000)
+  sums = []
+  cache._db.set_trace_callback(lambda sql: "SUM(" in sql and sums.append(sql))
+  files = []
+  for i in range(60):
+    f = tmp_path / f"{i}.mkv"
+    f.write_bytes(b"x" * i)
+    files.append(f)
+    cache.put(f, "native", [str(i), os.urandom(100).hex()])
+  (total,) = cache._db.execute("SELECT SUM(LENGTH(data)) FROM probes").fetchone()
+  assert total <= 4000 and cache._total == total
+  # The sizes are summed once, and again only each time the cache fills up.
+  assert len(sums) < 15
+  assert cache.get(files[-1], "native")[0] == "59"
+  assert cache.get(files[0], "native") is None
@@ -0,0 +1,48 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from cropdetect import CropDetector  # noqa: E402
+
+
+def frame(w, h, left=0, right=0, top=0, bottom=0, luma=128):
+  y = np.zeros((h, w), dtype=np.uint8)
+  y[top : h - bottom, left : w - right] = luma
+  return b"FRAME\n" + y.tobytes() + bytes(2 * (w // 2) * (h // 2))
+
+
+def detect(frames, w=64, h=48, chunk=1000):
+  data = f"YUV4MPEG2 W{w} H{h} F25:1 Ip A1:1 C420jpeg\n".encode() + b"".join(frames)
+  d = CropDetector()
+  for i in range(0, len(data), chunk):
+    d(data[i : i + chunk])
+  assert d.result() is None
+  d(b"")
+  return d.result()
+
+
+def test_letterbox():
+  frames = [frame(64, 48, top=7, bottom=6), frame(64, 48, left=3, top=8, bottom=8)]
+  assert detect(frames) == ((0, 0, 6, 6), False)
+
+
+def test_black_frames_are_ignored():
+  frames = [frame(64, 48, luma=0), frame(64, 48, top=4, bottom=4), frame(64, 48, left=25, right=25, top=4, bottom=4)]
+  assert detect(frames, chunk=333) == ((0, 0, 4, 4), False)
+  assert detect([frame(64, 48, luma=0)]) is None
+
+
+def test_varying_aspect_ratio():
+  frames = [frame(64, 48, top=6, bottom=6)] * 3 + [frame(64, 48, left=8, right=8)] * 3
+  assert detect(frames) == ((0, 0, 0, 0), True)
+
+
+def test_bad_stream():
+  with pytest.raises(ValueError):
+    CropDetector()(b"RIFF\0\0\0\0AVI LIST\n")
+  with pytest.raises(ValueError):
+    CropDetector()(b"")
+  d = CropDetector()
+  d(b"YUV4MPEG2 W4 H2\n")
+  with pytest.raises(ValueError):
+    d(b"FRAMX\n" + bytes(12))
@@ -0,0 +1,52 @@
+import time
+
+from jobqueue import FileJobQueue, Heartbeat
+
+
+def test_claim_complete_result(tmp_path):
+  q = FileJobQueue(tmp_path, lease=60.0)
+  jid = q.submit({"stage": "audio"})
+  assert q.claim("w1") == (jid, {"stage": "audio"})
+  assert q.claim("w2") is None
+  assert q.result(jid) is None
+  q.complete(jid, {"result": True})
+  assert q.result(jid) == {"result": True}
+  assert q.result(jid) is None
+
+
+def test_expired_lease_is_reclaimed_and_lost(tmp_path):
+  q = FileJobQueue(tmp_path, lease=0.05)
+  jid = q.submit({})
+  q.claim("w1")
+  time.sleep(0.1)
+  assert q.claim("w2")[0] == jid
+  assert not q.heartbeat(jid, "w1")
+  assert q.heartbeat(jid, "w2")
+
+
+def test_heartbeat_notices_lost_lease(tmp_path):
+  q = FileJobQueue(tmp_path, lease=0.05)
+  jid = q.submit({})
+  q.claim("w1")
+  with Heartbeat(q, jid, "w1", 60.0) as hb:
+    time.sleep(0.1)
+    q.claim("w2")
+  assert hb.lost.is_set()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+  q = FileJobQueue(tmp_path, lease=0.2)
+  jid = q.submit({})
+  q.claim("w1")
+  with Heartbeat(q, jid, "w1", 0.05) as hb:
+    time.sleep(0.4)
+    assert q.claim("w2") is None
+  assert not hb.lost.is_set()
+
+
+def test_relative_root_survives_chdir(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  q = FileJobQueue("queue")
+  monkeypatch.chdir("/")
+  jid = q.submit({})
+  assert q.claim("w1")[0] == jid
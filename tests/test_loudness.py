@@ -0,0 +1,86 @@
+import math
+import struct
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from loudness import LoudnessMeter, normalization_gain  # noqa: E402
+
+
+def wav(x, rate=48000, bits=16, fmt=1):
+  """Return a WAV of the samples x, a frames by channels array in [-1, 1)."""
+
+  if fmt == 3:
+    data = x.astype("<f4").tobytes()
+  elif bits == 24:
+    v = np.round(x * (1 << 23)).astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3]
+    data = v.tobytes()
+  else:
+    data = np.round(x * (1 << 15)).astype("<i2").tobytes()
+  channels = x.shape[1]
+  align = channels * bits // 8
+  fmtchunk = struct.pack("<HHIIHH", fmt, channels, rate, rate * align, align, bits)
+  return (
+    b"RIFF" + struct.pack("<I", 4 + 8 + len(fmtchunk) + 8 + len(data)) + b"WAVE"
+    + b"fmt " + struct.pack("<I", len(fmtchunk)) + fmtchunk
+    + b"data" + struct.pack("<I", len(data)) + data
+  )
+
+
+def measure(data, chunk=1 << 16):
+  m = LoudnessMeter()
+  for i in range(0, len(data), chunk):
+    m(data[i : i + chunk])
+  m(b"")
+  return m.result()
+
+
+def sine(freq, amp, seconds=5.0, rate=48000, channels=2, phase=0.0):
+  t = np.arange(int(seconds * rate)) / rate
+  return np.repeat((amp * np.sin(2 * math.pi * freq * t + phase))[:, None], channels, axis=1)
+
+
+def test_reference_sine():
+  # A 1 kHz sine peaking at 0 dBFS in one channel measures -3.01 LUFS.
+  x = sine(1000.0, 0.1)
+  r = measure(wav(x))
+  assert r["integrated"] == pytest.approx(-20.0, abs=0.05)
+  x[:, 1] = 0.0
+  assert measure(wav(x))["integrated"] == pytest.approx(-23.01, abs=0.05)
+  assert r["sample_peak"] == pytest.approx(-20.0, abs=0.05)
+  assert r["true_peak"] == pytest.approx(-20.0, abs=0.05)
+  assert r["lra"] == pytest.approx(0.0, abs=0.1)
+
+
+def test_formats_and_chunking_agree():
+  x = sine(440.0, 0.25, seconds=4.0, channels=6)
+  r16 = measure(wav(x), chunk=1001)
+  assert measure(wav(x, bits=24), chunk=7) == pytest.approx(r16, abs=0.02)
+  assert measure(wav(x, bits=32, fmt=3)) == pytest.approx(r16, abs=0.02)
+
+
+def test_true_peak_between_samples():
+  # A quarter-rate sine sampled 45 degrees off its peaks overshoots them by 3 dB.
+  r = measure(wav(sine(12000.0, 0.5, seconds=2.0, phase=math.pi / 4)))
+  assert r["sample_peak"] == pytest.approx(20 * math.log10(0.5 / math.sqrt(2)), abs=0.05)
+  assert r["true_peak"] == pytest.approx(20 * math.log10(0.5), abs=0.1)
+
+
+def test_silence_has_no_loudness():
+  r = measure(wav(np.zeros((48000, 2))))
+  assert r == {"integrated": None, "lra": None, "true_peak": None, "sample_peak": None}
+
+
+def test_not_wav():
+  with pytest.raises(ValueError):
+    LoudnessMeter()(b"RIFF\0\0\0\0AVI LIST")
+
+
+def test_normalization_gain():
+  loud = {"integrated": -30.0, "true_peak": -4.0, "sample_peak": -5.0}
+  assert normalization_gain(loud) == 5.0
+  assert normalization_gain(loud, true_peak=-1.0) == 3.0
+  assert normalization_gain(loud, target=-33.0) == -3.0
+  assert normalization_gain(loud, target=-23.0, true_peak=-1.0) == 3.0
+  assert normalization_gain(None) == 0.0
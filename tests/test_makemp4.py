@@ -0,0 +1,223 @@
+import argparse
+import pathlib
+import re
+import struct
+
+import pytest
+
+makemp4 = pytest.importorskip("makemp4")
+
+
+@pytest.fixture
+def args(monkeypatch):
+  a = argparse.Namespace(video_chunks=4, cpu_budget=8)
+  monkeypatch.setattr(makemp4, "args", a)
+  return a
+
+
+def test_chunk_ranges_cover_all_frames():
+  ranges = makemp4.chunk_ranges(10000, 4, 25.0)
+  assert ranges[0][0] == 0 and ranges[-1][1] == 9999
+  assert all(a[1] + 1 == b[0] for a, b in zip(ranges, ranges[1:], strict=False))
+  assert len(ranges) == 4
+
+
+def test_chunk_ranges_snap_to_chapters():
+  ranges = makemp4.chunk_ranges(10000, 2, 25.0, chapters=[190.0])
+  assert ranges == [(0, 4749), (4750, 9999)]
+
+
+def test_chunk_ranges_are_at_least_ten_seconds():
+  assert len(makemp4.chunk_ranges(600, 8, 25.0)) == 2
+  assert makemp4.chunk_ranges(100, 8, 25.0) == [(0, 99)]
+
+
+def test_write_qpfile_renumbers_within_chunk(tmp_path):
+  fn = tmp_path / "a.qp"
+  makemp4.write_qpfile([100, 250, 400], fn, 200, 399)
+  assert fn.read_text() == "50 I -1\n"
+
+
+def chunked_track():
+  cfg = makemp4.Title(base="Movie")
+  track = cfg.add_track(
+    makemp4.Track(id=0, type="video", frames=10000, frame_rate_ratio=25.0, frame_rate_ratio_out=25.0, outformat="h264")
+  )
+  return cfg, track
+
+
+def encode_chunks(tmp_path):
+  cfg, track = chunked_track()
+  avsfile, outfile = tmp_path / "Movie.avs", tmp_path / "Movie T00.264"
+  call = ["avs2pipemod", "-y4mp", avsfile, "|", "x264", "--output", outfile]
+  return makemp4.encode_video_chunks(cfg, track, ["Source()", "Distributor()"], avsfile, call, outfile)
+
+
+def test_chunks_are_joined(tmp_path, args, monkeypatch):
+  async def encode(cargs, outfile=None, infile=None):
+    m = re.search(r"Trim\((\d+),(\d+)\)", pathlib.Path(cargs[2]).read_text())
+    outfile.write_bytes(outfile.suffixes[-2].encode())
+    return f"encoded {int(m[2]) - int(m[1]) + 1} frames"
+
+  monkeypatch.setattr(makemp4, "do_call_async", encode)
+  assert encode_chunks(tmp_path) == 10000
+  assert [p.name for p in tmp_path.iterdir()] == ["Movie T00.264"]
+  assert (tmp_path / "Movie T00.264").read_bytes() == b".c00.c01.c02.c03"
+
+
+def test_failed_chunks_are_cleaned_up(tmp_path, args, monkeypatch):
+  async def fail(cargs, outfile=None, infile=None):
+    makemp4.spoil(outfile)
+    return "x264 [error]: could not open input file"
+
+  monkeypatch.setattr(makemp4, "do_call_async", fail)
+  assert encode_chunks(tmp_path) is None
+  assert list(tmp_path.iterdir()) == []
+
+
+def test_chunked_encode_skips_locked_outfile(tmp_path, args, monkeypatch):
+  monkeypatch.setattr(makemp4, "do_call_async", None)
+  chunk = tmp_path / "Movie T00.c00.264"
+  chunk.write_bytes(b"another process's chunk")
+  with makemp4.WorkLock(tmp_path / "Movie T00.264") as locked:
+    assert locked
+    assert encode_chunks(tmp_path) is None
+  assert sorted(p.name for p in tmp_path.iterdir()) == [chunk.name]
+
+
+def test_failed_mediainfo_batch_falls_back(args, monkeypatch):
+  args.avi_all_fields = False
+
+  def batch(files):
+    if len(files) > 1:
+      raise makemp4.ET.ParseError("junk after document element")
+    return {files[0]: [("General", {})]}
+
+  monkeypatch.setattr(makemp4, "mediainfo_batch", batch)
+  monkeypatch.setattr(makemp4, "probe_cache", None)
+  a, b = makemp4.pathlib.Path("a.avi"), makemp4.pathlib.Path("b.avi")
+  makemp4.prefetch_mediainfo([a, b])
+  assert makemp4.mediainfo_tracks(b) == [("General", {})]
+
+
+def test_avi_codecs_by_format_and_profile(args, monkeypatch):
+  args.avi_all_fields = False
+  args.stream_audio = False
+  avi = [
+    ("General", {"Format": "AVI"}),
+    ("Video", {"Format": "MPEG-4 Visual", "Format_Profile": "Advanced Simple@L5"}),
+    ("Audio", {"Format": "MPEG Audio", "Format_Profile": "Layer 3"}),
+    ("Audio", {"Format": "MPEG Audio", "Format_Profile": "Layer 2"}),
+    ("Audio", {"Format": "AC-3"}),
+  ]
+  monkeypatch.setattr(makemp4, "cached_probe", lambda *a: avi)
+  cfg = makemp4.Title(base="Movie")
+  makemp4.prepare_avi(cfg, makemp4.pathlib.Path("Movie.avi"))
+  assert [(t.format, t.disable) for t in cfg.tracks] == [
+    ("MPEG-4 Visual", None),
+    ("MPEG Audio Layer 3", None),
+    ("MPEG Audio Layer 2", None),
+    ("AC-3", None),
+  ]
+  assert [makemp4.find_codec(t.format)[0] for t in cfg.tracks] == ["MPEG-4 Visual", "MP3", "MP2", "AC-3"]
+
+
+def test_normalized_outputs_are_encoded_from_one_decode(tmp_path, args, monkeypatch):
+  np = pytest.importorskip("numpy")
+  args.loudness_target = None
+  args.true_peak = None
+  monkeypatch.chdir(tmp_path)
+  src = tmp_path / "Movie T01.dts"
+  src.write_bytes(b"dts")
+  t = np.arange(48000 * 3) / 48000
+  pcm = (np.repeat((0.1 * np.sin(2 * np.pi * 1000 * t))[:, None], 2, axis=1) * (1 << 15)).astype("<i2").tobytes()
+  fmt = struct.pack("<HHIIHH", 1, 2, 48000, 192000, 4, 16)
+  wav = b"RIFF" + struct.pack("<I", 36 + len(pcm)) + b"WAVEfmt " + struct.pack("<I", 16) + fmt + b"data" + struct.pack("<I", len(pcm)) + pcm
+  decodes, spooled = [], []
+
+  async def tee(decode, encodes, taps=(), job=None):
+    decodes.append([str(e[1]) for e in encodes])
+    for tap in taps:
+      tap(wav)
+      tap(b"")
+    for _, outfile in encodes:
+      outfile.write_bytes(b"m4a")
+    return ["wrote 3.0 seconds"] * len(encodes)
+
+  async def call(cargs, outfile=None, infile=None):
+    spooled.append((outfile.name, infile.read() == wav, [str(c) for c in cargs]))
+    outfile.write_bytes(b"m4a")
+    return "wrote 3.0 seconds"
+
+  monkeypatch.setattr(makemp4, "tee_call_async", tee)
+  monkeypatch.setattr(makemp4, "do_call_async", call)
+  cfg = makemp4.Title(base="Movie")
+  track = cfg.add_track(
+    makemp4.Track(id=1, type="audio", file=src, extension="dts", outputs=[{"downmix": 2}, {"normalize": True}])
+  )
+  assert makemp4.build_audio_outputs(cfg, track)
+  assert decodes == [["Movie T01.0.m4a"]]
+  assert [(o, same) for o, same, _ in spooled] == [("Movie T01.1.m4a", True)]
+  assert "+20.00" in spooled[0][2]
+  assert sorted(p.name for p in tmp_path.iterdir()) == ["Movie T01.0.m4a", "Movie T01.1.m4a", "Movie T01.dts"]
+
+
+def test_work_lock_delete(tmp_path, args, monkeypatch):
+  args.outdir = tmp_path
+  dead, done = tmp_path / "a.m4a", tmp_path / "b.m4a"
+  dead.write_bytes(b"partial")
+  dead.with_suffix(".m4a.working").write_text('{"pid": 1, "host": "gone", "heartbeat": 0.0}')
+  done.write_bytes(b"complete")
+  # b's owner finished between the glob and the takeover.
+  monkeypatch.setattr(
+    makemp4.pathlib.Path, "glob", lambda self, pattern: [dead.with_suffix(".m4a.working"), done.with_suffix(".m4a.working")]
+  )
+  makemp4.work_lock_delete()
+  assert sorted(p.name for p in tmp_path.iterdir()) == ["b.m4a"]
+
+
+def test_indexing_elsewhere_is_left_alone(tmp_path, args, monkeypatch):
+  async def locked(cargs, outfile=None, infile=None):
+    outfile.write_bytes(b"another process's index")
+    return None
+
+  monkeypatch.setattr(makemp4, "do_call_async", locked)
+  src = tmp_path / "Movie.mkv"
+  src.write_bytes(b"mkv")
+  track = makemp4.Track(id=0, type="video", file=src, dgifile=tmp_path / "Movie.dgi")
+  assert not makemp4.build_indices(makemp4.Title(base="Movie"), track)
+  assert track["dgifile"].read_bytes() == b"another process's index"
+
+
+def test_indexes_are_cached(tmp_path, args, monkeypatch):
+  monkeypatch.setattr(makemp4, "artifacts", makemp4.ArtifactStore(tmp_path / "cache", 1 << 30))
+  runs = []
+
+  async def index(cargs, outfile=None, infile=None):
+    runs.append(outfile)
+    outfile.write_text("DGAVCIndexFileNV16\n\nsource\n\nCLIP 0 0 0 0\n\nSIZ 1920 x 1080\nORDER 0\nFPS 24000 / 1001\n")
+    (tmp_path / "Movie.log").write_text("Info: Finished!\nSAR: 1:1\n")
+    return ""
+
+  monkeypatch.setattr(makemp4, "do_call_async", index)
+  src = tmp_path / "Movie.mkv"
+  src.write_bytes(b"mkv")
+  dgifile = tmp_path / "Movie.dgi"
+  makemp4.build_indices(makemp4.Title(base="Movie"), makemp4.Track(id=0, type="video", file=src, dgifile=dgifile))
+  made = dgifile.read_text()
+  dgifile.unlink()
+  track = makemp4.Track(id=0, type="video", file=src, dgifile=dgifile)
+  makemp4.build_indices(makemp4.Title(base="Movie"), track)
+  assert runs == [dgifile]
+  assert dgifile.read_text() == made
+  assert track["dg"]["info"] == "Finished!" and track["dg"]["sar"] == "1:1"
+  assert not (tmp_path / "Movie.log").exists()
+
+
+@pytest.mark.parametrize("cid", ["V_MPEG4/ISO/SP", "V_MPEG4/ISO/ASP", "V_MPEG4/ISO/AP"])
+def test_mkv_mpeg4_part2_is_extracted(cid):
+  cfg = makemp4.Title(base="Movie")
+  track = cfg.add_track(makemp4.Track(id=0, type="video", format=makemp4.codec_names[cid]))
+  makemp4.apply_codec(cfg, track, makemp4.pathlib.Path("Movie.mkv"), set(), extract=True)
+  assert not track["disable"]
+  assert (track["extension"], str(track["file"])) == ("avi", "Movie T00.avi")
@@ -0,0 +1,75 @@
+import struct
+
+from mkvprobe import dts_substream_sync, dts_xll_sync, probe_mkv
+
+
+def size(n):
+  return b"\x01" + n.to_bytes(7, "big")
+
+
+def el(eid, data):
+  return eid.to_bytes((eid.bit_length() + 7) // 8, "big") + size(len(data)) + data
+
+
+def uint(eid, v):
+  return el(eid, v.to_bytes(max(1, (v.bit_length() + 7) // 8), "big"))
+
+
+def track(number, codec, typ=2):
+  return el(0xAE, uint(0xD7, number) + uint(0x83, typ) + el(0x86, codec.encode()))
+
+
+def block(number, payload):
+  return el(0xA3, bytes([0x80 | number]) + b"\0\0\x80" + payload)
+
+
+def write_mkv(path, tracks, blocks, unknown_cluster=False):
+  info = el(0x1549A966, uint(0x2AD7B1, 1000000) + el(0x4489, struct.pack(">d", 5000.0)))
+  cluster_data = uint(0xE7, 0) + b"".join(blocks)
+  if unknown_cluster:
+    cluster = bytes.fromhex("1F43B675") + b"\x01\xff\xff\xff\xff\xff\xff\xff" + cluster_data
+  else:
+    cluster = el(0x1F43B675, cluster_data)
+  segment = info + el(0x1654AE6B, b"".join(tracks)) + cluster
+  path.write_bytes(el(0x1A45DFA3, el(0x4282, b"matroska")) + el(0x18538067, segment))
+
+
+def codecs(path):
+  return [t["codec"] for t in probe_mkv(path)["tracks"]]
+
+
+def test_headers(tmp_path):
+  p = tmp_path / "a.mkv"
+  write_mkv(p, [track(1, "V_MPEG4/ISO/AVC", 1), track(2, "V_MPEG4/ISO/ASP", 1), track(3, "A_AC3")], [])
+  j = probe_mkv(p)
+  assert j["container"]["properties"]["duration"] == 5000000000
+  assert [t["type"] for t in j["tracks"]] == ["video", "video", "audio"]
+  assert codecs(p) == ["AVC/H.264/MPEG-4p10", "MPEG-4p2", "AC-3"]
+
+
+def test_dts_kinds_from_first_frames(tmp_path):
+  p = tmp_path / "a.mkv"
+  core = b"\x7f\xfe\x80\x01" + bytes(60)
+  write_mkv(
+    p,
+    [track(1, "A_DTS"), track(2, "A_DTS"), track(3, "A_DTS")],
+    [
+      block(1, core + dts_substream_sync + bytes(16) + dts_xll_sync),
+      block(2, core + dts_substream_sync + bytes(16)),
+      block(3, core),
+      block(1, core),
+    ],
+  )
+  assert codecs(p) == ["DTS-HD Master Audio", "DTS-HD High Resolution Audio", "DTS"]
+
+
+def test_dts_in_cluster_of_unknown_size(tmp_path):
+  p = tmp_path / "a.mkv"
+  write_mkv(p, [track(1, "A_DTS")], [block(1, dts_substream_sync + dts_xll_sync)], unknown_cluster=True)
+  assert codecs(p) == ["DTS-HD Master Audio"]
+
+
+def test_dts_without_clusters(tmp_path):
+  p = tmp_path / "a.mkv"
+  write_mkv(p, [track(1, "A_DTS")], [])
+  assert codecs(p) == ["DTS"]
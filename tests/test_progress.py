@@ -0,0 +1,74 @@
+from progress import LineSplitter, RingBuffer, parse_progress
+
+x264_output = (
+  b"y4m [info]: 1920x1080p 1:1 @ 24000/1001 fps (cfr)\n"
+  b"[12.5%] 125/1000 frames, 23.45 fps, 1234.56 kb/s, eta 0:00:37\r"
+  b"[25.0%] 250/1000 frames, 24.00 fps, 1200.00 kb/s, eta 0:00:31\r"
+  b"\n"
+  b"x264 [info]: frame I:10    Avg QP:18.00  size: 50000\n"
+  b"encoded 1000 frames, 24.10 fps, 1210.00 kb/s\n"
+)
+
+
+def drain(data, tool):
+  """Split data into lines the way makemp4's drain does."""
+
+  events = []
+  buf = RingBuffer(10)
+  sp = LineSplitter()
+  for chunk in (data[:50], data[50:], b""):
+    for line in sp.feed(chunk):
+      if (e := parse_progress("job", tool, line)) is not None:
+        events.append(e)
+      elif line.strip():
+        buf.append(line)
+  return events, buf.text()
+
+
+def test_x264_progress_and_summary():
+  events, text = drain(x264_output, "x264")
+  assert [(e.frames, e.total, e.percent) for e in events] == [(125, 1000, 12.5), (250, 1000, 25.0)]
+  assert events[0].fps == 23.45 and events[0].bitrate == 1234.56 and events[0].eta == 37.0
+  assert "encoded 1000 frames, 24.10 fps, 1210.00 kb/s" in text.splitlines()
+  assert "x264 [info]: frame I:10    Avg QP:18.00  size: 50000" in text.splitlines()
+
+
+def test_x264_progress_without_total():
+  e = parse_progress("job", "x264", "125 frames: 23.45 fps, 1234.56 kb/s")
+  assert (e.frames, e.total, e.percent) == (125, None, None)
+
+
+def test_x264_summary_is_not_progress():
+  assert parse_progress("job", "x264", "encoded 1000 frames, 24.10 fps, 1210.00 kb/s") is None
+  assert parse_progress("job", "x265", "encoded 1000 frames in 41.50s (24.10 fps), 1210.00 kb/s, Avg QP:20.1") is None
+
+
+def test_qaac_progress():
+  e = parse_progress("job", "qaac64", "[50.0%] 0:30.000/1:00.000 (20.5x), ETA 0:01.500")
+  assert (e.percent, e.position, e.speed) == (50.0, 30.0, 20.5)
+  assert parse_progress("job", "qaac64", "wrote 60.0 seconds") is None
+
+
+def test_percent_progress():
+  assert parse_progress("job", "mkvmerge", "Progress: 42%").percent == 42.0
+  assert parse_progress("job", "unknown", "Progress: 42%") is None
+
+
+def test_ring_buffer_keeps_last_lines():
+  buf = RingBuffer(2)
+  for line in ("a", "b", "c"):
+    buf.append(line)
+  assert buf.text() == "b\nc" and buf.dropped == 1
+
+
+def test_line_splitter_handles_split_utf8_and_crlf():
+  sp = LineSplitter()
+  data = "é1\r\né2\rlast".encode()
+  assert sp.feed(data[:1]) == []
+  assert sp.feed(data[1:]) == ["é1", "é2"]
+  assert sp.feed(b"") == ["last"]
+
+
+def test_qaac_progress_over_an_hour():
+  e = parse_progress("job", "qaac", "[10.0%] 1:02:03.500/10:20:35.000 (30.0x)")
+  assert e.position == 3723.5
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from cetools import StageScheduler
+
+
+def test_dependencies_run_in_order():
+  s = StageScheduler({"cpu": 4, "io": 1})
+  order = []
+  s.add("mux", order.append, "mux", deps=("video", "audio"), lane="io")
+  s.add("video", order.append, "video", deps=("prepare",))
+  s.add("audio", order.append, "audio", deps=("prepare",))
+  s.add("prepare", order.append, "prepare", lane="io")
+  assert s.run()
+  assert order[0] == "prepare" and order[-1] == "mux"
+  assert set(order[1:3]) == {"video", "audio"}
+
+
+def test_failure_skips_dependents():
+  s = StageScheduler({"cpu": 2})
+  ran = []
+
+  def fail():
+    raise RuntimeError("broken")
+
+  s.add("a", fail)
+  s.add("b", ran.append, "b", deps=("a",))
+  s.add("c", ran.append, "c", deps=("b",))
+  s.add("d", ran.append, "d")
+  assert not s.run()
+  assert ran == ["d"]
+
+
+def test_unknown_dependency_fails():
+  s = StageScheduler({"cpu": 1})
+  s.add("a", lambda: None, deps=("missing",))
+  assert not s.run()
+
+
+def test_stages_added_by_stages():
+  s = StageScheduler({"cpu": 2})
+  ran = []
+
+  def first():
+    ran.append("first")
+    s.add("second", ran.append, "second", deps=("first",))
+
+  s.add("first", first)
+  assert s.run()
+  assert ran == ["first", "second"]
+
+
+def test_budget_limits_and_backfills():
+  s = StageScheduler({"cpu": 8}, budget=4)
+  lock = threading.Lock()
+  used = [0, 0]
+  started = []
+
+  def stage(name, cost):
+    with lock:
+      started.append(name)
+      used[0] += cost
+      used[1] = max(used[1], used[0])
+    time.sleep(0.05)
+    with lock:
+      used[0] -= cost
+
+  s.add("big1", stage, "big1", 3, cost=3)
+  s.add("big2", stage, "big2", 3, cost=3)
+  s.add("small", stage, "small", 1, cost=1)
+  s.add("huge", stage, "huge", 4, cost=10)
+  assert s.run()
+  assert used[1] <= 4
+  # small fits beside big1, so it starts ahead of big2.
+  assert started.index("small") < started.index("big2")
+
+
+def test_reserve_holds_back_later_stages():
+  s = StageScheduler({"cpu": 8}, budget=4)
+  started = []
+  gate = threading.Event()
+
+  def stage(name):
+    started.append(name)
+    if name == "audio1":
+      gate.wait(1.0)
+
+  s.add("audio1", stage, "audio1", cost=2)
+  s.add("video", stage, "video", cost=4, reserve=True)
+  s.add("audio2", stage, "audio2", cost=2)
+  gate.set()
+  assert s.run()
+  assert started == ["audio1", "video", "audio2"]
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from cetools import SourceWatcher
+
+
+class Silent:
+  """An inotify stand-in that never reports an event, as for writes over NFS."""
+
+  def read(self, timeout):
+    time.sleep(timeout)
+    return []
+
+
+def test_settled_file_is_returned_once(tmp_path):
+  p = tmp_path / "a.mkv"
+  p.write_bytes(b"x" * 10)
+  w = SourceWatcher([tmp_path], settle=0.05, interval=0.01, backend="poll")
+  assert w.wait() == [p]
+  w._scan()
+  assert not w.pending and w.ripe() == []
+
+
+def test_changed_file_is_quarantined_again(tmp_path):
+  p = tmp_path / "a.mkv"
+  p.write_bytes(b"x")
+  w = SourceWatcher([tmp_path], settle=0.05, interval=0.01, backend="poll")
+  assert w.wait() == [p]
+  p.write_bytes(b"xx")
+  w._scan()
+  assert w.ripe() == []
+  assert w.wait() == [p]
+
+
+def test_scans_without_events(tmp_path):
+  w = SourceWatcher([tmp_path], settle=0.05, interval=0.02, backend="poll", rescan=0.02)
+  w.notify = Silent()
+  p = tmp_path / "b.avi"
+  p.write_bytes(b"x" * 10)
+  assert w.wait() == [p]
+
+
+def test_requeue(tmp_path):
+  p = tmp_path / "a.mkv"
+  p.write_bytes(b"x")
+  w = SourceWatcher([tmp_path], settle=0.05, interval=0.01, backend="poll")
+  assert w.wait() == [p]
+  w.requeue([p, tmp_path / "gone.mkv"])
+  assert w.ripe() == []
+  assert w.wait() == [p]
+
+
+def test_requeue_backs_off_and_gives_up(tmp_path):
+  p = tmp_path / "a.mkv"
+  p.write_bytes(b"x")
+  w = SourceWatcher([tmp_path], settle=0.05, interval=0.01, backend="poll", retries=2)
+  assert w.wait() == [p]
+  w.requeue([p])
+  _, since = w.pending[p]
+  assert since - time.time() == pytest.approx(0.05, abs=0.02)
+  assert w.wait() == [p]
+  w.requeue([p])
+  _, since = w.pending[p]
+  assert since - time.time() == pytest.approx(0.15, abs=0.02)
+  assert w.wait() == [p]
+  w.requeue([p])
+  assert not w.pending
+  # A change starts over.
+  p.write_bytes(b"xx")
+  assert w.wait() == [p]
+  w.requeue([p])
+  assert p in w.pending
+
+
+def test_inotify_finds_files_without_scans(tmp_path, monkeypatch):
+  try:
+    w = SourceWatcher([tmp_path], settle=0.05, interval=0.01, backend="inotify")
+  except OSError:
+    pytest.skip("inotify is unavailable")
+  scans = []
+  monkeypatch.setattr(w, "_scan", lambda initial=False: scans.append(initial))
+  p = tmp_path / "a.mkv"
+  p.write_bytes(b"x" * 10)
+  assert w.wait() == [p]
+  assert scans == []
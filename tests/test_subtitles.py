@@ -0,0 +1,147 @@
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import subtitles
+from subtitles import (
+  Cue,
+  VobSubIndex,
+  convert_subtitles,
+  parse_ass,
+  parse_srt,
+  parse_timestamp,
+  parse_vtt,
+  retime,
+  write_ttxt,
+)
+
+
+def test_parse_timestamp():
+  assert parse_timestamp("01:02:03,456") == 3723.456
+  assert parse_timestamp("02:03.5") == 123.5
+  assert parse_timestamp("0:00:01.25") == 1.25
+
+
+def test_parse_srt():
+  srt = "\ufeff1\r\n00:00:01,000 --> 00:00:02,500\r\n<i>Hello</i>\r\nworld\r\n\r\n2\n00:00:03,000 --> 00:00:04,000\nBye"
+  assert list(parse_srt(io.StringIO(srt))) == [
+    Cue(1.0, 2.5, "Hello\nworld"),
+    Cue(3.0, 4.0, "Bye"),
+  ]
+
+
+def test_parse_vtt():
+  vtt = "WEBVTT\n\nNOTE a comment\n\nintro\n00:01.000 --> 00:02.000 align:start\n<v Bob>Hi</v>\n\n00:03.000 --> 00:04.000\nThere\n"
+  assert list(parse_vtt(io.StringIO(vtt))) == [Cue(1.0, 2.0, "Hi"), Cue(3.0, 4.0, "There")]
+
+
+def test_parse_ass():
+  ass = """[Script Info]
+Title: x
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+Dialogue: 0,0:00:05.00,0:00:06.00,Default,,0,0,0,,Later, with a comma
+Dialogue: 0,0:00:01.00,0:00:02.50,Default,,0,0,0,,{\\i1}First{\\i0}\\Nline
+Dialogue: 0,0:00:03.00,0:00:04.00,Default,,0,0,0,,{\\p1}
+"""
+  assert list(parse_ass(io.StringIO(ass))) == [
+    Cue(1.0, 2.5, "First\nline"),
+    Cue(5.0, 6.0, "Later, with a comma"),
+  ]
+
+
+def test_retime():
+  cues = [Cue(1.0, 2.0, "a"), Cue(4.0, 6.0, "b")]
+  assert list(retime(cues, delay=-3.0, elongation=1.0)) == [Cue(1.0, 3.0, "b")]
+  assert list(retime(cues, delay=-1.5, elongation=1.0)) == [Cue(0.0, 0.5, "a"), Cue(2.5, 4.5, "b")]
+
+
+def samples(cues):
+  fp = io.StringIO()
+  n = write_ttxt(cues, fp)
+  root = ET.fromstring(fp.getvalue().split("\n", 1)[1])
+  return n, [(s.get("sampleTime"), s.text or "") for s in root.iter("TextSample")]
+
+
+def test_write_ttxt():
+  n, s = samples([Cue(1.0, 2.0, "a & b"), Cue(2.0, 3.0, "c"), Cue(2.5, 4.0, "d")])
+  assert n == 3
+  assert s == [
+    ("00:00:00.000", ""),
+    ("00:00:01.000", "a & b"),
+    ("00:00:02.000", "c"),
+    ("00:00:02.500", "d"),
+    ("00:00:04.000", ""),
+  ]
+
+
+def test_write_ttxt_moves_cues_out_of_order():
+  _, s = samples([Cue(0.0, 5.0, "a"), Cue(3600.0, 3601.0, "b"), Cue(10.0, 11.0, "c")])
+  assert s == [
+    ("00:00:00.000", "a"),
+    ("00:00:05.000", ""),
+    ("01:00:00.000", "b"),
+    ("01:00:00.000", "c"),
+    ("01:00:00.000", ""),
+  ]
+
+
+def test_convert_subtitles(tmp_path):
+  srt = tmp_path / "a.SRT"
+  srt.write_text("1\n00:00:01,000 --> 00:00:02,000\nHi\n", encoding="utf-8")
+  assert convert_subtitles(srt, tmp_path / "a.ttxt", delay=1.0, elongation=2.0) == 1
+  assert 'sampleTime="00:00:03.000"' in (tmp_path / "a.ttxt").read_text(encoding="utf-8")
+
+
+IDX = """# VobSub index file, v7 (do not modify this line!)
+size: 720x480
+palette: 000000, 828282
+
+id: en, index: 0
+timestamp: 00:00:01:000, filepos: 000000000
+timestamp: 00:00:05:500, filepos: 000001800
+id: fr, index: 1
+timestamp: 01:02:03:040, filepos: 00000a000
+"""
+
+
+def test_vobsub_index_round_trip(tmp_path):
+  idx = VobSubIndex.parse(io.StringIO(IDX))
+  assert len(idx) == 3
+  assert list(idx.times) == [1.0, 5.5, 3723.04]
+  assert list(idx.filepos) == [0, 0x1800, 0xA000]
+  assert idx.languages() == [("en", 0), ("fr", 1)]
+  fp = io.StringIO()
+  idx.write(fp)
+  assert fp.getvalue() == IDX
+
+  f = tmp_path / "a.idx"
+  f.write_text(IDX)
+  VobSubIndex.for_file(f)
+  assert (tmp_path / "a.vsi").exists()
+  again = VobSubIndex.for_file(f)
+  assert (list(again.times), list(again.filepos), again.lines) == (list(idx.times), list(idx.filepos), idx.lines)
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_vobsub_index_retimed(monkeypatch, numpy):
+  if not numpy:
+    monkeypatch.setattr(subtitles, "np", None)
+  elif subtitles.np is None:
+    pytest.skip("numpy is not installed")
+  idx = VobSubIndex.parse(io.StringIO(IDX))
+  r = idx.retimed(delay=-2.0)
+  assert list(r.times) == [3.5, 3721.04]
+  assert list(r.filepos) == [0x1800, 0xA000]
+  fp = io.StringIO()
+  r.write(fp)
+  out = fp.getvalue().splitlines()
+  assert out.index("id: fr, index: 1") == out.index("timestamp: 00:00:03:500, filepos: 000001800") + 1
+  assert list(idx.retimed(elongation=2.0).times) == [2.0, 11.0, 7446.08]
+  # Each stream starts over at 0, so dropped subpictures need not come first.
+  two = "id: en, index: 0\ntimestamp: 00:00:10:000, filepos: 000000000\nid: fr, index: 1\ntimestamp: 00:00:01:000, filepos: 000000800\n"
+  r = VobSubIndex.parse(io.StringIO(two)).retimed(delay=-5.0)
+  assert (list(r.times), list(r.filepos)) == ([5.0], [0])
+  assert r.lines == [(0, "id: en, index: 0"), (1, "id: fr, index: 1")]
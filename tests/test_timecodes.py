@@ -0,0 +1,55 @@
+import pytest
+
+import timecodes
+from timecodes import Timecodes
+
+
+def v2(path, times):
+  path.write_text("# timestamp format v2\n" + "".join(f"{t:.0f}\n" for t in times))
+  return path
+
+
+def cfr(n, fps):
+  return [round(i * 1000.0 / fps) for i in range(n)]
+
+
+def test_store_round_trip(tmp_path):
+  times = cfr(1000, 23.976)
+  with Timecodes.for_file(v2(tmp_path / "a.t2c", times)) as tcs:
+    assert len(tcs) == 1000
+    assert list(tcs.times) == times
+    assert tcs[999] == times[-1]
+  assert (tmp_path / "a.tcs").exists()
+
+
+def test_store_is_reused_until_stale(tmp_path, monkeypatch):
+  tc = v2(tmp_path / "a.t2c", cfr(10, 25.0))
+  Timecodes.for_file(tc).close()
+  monkeypatch.setattr(Timecodes, "convert", None)
+  with Timecodes.for_file(tc) as tcs:
+    assert len(tcs) == 10
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_stats(tmp_path, monkeypatch, numpy):
+  if not numpy:
+    monkeypatch.setattr(timecodes, "np", None)
+  with Timecodes.for_file(v2(tmp_path / "cfr.t2c", cfr(2400, 23.976))) as tcs:
+    st = tcs.stats()
+  assert st["frames"] == 2400 and not st["vfr"]
+  assert st["typical_fps"] == pytest.approx(23.976, abs=0.3)  # Times are whole milliseconds.
+  assert st["duration"] == pytest.approx(2400 / 23.976, abs=0.05)
+
+  # Film at 23.976 fps followed by video at 29.97 fps.
+  times = cfr(1200, 23.976)
+  times += [times[-1] + t + 33 for t in cfr(600, 29.97)]
+  with Timecodes.for_file(v2(tmp_path / "vfr.t2c", times)) as tcs:
+    st = tcs.stats()
+  assert st["vfr"]
+  assert st["min_fps"] == pytest.approx(23.976, abs=1.0)
+  assert st["max_fps"] == pytest.approx(29.97, abs=1.5)
+
+
+def test_stats_of_few_frames(tmp_path):
+  with Timecodes.for_file(v2(tmp_path / "a.t2c", [])) as tcs:
+    assert tcs.stats() == {"frames": 0, "duration": 0.0, "vfr": False}
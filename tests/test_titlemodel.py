@@ -0,0 +1,92 @@
+import pathlib
+import threading
+
+from titlemodel import Title, Track
+
+
+def title():
+  return Title.from_dict(
+    {
+      "base": "Movie",
+      "cfgname": "Movie.yaml",
+      "custom": 1,
+      "chapters": {"time": [0.0, 60.0], "name": ["A", "B"]},
+      "track00": {"id": 0, "type": "video", "file": "Movie T00.264"},
+      "track01": {"id": 1, "type": "audio", "loudness": {"integrated": -23.0}},
+    }
+  )
+
+
+def test_round_trip_and_access():
+  t = title()
+  assert not t.modified()
+  assert t["track01"]["type"] == "audio"
+  assert t["track00"]["file"] == pathlib.Path("Movie T00.264")
+  assert t["custom"] == 1 and t["missing"] is None
+  assert t.to_dict() == title().to_dict()
+  assert t.to_dict()["track00"]["file"] == "Movie T00.264"
+
+
+def test_dirty_tracking():
+  t = title()
+  t["hdvideo"] = True
+  t["track01"]["quality"] = 60
+  t["custom"] = 1
+  assert t.dirty() == {"hdvideo"}
+  assert t.modified()
+  assert t.modclear()
+  assert not t.modified() and not t.modclear()
+  del t["custom"]
+  assert t.dirty() == {"custom"}
+
+
+def test_nested_records_share_the_lock():
+  t = title()
+  assert t.tracks[0].lock is t.lock and t.chapters.lock is t.lock
+  assert t.add_track(Track(id=2)).lock is t.lock
+  assert t.dirty() == {"tracks"}
+
+
+def test_serialize_while_stages_modify():
+  t = title()
+  stop = threading.Event()
+
+  def stage(track):
+    i = 0
+    while not stop.is_set():
+      i += 1
+      with t.lock:
+        track["frames"] = i
+        track["duration"] = i / 25.0
+
+  threads = [threading.Thread(target=stage, args=(tr,)) for tr in t.tracks]
+  for th in threads:
+    th.start()
+  try:
+    for _ in range(200):
+      with t.lock:
+        t.modclear()
+        d = t.to_dict()
+      for k in ("track00", "track01"):
+        if "frames" in d[k]:
+          assert d[k]["duration"] == d[k]["frames"] / 25.0
+  finally:
+    stop.set()
+    for th in threads:
+      th.join()
+
+
+def test_retimed_chapters():
+  c = title().chapters
+  c.update({"time": [0.0, 60.0, 120.0, 30.0], "name": list("ABCD"), "hidden": [0, 0, 1, 0], "enabled": [1, 1, 1, "0"]})
+  assert c.retimed() == [(0.0, "A", None), (60.0, "B", None)]
+  assert c.retimed(delay=-10.0, elongation=2.0) == [(0.0, "A", None), (110.0, "B", None)]
+
+
+def test_retimed_keeps_last_early_chapter_at_start():
+  c = title().chapters
+  c.update({"time": [0.0, 5.0, 60.0], "name": list("ABC"), "lang": ["eng"] * 3, "delay": -10.0})
+  assert c.retimed() == [(0.0, "B", "eng"), (50.0, "C", "eng")]
+  c.update({"delay": 1.0, "lang": ["eng"]})
+  assert c.retimed() == [(1.0, "A", None), (6.0, "B", None), (61.0, "C", None)]
+  assert c.retimed(delay=-100.0) == [(0.0, "C", None)]
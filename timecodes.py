@@ -0,0 +1,131 @@
+# Memory-mapped per-frame timecode store
+
+import array
+import logging
+import mmap
+import statistics
+import struct
+import sys
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+from cetools import *  # noqa: F403
+
+log = logging.getLogger()
+
+
+class Timecodes:
+  """The presentation times, in milliseconds, of the frames of a video track.
+
+  Times are parsed once from a timecodes v2 file (as written by mkvextract)
+  into a sidecar of little-endian doubles, which is memory-mapped from then
+  on, so that even a film's 200k frames cost next to no memory."""
+
+  magic = b"TCS1"
+  header = struct.Struct("<4sQ")
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as fp:
+      magic, n = self.header.unpack(fp.read(self.header.size))
+      if magic != self.magic:
+        raise ValueError(f"{path} is not a timecode store")
+      self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if n else None
+    if n == 0:
+      self.times = array.array("d")
+    elif sys.byteorder == "little":
+      self.times = memoryview(self._map)[self.header.size : self.header.size + 8 * n].cast("d")
+    else:
+      self.times = array.array("d", self._map[self.header.size : self.header.size + 8 * n])
+      self.times.byteswap()
+
+  def __len__(self):
+    return len(self.times)
+
+  def __getitem__(self, i):
+    return self.times[i]
+
+  def close(self):
+    if isinstance(self.times, memoryview):
+      self.times.release()
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  @classmethod
+  def convert(cls, v2file, path, chunk=65536):
+    """Write the times in timecodes v2 file v2file into store path, streaming."""
+
+    n = 0
+    with open(v2file, "rt", encoding="utf-8", errors="replace") as i, open(path, "wb") as o:
+      o.write(cls.header.pack(cls.magic, 0))
+      buf = array.array("d")
+      for l in i:
+        l = l.strip()
+        if not l or l.startswith("#"):
+          continue
+        buf.append(float(l))
+        if len(buf) >= chunk:
+          n += cls._flush(buf, o)
+      n += cls._flush(buf, o)
+      o.seek(0)
+      o.write(cls.header.pack(cls.magic, n))
+    return n
+
+  @staticmethod
+  def _flush(buf, o):
+    if sys.byteorder != "little":
+      buf.byteswap()
+    buf.tofile(o)
+    n = len(buf)
+    del buf[:]
+    return n
+
+  @classmethod
+  def for_file(cls, v2file):
+    """Return the store for v2file, converting it first if the store is missing or stale."""
+
+    path = v2file.with_suffix(".tcs")
+    try:
+      if path.stat().st_mtime_ns >= v2file.stat().st_mtime_ns:
+        return cls(path)
+    except (OSError, ValueError):
+      pass
+    cls.convert(v2file, path)
+    return cls(path)
+
+  def stats(self, vfr_tolerance=0.05):
+    """Return the frame count, duration, mean, typical, minimum, and maximum frame rates, and
+    whether the rate varies by more than vfr_tolerance from the typical rate."""
+
+    n = len(self.times)
+    if n < 2:
+      return {"frames": n, "duration": 0.0, "vfr": False}
+    if np is not None:
+      d = np.diff(np.frombuffer(self.times, dtype="<f8") if isinstance(self.times, memoryview) else np.array(self.times))
+      d = d[d > 0]
+      typical, shortest, longest = float(np.median(d)), float(d.min()), float(d.max())
+    else:
+      d = [b - a for a, b in zip(self.times, self.times[1:], strict=False) if b > a]
+      typical, shortest, longest = statistics.median(d), min(d), max(d)
+    span = self.times[n - 1] - self.times[0]
+    # Timecodes are rounded to milliseconds, so allow one millisecond of jitter.
+    slack = 1.0 + typical * vfr_tolerance
+    return {
+      "frames": n,
+      "duration": (span + typical) / 1000.0,
+      "fps": 1000.0 * (n - 1) / span,
+      "typical_fps": 1000.0 / typical,
+      "min_fps": 1000.0 / longest,
+      "max_fps": 1000.0 / shortest,
+      "vfr": longest - shortest > slack,
+    }
@@ -0,0 +1,392 @@
+# Typed, slotted data model for title configs
+
+import pathlib
+import re
+import threading
+import typing
+
+from dataclasses import dataclass, field, fields
+
+from cetools import *  # noqa: F403
+
+
+def _kinds(t):
+  """Return the set of runtime types (or generic origins) named by annotation t."""
+
+  args = typing.get_args(t) if typing.get_origin(t) in (typing.Union, type(int | None)) else (t,)
+  return {typing.get_origin(a) or a for a in args}
+
+
+def _plain(v):
+  """Convert v into something JSON and YAML can dump."""
+
+  if isinstance(v, Record):
+    return v.to_dict()
+  if isinstance(v, pathlib.PurePath):
+    return str(v)
+  if isinstance(v, dict):
+    return {k: _plain(i) for k, i in list(v.items())}
+  if isinstance(v, (list, tuple)):
+    return [_plain(i) for i in v]
+  return v
+
+
+def record(cls):
+  """Class decorator making cls a slotted Record dataclass.
+
+  Fields annotated with pathlib.Path hold paths; fields annotated with lists,
+  dicts, or Records are checked for nested modifications."""
+
+  cls = dataclass(slots=True)(cls)
+  fs = [f for f in fields(cls) if f.name not in ("_dirty", "_lock", "extra")]
+  cls._fieldset = frozenset(f.name for f in fs)
+  cls._paths = frozenset(f.name for f in fs if pathlib.Path in _kinds(f.type))
+  cls._nested = frozenset(
+    f.name
+    for f in fs
+    if any(k in (list, dict) or (isinstance(k, type) and issubclass(k, (Record, dict))) for k in _kinds(f.type))
+  )
+  return cls
+
+
+@dataclass(slots=True)
+class Record:
+  """Base of the config records.
+
+  Records allow defdict-style access: reading an unset field returns None,
+  assigning None unsets it, and undeclared keys are kept in extra so that
+  sidecars round-trip unchanged.  Modifications are tracked per field.
+
+  Stages of a title run concurrently, so each record has a reentrant lock,
+  shared with the records nested in it, that is held while it is modified,
+  serialized, or has its modifications cleared.  Hold lock to make several
+  changes at once."""
+
+  _dirty: set = field(default_factory=set, init=False, repr=False, compare=False)
+  _lock: typing.Any = field(default_factory=threading.RLock, init=False, repr=False, compare=False)
+  extra: dict = field(default_factory=dict, repr=False)
+
+  _fieldset = frozenset()
+  _paths = frozenset()
+  _nested = frozenset()
+
+  def __post_init__(self):
+    self._dirty.clear()
+
+  def __setattr__(self, name, value):
+    if name in self._paths and value is not None and not isinstance(value, pathlib.Path):
+      value = pathlib.Path(value)
+    if name in self._fieldset:
+      with self._lock:
+        if name in self._nested:
+          self._adopt(value)
+        try:
+          old = getattr(self, name)
+        except AttributeError:
+          old = None
+        object.__setattr__(self, name, value)
+        if old is not value and old != value:
+          self._dirty.add(name)
+    else:
+      object.__setattr__(self, name, value)
+
+  @property
+  def lock(self):
+    return self._lock
+
+  def _adopt(self, value):
+    """Have the records in value, one or a list of them, share this record's lock."""
+
+    for r in value if isinstance(value, list) else (value,):
+      if isinstance(r, Record) and r._lock is not self._lock:
+        object.__setattr__(r, "_lock", self._lock)
+        for n in r._nested:
+          r._adopt(getattr(r, n))
+
+  def __getitem__(self, key):
+    if key in self._fieldset:
+      return getattr(self, key)
+    return self.extra.get(key)
+
+  def __setitem__(self, key, value):
+    """n.b. Assigning None to a field unsets it."""
+
+    if key in self._fieldset:
+      setattr(self, key, value)
+      return
+    if isinstance(value, pathlib.PurePath):
+      value = str(value)
+    with self._lock:
+      if value is None:
+        if self.extra.pop(key, None) is not None:
+          self._dirty.add(key)
+      elif self.extra.get(key) != value:
+        self.extra[key] = value
+        self._dirty.add(key)
+
+  def __delitem__(self, key):
+    self[key] = None
+
+  def __contains__(self, key):
+    return self[key] is not None
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def get(self, key, default=None):
+    v = self[key]
+    return default if v is None else v
+
+  def keys(self):
+    return [n for n in self._fieldset if getattr(self, n) is not None] + list(self.extra)
+
+  def items(self):
+    return [(k, self[k]) for k in self.keys()]
+
+  def update(self, d):
+    with self._lock:
+      for k, v in d.items():
+        self[k] = v
+
+  def touch(self, name):
+    """Mark field name as modified, e.g., after changing a list in place."""
+
+    with self._lock:
+      self._dirty.add(name)
+
+  def dirty(self):
+    """Return the names of this record's modified fields."""
+
+    with self._lock:
+      return set(self._dirty)
+
+  def _children(self):
+    for n in self._nested:
+      v = getattr(self, n)
+      if isinstance(v, (Record, defdict)):
+        yield v
+      elif isinstance(v, list):
+        yield from (i for i in v if isinstance(i, (Record, defdict)))
+
+  def modified(self):
+    """Check whether record (or any nested record) has been modified."""
+
+    with self._lock:
+      return bool(self._dirty) or any(c.modified() for c in self._children())
+
+  def modclear(self):
+    """Check whether record (or any nested record) has been modified
+    and clear modification status."""
+
+    with self._lock:
+      # Note: list, not generator, to prevent short-circuiting
+      m = any([c.modclear() for c in self._children()])
+      m = m or bool(self._dirty)
+      self._dirty.clear()
+      return m
+
+  def to_dict(self):
+    with self._lock:
+      d = {n: _plain(v) for n in self._fieldset if (v := getattr(self, n)) is not None}
+      d.update(_plain(self.extra))
+      return d
+
+  @classmethod
+  def from_dict(cls, d):
+    known = {}
+    extra = {}
+    for k, v in d.items():
+      if k in cls._fieldset:
+        known[k] = cls._load(k, v)
+      else:
+        extra[k] = v
+    return cls(extra=extra, **known)
+
+  @classmethod
+  def _load(cls, k, v):
+    if isinstance(v, dict) and k in cls._nested:
+      return defdict(v)
+    return v
+
+
+def _flag(v):
+  return str(v).strip().casefold() in ("1", "true", "yes")
+
+
+@record
+class Chapters(Record):
+  """Chapters as columns: the i-th entry of each list describes chapter i."""
+
+  uid: list | None = None
+  time: list | None = None
+  hidden: list | None = None
+  enabled: list | None = None
+  name: list | None = None
+  lang: list | None = None
+  delay: float | None = None
+  elongation: float | None = None
+
+  def retimed(self, delay=0.0, elongation=1.0):
+    """Return the (time, name, lang) of the enabled, visible chapters in order.
+
+    Times are stretched and shifted first by this record's elongation and
+    delay and then by the given ones.  Of the chapters moved before the
+    start, only the last is kept, at 0."""
+
+    times = self.time or []
+    n = len(times)
+
+    def column(c, default):
+      return c if c is not None and len(c) == n else [default] * n
+
+    e = (self.elongation or 1.0) * elongation
+    d = (self.delay or 0.0) * elongation + delay
+    shown = [
+      (float(t) * e + d, name, lang)
+      for t, name, lang, hidden, enabled in zip(
+        times, column(self.name, None), column(self.lang, None), column(self.hidden, 0), column(self.enabled, 1), strict=True
+      )
+      if not _flag(hidden) and _flag(enabled)
+    ]
+    shown.sort(key=lambda c: c[0])
+    early = [c for c in shown if c[0] <= 0.0]
+    later = [c for c in shown if c[0] > 0.0]
+    if early:
+      _, name, lang = early[-1]
+      return [(0.0, name, lang)] + later
+    return later
+
+
+@record
+class Track(Record):
+  id: int | None = None
+  type: str | None = None
+  disable: bool | None = None
+  passthrough: bool | None = None
+  format: str | None = None
+  extension: str | None = None
+  mkvtrack: int | None = None
+  stream: int | None = None
+  file: pathlib.Path | None = None
+  dgifile: pathlib.Path | None = None
+  t2cfile: pathlib.Path | None = None
+  avsfile: pathlib.Path | None = None
+  outfile: pathlib.Path | None = None
+  language: str | None = None
+  name: str | None = None
+  trackname: str | None = None
+  default_track: bool | None = None
+  forcedtrack: bool | None = None
+  delay: float | None = None
+  elongation: float | None = None
+  duration: float | None = None
+  frames: int | None = None
+  frameduration: float | None = None
+  vfr: bool | None = None
+  samplerate: int | None = None
+  channels: int | None = None
+  downmix: int | None = None
+  normalize: bool | None = None
+  quality: int | None = None
+  outputs: list | None = None
+  loudness: dict | None = None
+  display_width: int | None = None
+  display_height: int | None = None
+  pixel_width: int | None = None
+  pixel_height: int | None = None
+  picture_width: int | None = None
+  picture_height: int | None = None
+  sample_aspect_ratio: float | None = None
+  frame_rate_ratio: float | None = None
+  frame_rate_ratio_out: float | None = None
+  field_operation: int | None = None
+  interlace_fraction: float | None = None
+  interlace_type: str | None = None
+  macroblocks: int | None = None
+  crop: str | None = None
+  varying_aspect: bool | None = None
+  degrain: int | None = None
+  unblock: str | bool | None = None
+  processors: int | None = None
+  outformat: str | None = None
+  avc_profile: str | None = None
+  avc_level: float | None = None
+  x264_preset: str | None = None
+  x264_tune: str | None = None
+  x264_rate_factor: float | None = None
+  x264_deterministic: bool | None = None
+  x264_fast_pskip: bool | None = None
+  x264_dct_decimate: bool | None = None
+  x265_preset: str | None = None
+  x265_tune: str | None = None
+  x265_rate_factor: float | None = None
+  x265_bit_depth: int | None = None
+  dg: defdict | None = None
+
+
+_trackkey = re.compile(r"track(\d+)")
+
+
+@record
+class Title(Record):
+  cfgname: pathlib.Path | None = None
+  base: str | None = None
+  type: str | None = None
+  show: str | None = None
+  title: str | None = None
+  song: str | None = None
+  year: int | str | None = None
+  season: int | None = None
+  episode: int | None = None
+  duration: float | None = None
+  hdvideo: bool | None = None
+  languages: list | None = None
+  imdb_id: str | None = None
+  omdb_status: str | None = None
+  genre: str | None = None
+  description: str | None = None
+  comment: list | None = None
+  coverart: list | None = None
+  tool: str | None = None
+  chapters: Chapters | None = None
+  mkvcontainer: defdict | None = None
+  tracks: list[Track] = field(default_factory=list)
+
+  def __getitem__(self, key):
+    if key in self._fieldset:
+      return getattr(self, key)
+    if m := _trackkey.fullmatch(key):
+      tid = int(m[1])
+      return next((t for t in self.tracks if t.id == tid), None)
+    return self.extra.get(key)
+
+  def add_track(self, track):
+    with self._lock:
+      self._adopt(track)
+      self.tracks.append(track)
+      self._dirty.add("tracks")
+    return track
+
+  # n.b. Zero-argument super() does not work in slotted dataclasses.
+  def to_dict(self):
+    with self._lock:
+      d = Record.to_dict(self)
+      del d["tracks"]
+      for t in self.tracks:
+        d[f"track{t.id:02d}"] = t.to_dict()
+      return d
+
+  @classmethod
+  def from_dict(cls, d):
+    d = dict(d)
+    ts = [Track.from_dict(d.pop(k)) for k in list(d) if _trackkey.fullmatch(k)]
+    title = Record.from_dict.__func__(cls, d)
+    title.tracks = sorted(ts, key=lambda t: t.id)
+    title._dirty.clear()
+    return title
+
+  @classmethod
+  def _load(cls, k, v):
+    if k == "chapters" and isinstance(v, dict):
+      return Chapters.from_dict(v)
+    return Record._load.__func__(cls, k, v)